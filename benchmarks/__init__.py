@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+"""
+Shared plumbing for the benchmarks.
+
+Every benchmark produces a list of results, each a dictionary with a
+"benchmark" name, any parameters, and its measurements.  The results are
+written as one JSON document that also describes the environment, so runs
+from different commits can be compared with benchmarks.compare.
+"""
+import argparse
+import json
+import platform
+import subprocess  # nosec
+import sys
+import timeit
+from datetime import datetime
+from datetime import timezone
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+
+def arguments(
+    description: Optional[str], repeat: bool = True
+) -> argparse.ArgumentParser:
+    """The command line arguments the benchmarks accept."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--output", type=Path, help="write the results to this file (default stdout)"
+    )
+    if repeat:
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="repeat each measurement this many times",
+        )
+    return parser
+
+
+def measure(
+    name: str, func: Callable[[], Any], repeat: int, **params: Any
+) -> Dict[str, Any]:
+    """
+    Time a function, returning the best time per call in nanoseconds.
+
+    The number of calls per measurement is chosen so that a measurement
+    takes at least 0.2 seconds, then the best of several measurements is
+    taken to reduce the noise from everything else on the machine.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {"benchmark": name, **params, "ns_per_op": round(best * 1e9, 1)}
+
+
+def environment() -> Dict[str, Any]:
+    """Describe where the benchmarks ran."""
+    try:
+        commit = subprocess.run(  # nosec
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            check=True,
+            cwd=Path(__file__).parent,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "time": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def emit(suite: str, results: List[Dict[str, Any]], output: Optional[Path]) -> None:
+    """Write the results of a suite."""
+    document = {"suite": suite, "environment": environment(), "results": results}
+    text = json.dumps(document, indent=2) + "\n"
+    if output is None:
+        sys.stdout.write(text)
+    else:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(text)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+"""
+Compares two benchmark result files, typically from two commits, and
+reports the change in each measurement.  Exits non-zero if any
+measurement is slower than the baseline by more than the threshold.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Tuple
+
+# lower is better for these, higher is better for everything else
+LOWER_IS_BETTER = ("ns_per_op", "seconds")
+MEASUREMENTS = LOWER_IS_BETTER + ("calls_per_second",)
+
+
+def load(path: Path) -> Dict[Tuple, Dict[str, Any]]:
+    """Load results keyed by the benchmark name and its parameters."""
+    results = {}
+    for result in json.loads(path.read_text())["results"]:
+        params = tuple(
+            sorted((k, str(v)) for k, v in result.items() if k not in MEASUREMENTS)
+        )
+        results[params] = result
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("current", type=Path)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="fraction slower than the baseline considered a regression",
+    )
+    args = parser.parse_args()
+
+    baseline = load(args.baseline)
+    current = load(args.current)
+    regressed = False
+    for params, result in current.items():
+        before = baseline.get(params)
+        if before is None:
+            continue
+        for measurement in MEASUREMENTS:
+            if measurement not in result or not before.get(measurement):
+                continue
+            change = result[measurement] / before[measurement] - 1.0
+            slower = change if measurement in LOWER_IS_BETTER else -change
+            flag = ""
+            if slower > args.threshold:
+                flag = "  REGRESSION"
+                regressed = True
+            name = " ".join(f"{k}={v}" for k, v in params)
+            print(
+                f"{name}: {measurement} {before[measurement]} -> "
+                f"{result[measurement]} ({change:+.1%}){flag}"
+            )
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+"""
+Measures the overhead the interposer adds to calls and attribute lookups,
+with various numbers of handlers, and with the tape deck recording or
+playing back.
+"""
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from benchmarks.common import arguments
+from benchmarks.common import emit
+from benchmarks.common import measure
+from interposer import CallBypass
+from interposer import CallContext
+from interposer import CallHandler
+from interposer import Interposer
+from interposer.policy import WrapPolicy
+from interposer.recorder import TapeDeckCallHandler
+from interposer.tapedeck import Mode
+from interposer.tapedeck import TapeDeck
+
+
+class Client(object):
+    """Stands in for a third party client."""
+
+    def __init__(self, name: str = "client") -> None:
+        self.name = name
+
+    def method(self, value: int, flag: bool = False) -> int:
+        return value
+
+
+class PassingCallHandler(CallHandler):
+    """A handler that does nothing in every hook it overrides."""
+
+    def on_call_begin(self, context: CallContext) -> Optional[CallBypass]:
+        return None
+
+    def on_call_end_exception(
+        self, context: CallContext, ex: Exception
+    ) -> Optional[Exception]:
+        return None
+
+    def on_call_end_result(self, context: CallContext, result: Any) -> Any:
+        return result
+
+
+def calls(repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    client = Client()
+    results.append(measure("call", lambda: client.method(1), repeat, wrapping="raw"))
+
+    single = Interposer(Client(), PassingCallHandler())
+    results.append(
+        measure("call", lambda: single.method(1), repeat, wrapping="interposer")
+    )
+
+    stacked = Interposer(
+        Interposer(Interposer(Client(), PassingCallHandler()), PassingCallHandler()),
+        PassingCallHandler(),
+    )
+    results.append(
+        measure("call", lambda: stacked.method(1), repeat, wrapping="stacked-3")
+    )
+
+    policy = WrapPolicy(include=["*.Client.other"])
+    limited = Interposer(Client(), PassingCallHandler(), policy=policy)
+    results.append(
+        measure("call", lambda: limited.method(1), repeat, wrapping="policy-raw")
+    )
+
+    for count in (0, 1, 5, 20):
+        uut = Interposer(Client(), [PassingCallHandler() for _ in range(count)])
+        results.append(measure("handlers", lambda: uut.method(1), repeat, count=count))
+
+    noops = Interposer(Client(), [CallHandler() for _ in range(5)])
+    results.append(measure("handlers", lambda: noops.method(1), repeat, count="5-noop"))
+    return results
+
+
+def attributes(repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    client = Client()
+    results.append(measure("getattr", lambda: client.method, repeat, wrapping="raw"))
+    uut = Interposer(Client(), PassingCallHandler())
+    results.append(
+        measure("getattr", lambda: uut.method, repeat, wrapping="interposer")
+    )
+    results.append(measure("getattr", lambda: uut.name, repeat, wrapping="data"))
+    return results
+
+
+def instantiation(repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    results.append(measure("instantiate", lambda: Client(), repeat, wrapping="raw"))
+    uut = Interposer(Client, PassingCallHandler())
+    results.append(
+        measure("instantiate", lambda: uut(), repeat, wrapping="interposer-rewrap")
+    )
+    return results
+
+
+def tapedeck(repeat: int, calls: int = 1000) -> List[Dict[str, Any]]:
+    """
+    Recording and playback work on a fixed number of calls, since every
+    call recorded has to be found again on playback.  Each repetition runs
+    in its own scope so the calls it records are distinct.  Recording is
+    measured with and without the contexts kept for forensics, and playback
+    from the file and preloaded into memory.
+    """
+    results = []
+    datadir = Path(tempfile.mkdtemp())
+    try:
+        for mode, name, options in (
+            (Mode.Recording, "lean", {"forensics_every": 0}),
+            (Mode.Recording, "bench", {}),
+            (Mode.Playback, "bench", {}),
+            (Mode.Playback, "bench", {"preload": True}),
+        ):
+            with TapeDeck(datadir / name, mode, **options) as deck:
+                uut = Interposer(Client(), TapeDeckCallHandler(deck, "bench"))
+                times = []
+                for rep in range(repeat):
+                    with deck.scope(str(rep)):
+                        start = time.perf_counter()
+                        for value in range(calls):
+                            uut.method(value)
+                        times.append(time.perf_counter() - start)
+            results.append(
+                {
+                    "benchmark": "tapedeck",
+                    "mode": mode.name,
+                    **options,
+                    "ns_per_op": round(min(times) / calls * 1e9, 1),
+                }
+            )
+    finally:
+        shutil.rmtree(str(datadir))
+    return results
+
+
+def main() -> None:
+    parser = arguments(__doc__)
+    args = parser.parse_args()
+    results = (
+        calls(args.repeat)
+        + attributes(args.repeat)
+        + instantiation(args.repeat)
+        + tapedeck(args.repeat)
+    )
+    emit("overhead", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+"""
+Measures redacting a pickled API response and a log line as the number
+of tracked secrets grows, comparing the compiled Redactor against
+replacing each secret in turn.
+"""
+import pickle  # nosec
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Union
+
+from benchmarks.common import arguments
+from benchmarks.common import emit
+from benchmarks.common import measure
+from interposer.redaction import Redactor
+
+
+def sequential(redactions: Dict[Union[str, bytes], str], raw: bytes) -> bytes:
+    """How redaction worked before the Redactor."""
+    for secret, replacement in redactions.items():
+        raw = raw.replace(
+            secret.encode() if isinstance(secret, str) else secret,
+            replacement.encode(),
+        )
+    return raw
+
+
+def main() -> None:
+    parser = arguments(__doc__)
+    args = parser.parse_args()
+
+    response = [
+        {"id": item, "name": f"resource-{item}", "tags": {"owner": "someone"}}
+        for item in range(2000)
+    ]
+    raw = pickle.dumps(response, protocol=4)
+    line = "TAPE: record(result): " + repr(response[:20])
+
+    results: List[Dict[str, Any]] = []
+    for count in (1, 10, 50, 100, 500):
+        redactions: Dict[Union[str, bytes], str] = {
+            f"secret-{index:04}-value": f"id{index}".ljust(17, "_")
+            for index in range(count)
+        }
+        redactor = Redactor(redactions)
+        params = {"secrets": count, "bytes": len(raw)}
+        results.append(
+            measure(
+                "redact_bytes",
+                lambda: sequential(redactions, raw),
+                args.repeat,
+                engine="sequential",
+                **params,
+            )
+        )
+        results.append(
+            measure(
+                "redact_bytes",
+                lambda: redactor.redact_bytes(raw),
+                args.repeat,
+                engine="compiled",
+                **params,
+            )
+        )
+        results.append(
+            measure(
+                "redact_text",
+                lambda: redactor.redact_text(line),
+                args.repeat,
+                engine="compiled",
+                secrets=count,
+            )
+        )
+        results.append(
+            measure("compile", lambda: Redactor(redactions), args.repeat, secrets=count)
+        )
+    emit("redaction", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+"""
+Measures TapeDeck recording and playback throughput as the number of
+threads making calls grows.
+
+Each call sleeps briefly to stand in for network latency, which is the
+situation where fanning out across threads pays off.  Recording is measured
+with and without write-behind.
+"""
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks.common import arguments
+from benchmarks.common import emit
+from interposer import Interposer
+from interposer.recorder import TapeDeckCallHandler
+from interposer.storage import WriteBehind
+from interposer.tapedeck import Mode
+from interposer.tapedeck import TapeDeck
+
+
+class Service(object):
+    """Stands in for a client of a remote service."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    def fetch(self, item: int, page: int) -> dict:
+        time.sleep(self.latency)
+        return {"item": item, "page": page, "body": "x" * 256}
+
+
+def run(deck: TapeDeck, threads: int, items: int, pages: int, latency: float) -> float:
+    """Make all the calls and return the elapsed time in seconds."""
+    service = Interposer(Service(latency), TapeDeckCallHandler(deck, "bench"))
+
+    def work(item: int) -> None:
+        with deck.scope(str(item)):
+            for page in range(pages):
+                service.fetch(item, page)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(work, range(items)))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = arguments(__doc__, repeat=False)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--items", type=int, default=32)
+    parser.add_argument("--pages", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.002)
+    args = parser.parse_args()
+
+    results = []
+    datadir = Path(tempfile.mkdtemp())
+    try:
+        for threads in args.threads:
+            tape = datadir / f"threads{threads}"
+            calls = args.items * args.pages
+            runs = [
+                (Mode.Recording, tape, None),
+                (Mode.Recording, datadir / f"behind{threads}", WriteBehind()),
+                (Mode.Playback, tape, None),
+            ]
+            for mode, path, write_behind in runs:
+                with TapeDeck(path, mode, write_behind=write_behind) as deck:
+                    elapsed = run(deck, threads, args.items, args.pages, args.latency)
+                results.append(
+                    {
+                        "benchmark": "tapedeck_threads",
+                        "mode": mode.name,
+                        "write_behind": write_behind is not None,
+                        "threads": threads,
+                        "calls": calls,
+                        "seconds": round(elapsed, 6),
+                        "calls_per_second": round(calls / elapsed, 1),
+                    }
+                )
+    finally:
+        shutil.rmtree(str(datadir))
+    emit("tapedeck_threads", results, args.output)
+
+
+if __name__ == "__main__":
+    main()
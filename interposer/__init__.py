@@ -4,8 +4,10 @@
 # Copyright (C) 2021 - 2022 CloudTruth, Inc.
 #
 import inspect
+import weakref
 from dataclasses import dataclass
-from dataclasses import field
+from types import BuiltinMethodType
+from types import MethodType
 from typing import Any
 from typing import Callable
 from typing import Dict
@@ -15,6 +17,9 @@ from typing import Tuple
 from typing import Union
 
 from wrapt import CallableObjectProxy
+from wrapt import ObjectProxy
+
+from interposer.policy import WrapPolicy
 
 
 @dataclass
@@ -26,7 +31,7 @@ class CallBypass:
     result: Any
 
 
-@dataclass
+@dataclass(init=False, repr=False, eq=False)
 class CallContext:
     """
     Provides argument and temporary storage for the call duration.
@@ -41,21 +46,113 @@ class CallContext:
                      affect behavior of certian call handlers
 
         rewrap (bool): used to control whether the result is rewrapped
-                       this implements selective diving
+                       this implements selective diving; None if nothing
+                       decided (the context was not made by an interposer)
+        scratch (dict): temporary storage like meta that is never pickled,
+                        compared, or recorded, for values that differ from
+                        one run to the next (such as timings) or that are
+                        keyed by objects (such as the handler itself)
+
+    The meta storage is only allocated the first time it is accessed, so
+    handlers that do not need it should not touch it; use peek() to read
+    meta without allocating it.  A call through handlers that leave meta
+    alone allocates nothing beyond the context itself.  Meta is still a
+    field, so it is compared and is kept by dataclasses.asdict() and
+    dataclasses.replace(); an empty meta equals one never allocated.  The
+    scratch storage is allocated the same way, read it with peek_scratch().
+
+    The pickled form of a context is the same as it was when meta held
+    the rewrap flag, so recordings keep their call signatures.
     """
 
+    __slots__ = ("call", "args", "kwargs", "rewrap", "_meta", "_scratch")
+
     call: Callable
-    args: Tuple[Any]
+    args: Tuple[Any, ...]
     kwargs: Dict[str, Any]
-    meta: Dict[str, Any] = field(default_factory=dict)
+    meta: Dict[str, Any]  # see the property below
+    rewrap: Optional[bool]
+
+    def __init__(
+        self,
+        call: Callable,
+        args: Tuple[Any, ...],
+        kwargs: Dict[str, Any],
+        meta: Optional[Dict[str, Any]] = None,
+        rewrap: Optional[bool] = None,
+    ) -> None:
+        self.call = call
+        self.args = args
+        self.kwargs = kwargs
+        self.rewrap = rewrap
+        self._meta = meta
+        self._scratch: Optional[Dict[Any, Any]] = None
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(call={self.call!r}, args={self.args!r}, "
+            f"kwargs={self.kwargs!r}, meta={self._meta or {}!r}, rewrap={self.rewrap!r})"
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CallContext) or type(other) is not type(self):
+            return NotImplemented
+        return (
+            self.call == other.call
+            and self.args == other.args
+            and self.kwargs == other.kwargs
+            and (self._meta or {}) == (other._meta or {})
+            and self.rewrap == other.rewrap
+        )
+
+    def __getstate__(self) -> Dict[str, Any]:
+        meta = self._meta if self._meta is not None else {}
+        if self.rewrap is not None:
+            meta = {"_flags": {"rewrap": self.rewrap}, **meta}
+        return {
+            "call": self.call,
+            "args": self.args,
+            "kwargs": self.kwargs,
+            "meta": meta,
+        }
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        meta = dict(state["meta"])
+        self.call = state["call"]
+        self.args = state["args"]
+        self.kwargs = state["kwargs"]
+        self.rewrap = meta.pop("_flags", {}).get("rewrap")
+        self._meta = meta or None
+        self._scratch = None
+
+    # the meta field, allocated on first use
+    @property  # type: ignore[no-redef]
+    def meta(self) -> Dict[str, Any]:
+        if self._meta is None:
+            self._meta = {}
+        return self._meta
+
+    @meta.setter
+    def meta(self, value: Dict[str, Any]) -> None:
+        self._meta = value
+
+    def peek(self, key: str, default: Any = None) -> Any:
+        """
+        Read an item from meta without allocating meta storage.
+        """
+        return default if self._meta is None else self._meta.get(key, default)
 
     @property
-    def rewrap(self) -> bool:
-        return self.meta.get("_flags", {}).get("rewrap", False)
+    def scratch(self) -> Dict[Any, Any]:
+        if self._scratch is None:
+            self._scratch = {}
+        return self._scratch
 
-    @rewrap.setter
-    def rewrap(self, value: bool) -> None:
-        self.meta.setdefault("_flags", {})["rewrap"] = value
+    def peek_scratch(self, key: Any, default: Any = None) -> Any:
+        """
+        Read an item from scratch without allocating scratch storage.
+        """
+        return default if self._scratch is None else self._scratch.get(key, default)
 
 
 class CallHandler(object):
@@ -109,6 +206,61 @@ class CallHandler(object):
         """
         return result
 
+    def on_call_yield(self, context: CallContext, item: Any) -> Any:
+        """
+        Invoked for each item as the caller consumes an iterator result.
+
+        When any handler implements this or on_call_end_stream, a call that
+        returns a generator has its result replaced with a streaming proxy
+        which invokes these hooks as the items are consumed.  Other iterators
+        (such as file objects, or objects that are their own iterator) and
+        results that get rewrapped are not streamed.  Whatever this method returns is given to the caller in
+        place of the item.
+        """
+        return item
+
+    def on_call_end_stream(
+        self, context: CallContext, ex: Optional[Exception]
+    ) -> Optional[Exception]:
+        """
+        Invoked when an iterator result is exhausted (ex is None) or raises
+        an exception while the caller consumes it.
+
+        If this method returns an Exception, it replaces the original
+        exception as in on_call_end_exception.  This is not invoked if
+        the caller stops consuming the iterator before it is exhausted.
+        """
+        return None
+
+    async def on_call_begin_async(self, context: CallContext) -> Optional[CallBypass]:
+        """
+        Invoked instead of on_call_begin when the call is a coroutine.
+
+        The default implementation calls on_call_begin, so handlers only
+        need to override this to await something of their own.
+        """
+        return self.on_call_begin(context)
+
+    async def on_call_end_exception_async(
+        self, context: CallContext, ex: Exception
+    ) -> Optional[Exception]:
+        """
+        Invoked instead of on_call_end_exception when the call is a coroutine,
+        after it has been awaited.
+
+        The default implementation calls on_call_end_exception.
+        """
+        return self.on_call_end_exception(context, ex)
+
+    async def on_call_end_result_async(self, context: CallContext, result: Any) -> Any:
+        """
+        Invoked instead of on_call_end_result when the call is a coroutine,
+        with the result of awaiting it.
+
+        The default implementation calls on_call_end_result.
+        """
+        return self.on_call_end_result(context, result)
+
 
 class Interposer(CallableObjectProxy):
     """
@@ -152,6 +304,17 @@ class Interposer(CallableObjectProxy):
     or raise an exception, bypassing the actual call completely.  This is
     useful when playing back responses that were recorded, for example.
 
+    When a coroutine function is wrapped, the __call__ returns a coroutine
+    and the handlers run as it is awaited, using their async hook variants
+    (on_call_begin_async, etc.) so they see the actual result or exception
+    rather than the coroutine object.
+
+    When a call returns a generator and a handler implements on_call_yield
+    or on_call_end_stream, the result is a streaming proxy that hands each
+    item to the handlers as the caller consumes it, so large or paged
+    results can be processed without materializing them.  The proxy is
+    otherwise indistinguishable from the iterator it wraps.
+
     When subclassing to implement specific behavior, rememeber you must
     prefix _self_ in front of any class property you want to be able to
     access in your implementation due to wrapt.CallableObjectProxy rules.
@@ -164,10 +327,28 @@ class Interposer(CallableObjectProxy):
     capture, any subclass must implement the capture method, allowing
     the framework to wrap and also allowing the subclass to optionally
     share state among the child interposers.
+
+    Each interposer remembers the attributes it has handed out.  Looking
+    up the same attribute again returns the same child interposer as long
+    as the underlying attribute has not changed, so a hot loop calling
+    `client.method()` costs a dictionary hit instead of an inspection of
+    the attribute and the construction of a new child interposer.  Only
+    attributes the wrapped entity keeps alive anyway (such as its methods,
+    the values stored on it, and functions, classes, and modules) are held
+    by the cache; for any other value, such as one a property makes on each
+    lookup, the cache holds a weak reference to the child interposer, so it
+    does not keep the value alive.
+
+    A WrapPolicy limits the wrapping to the parts of the tree that matter,
+    for example the few methods of a client library that make network
+    calls.  Attributes the policy does not want are returned raw.
     """
 
     def __init__(
-        self, entity: Any, handlers: Union[CallHandler, List[CallHandler]]
+        self,
+        entity: Any,
+        handlers: Union[CallHandler, List[CallHandler]],
+        policy: Optional[WrapPolicy] = None,
     ) -> None:
         """
         Wrap a module, class, object, method, or function and imbue calls
@@ -175,10 +356,72 @@ class Interposer(CallableObjectProxy):
 
         Args:
             entity (Any): A module, class, object, method, or function.
-            handlers (list): Call handlers to invoke
+            handlers (list): Call handlers to invoke; handlers added to or
+                             removed from the list are seen on the next call
+            policy (WrapPolicy): Limits what is wrapped and which calls the
+                                 handlers see; shared by child interposers
         """
         super().__init__(entity)
         self._self_handlers = handlers if isinstance(handlers, list) else [handlers]
+        self._self_policy = policy
+        # attribute name and (the attribute, its child interposer or None),
+        # or a weak reference to the child interposer of any other value
+        self._self_attrs: Dict[str, Union[Tuple[Any, Any], weakref.ref]] = {}
+        # a call to instantiate an object from a class definition is
+        # rewrapped by default so we capture the calls on the object
+        self._self_isclass = inspect.isclass(entity)
+        if isinstance(entity, Interposer):
+            # inspecting a stacked interposer would wrap its attributes
+            self._self_isasync: bool = entity._self_isasync
+        else:
+            self._self_isasync = inspect.iscoroutinefunction(entity)
+        self._self_plan()
+
+    def _self_plan(self) -> None:
+        """
+        Collect the hooks that actually do something, in handler order.
+
+        This is done again whenever the list of handlers changes.  The hooks
+        are collected once per list of handlers and shared by the interposers
+        using it, so child interposers cost little to make.  A hook assigned
+        to a handler instance after it was added is not noticed.
+        """
+        handlers = self._self_handlers
+        plan = _plans.get(id(handlers))
+        if plan is None or plan.handlers is not handlers or plan.snapshot != handlers:
+            plan = _plans[id(handlers)] = _Plan(handlers)
+        # holding the plan keeps it shared with the other interposers
+        self._self_hooks = plan
+        self._self_planned = plan.snapshot
+        self._self_on_begin = plan.on_begin
+        self._self_on_exception = plan.on_exception
+        self._self_on_result = plan.on_result
+        self._self_on_yield = plan.on_yield
+        self._self_on_end_stream = plan.on_end_stream
+        # instantiating a class never streams, its result is rewrapped
+        self._self_streams = not self._self_isclass and bool(
+            self._self_on_yield or self._self_on_end_stream
+        )
+        self._self_passthru = not (
+            self._self_on_begin
+            or self._self_on_exception
+            or self._self_on_result
+            or self._self_streams
+        )
+        self._self_on_begin_async = plan.on_begin_async
+        self._self_on_exception_async = plan.on_exception_async
+        self._self_on_result_async = plan.on_result_async
+        if self._self_isasync:
+            self._self_passthru = not (
+                self._self_on_begin_async
+                or self._self_on_exception_async
+                or self._self_on_result_async
+                or self._self_streams
+            )
+        policy = self._self_policy
+        if policy is not None and not policy.interposes(self.__wrapped__):
+            # only here so the members can be reached
+            self._self_passthru = True
 
     def __call__(self, *args, **kwargs):
         """
@@ -187,46 +430,112 @@ class Interposer(CallableObjectProxy):
         This means we've wrapped a class (when called makes an object) or
         that we've wrapped a method or function (when called returns a result).
 
+        Only the hooks a handler overrides are invoked.  When no handler
+        overrides any hook, the call goes straight to the wrapped callable.
+
         It is intentional that we are not logging anything here, as this
         information could contain secrets.
         """
-        context = CallContext(self.__wrapped__, args, kwargs)
-
-        # by default, a call to instantiate an object from a class definition
-        # is rewrapped so we capture the calls on the object
-        context.rewrap = inspect.isclass(self.__wrapped__)
+        if self._self_handlers != self._self_planned:
+            self._self_plan()
+        if self._self_passthru:
+            result = self.__wrapped__(*args, **kwargs)
+            if self._self_isclass:
+                result = self._self_wrap(result)
+            return result
+
+        context = CallContext(self.__wrapped__, args, kwargs, None, self._self_isclass)
+        if self._self_isasync:
+            return self._self_acall(context)
 
         # see if a handler wants to bypass the call
-        for handler in self._self_handlers:
-            bypass = handler.on_call_begin(context)
+        for on_call_begin in self._self_on_begin:
+            bypass = on_call_begin(context)
             if bypass:
                 if context.rewrap:
-                    # FIXME: derived types cannot have additional arguments
-                    return type(self)(bypass.result, self._self_handlers)
+                    return self._self_wrap(bypass.result)
                 else:
                     return bypass.result
 
         # nope, so make the actual call
         try:
-            result = super().__call__(*context.args, **context.kwargs)
+            result = self.__wrapped__(*context.args, **context.kwargs)
+        except Exception as ex:
+            orig_ex = ex
+            for on_call_end_exception in self._self_on_exception:
+                repl = on_call_end_exception(context, ex)
+                if isinstance(repl, Exception):
+                    ex = repl
+            if ex is orig_ex:
+                raise  # re-raise the original exception
+            else:
+                raise ex  # raise the replacement exception
+        if self._self_streams and not context.rewrap and _isstream(result):
+            result = _Stream(
+                result, context, self._self_on_yield, self._self_on_end_stream
+            )
+        for on_call_end_result in self._self_on_result:
+            result = on_call_end_result(context, result)
+
+        if context.rewrap:
+            result = self._self_wrap(result)
+        return result
+
+    async def _self_acall(self, context: CallContext) -> Any:
+        """
+        Handle a call on a wrapped coroutine function.
+
+        This is __call__ for coroutines: the begin hooks run when the
+        coroutine is first awaited, and the end hooks run once the actual
+        call has been awaited.  The actual coroutine is never created if
+        a handler bypasses the call.
+        """
+        for on_call_begin, isasync in self._self_on_begin_async:
+            bypass = on_call_begin(context)
+            if isasync:
+                bypass = await bypass
+            if bypass:
+                if context.rewrap:
+                    return self._self_wrap(bypass.result)
+                else:
+                    return bypass.result
+
+        try:
+            result = await self.__wrapped__(*context.args, **context.kwargs)
         except Exception as ex:
             orig_ex = ex
-            for handler in self._self_handlers:
-                repl = handler.on_call_end_exception(context, ex)
+            for on_call_end_exception, isasync in self._self_on_exception_async:
+                repl = on_call_end_exception(context, ex)
+                if isasync:
+                    repl = await repl
                 if isinstance(repl, Exception):
                     ex = repl
             if ex is orig_ex:
                 raise  # re-raise the original exception
             else:
                 raise ex  # raise the replacement exception
-        for handler in self._self_handlers:
-            result = handler.on_call_end_result(context, result)
+        if self._self_streams and not context.rewrap and _isstream(result):
+            result = _Stream(
+                result, context, self._self_on_yield, self._self_on_end_stream
+            )
+        for on_call_end_result, isasync in self._self_on_result_async:
+            result = on_call_end_result(context, result)
+            if isasync:
+                result = await result
 
         if context.rewrap:
-            # FIXME: derived types cannot have additional arguments
-            result = type(self)(result, self._self_handlers)
+            result = self._self_wrap(result)
         return result
 
+    def _self_wrap(self, entity: Any) -> Any:
+        """
+        Make a child interposer that shares our handlers and policy.
+        """
+        # FIXME: derived types cannot have additional arguments
+        if self._self_policy is None:
+            return type(self)(entity, self._self_handlers)
+        return type(self)(entity, self._self_handlers, policy=self._self_policy)
+
     def __getattr__(self, name: str) -> Any:
         """
         Handle duck typing for the wrapped entity.
@@ -235,14 +544,229 @@ class Interposer(CallableObjectProxy):
         the python distribution (that is an assumption) then wrap it, because
         we want to wrap until we get to a __call__.  This allows top level
         objects that construct helpers as attributes (@property) to be
-        captured properly.
+        captured properly.  A policy can keep the attribute raw.
         """
         attr = super().__getattr__(name)
-        wrap = inspect.isbuiltin(attr) or inspect.getmodule(attr)
-        if wrap:
-            # FIXME: derived types cannot have additional arguments
-            attr = type(self)(attr, self._self_handlers)
-        return attr
+
+        cached = self._self_attrs.get(name)
+        if isinstance(cached, tuple):
+            if _unchanged(cached[0], attr):
+                return attr if cached[1] is None else cached[1]
+        elif cached is not None:
+            child = cached()
+            if child is not None and _unchanged(child.__wrapped__, attr):
+                return child
+
+        child = None
+        if inspect.isbuiltin(attr) or inspect.getmodule(attr):
+            policy = self._self_policy
+            if policy is None or policy.wraps(attr):
+                child = self._self_wrap(attr)
+        if _held(attr, self.__wrapped__, name):
+            self._self_attrs[name] = (attr, child)
+        elif child is not None:
+            self._self_attrs[name] = weakref.ref(child)
+        else:
+            self._self_attrs.pop(name, None)
+        return attr if child is None else child
+
+
+class _Stream(ObjectProxy):
+    """
+    Wraps an iterator result, invoking the on_call_yield hooks for each
+    item and the on_call_end_stream hooks when it is exhausted or raises.
+
+    Items passed in through a generator's send() or throw() are not seen
+    by the hooks.
+    """
+
+    def __init__(
+        self,
+        iterator: Any,
+        context: CallContext,
+        on_yield: Tuple[Callable, ...],
+        on_end: Tuple[Callable, ...],
+    ) -> None:
+        super().__init__(iterator)
+        self._self_context = context
+        self._self_on_yield = on_yield
+        self._self_on_end = on_end
+        self._self_ended = False
+
+    def __iter__(self) -> Any:
+        return self
+
+    def __next__(self) -> Any:
+        context = self._self_context
+        try:
+            item = next(self.__wrapped__)
+        except StopIteration:
+            if not self._self_ended:
+                self._self_ended = True
+                for on_call_end_stream in self._self_on_end:
+                    on_call_end_stream(context, None)
+            raise
+        except Exception as ex:
+            if self._self_ended:
+                raise
+            self._self_ended = True
+            orig_ex = ex
+            for on_call_end_stream in self._self_on_end:
+                repl = on_call_end_stream(context, ex)
+                if isinstance(repl, Exception):
+                    ex = repl
+            if ex is orig_ex:
+                raise  # re-raise the original exception
+            else:
+                raise ex  # raise the replacement exception
+        for on_call_yield in self._self_on_yield:
+            item = on_call_yield(context, item)
+        return item
+
+
+def _isstream(result: Any) -> bool:
+    """
+    Determines if a call result should be streamed.
+
+    Only generators are streamed; other iterators, such as file objects or
+    instances of classes that are their own iterator, are more than their
+    items and are left alone.
+    """
+    return inspect.isgenerator(result)
+
+
+def overrides(handler: CallHandler, name: str) -> bool:
+    """
+    Determines if a handler does something other than the do-nothing
+    implementation of the named hook in CallHandler.
+    """
+    return getattr(type(handler), name, None) is not getattr(
+        CallHandler, name
+    ) or name in getattr(handler, "__dict__", ())
+
+
+class _Plan(object):
+    """
+    The hooks overridden by the handlers in a list of handlers, as of when
+    the plan was made, shared by every interposer using the list.
+    """
+
+    __slots__ = (
+        "handlers",
+        "snapshot",
+        "on_begin",
+        "on_exception",
+        "on_result",
+        "on_yield",
+        "on_end_stream",
+        "on_begin_async",
+        "on_exception_async",
+        "on_result_async",
+        "__weakref__",
+    )
+
+    def __init__(self, handlers: List[CallHandler]) -> None:
+        # holding the list keeps its id from being reused while planned
+        self.handlers = handlers
+        self.snapshot = list(handlers)
+        self.on_begin = _hooks(handlers, "on_call_begin")
+        self.on_exception = _hooks(handlers, "on_call_end_exception")
+        self.on_result = _hooks(handlers, "on_call_end_result")
+        self.on_yield = _hooks(handlers, "on_call_yield")
+        self.on_end_stream = _hooks(handlers, "on_call_end_stream")
+        self.on_begin_async = _async_hooks(handlers, "on_call_begin")
+        self.on_exception_async = _async_hooks(handlers, "on_call_end_exception")
+        self.on_result_async = _async_hooks(handlers, "on_call_end_result")
+
+
+# the plan of each list of handlers in use, by the id of the list
+_plans: "weakref.WeakValueDictionary[int, _Plan]" = weakref.WeakValueDictionary()
+
+
+def _hooks(handlers: List[CallHandler], name: str) -> Tuple[Callable, ...]:
+    """
+    Collects the named hook from each handler that overrides it.
+
+    Handlers that inherit the do-nothing implementation from CallHandler
+    are left out so calls do not pay for hooks that are not used.
+    """
+    return tuple(
+        getattr(handler, name) for handler in handlers if overrides(handler, name)
+    )
+
+
+def _async_hooks(
+    handlers: List[CallHandler], name: str
+) -> Tuple[Tuple[Callable, bool], ...]:
+    """
+    Collects the named hook for coroutine calls from each handler that
+    overrides it, along with whether the hook itself must be awaited.
+
+    The async variant of a hook is used if it is overridden, otherwise
+    the synchronous hook is called directly.
+    """
+    hooks = []
+    for handler in handlers:
+        if overrides(handler, name + "_async"):
+            hooks.append((getattr(handler, name + "_async"), True))
+        elif overrides(handler, name):
+            hooks.append((getattr(handler, name), False))
+    return tuple(hooks)
+
+
+def _held(attr: Any, owner: Any, name: str) -> bool:
+    """
+    Determines if an attribute is kept alive anyway, by the wrapped entity
+    or by a module, so the attribute cache can hold it without keeping
+    anything alive longer.
+
+    That includes a value stored on the wrapped entity itself, and, when
+    interposers are stacked, a child interposer that the wrapped interposer
+    holds in its own cache.
+    """
+    if isinstance(owner, Interposer):
+        cached = owner._self_attrs.get(name)
+        if isinstance(cached, tuple) and cached[1] is attr:
+            return True
+    kind = type(attr)
+    if kind is MethodType or kind is BuiltinMethodType:
+        attr = attr.__self__
+    elif getattr(owner, "__dict__", {}).get(name) is attr:
+        return True
+    return (
+        attr is owner
+        or attr is None
+        or inspect.ismodule(attr)
+        or inspect.isclass(attr)
+        or inspect.isfunction(attr)
+    )
+
+
+def _unchanged(previous: Any, current: Any) -> bool:
+    """
+    Determines if an attribute is the same one seen on a previous lookup.
+
+    Bound methods are created anew on every lookup, so they are considered
+    the same when they bind the same function to the same object.  The
+    bound object is compared by identity, which method equality only does
+    itself since Python 3.8.
+    """
+    if previous is current:
+        return True
+    kind = type(current)
+    if type(previous) is not kind:
+        return False
+    if kind is MethodType:
+        return (
+            previous.__self__ is current.__self__
+            and previous.__func__ is current.__func__
+        )
+    if kind is BuiltinMethodType:
+        return (
+            previous.__self__ is current.__self__
+            and previous.__name__ == current.__name__
+        )
+    return False
 
 
 def isinterposed(entity: Any) -> bool:
@@ -250,3 +774,10 @@ def isinterposed(entity: Any) -> bool:
     Checks to see if something is being interposed.
     """
     return type(entity) == Interposer
+
+
+def isstreaming(entity: Any) -> bool:
+    """
+    Checks to see if a call result is being streamed to call handlers.
+    """
+    return type(entity) is _Stream
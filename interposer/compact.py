@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+"""
+Compacts recordings in place: each is rewritten into a new segment file that
+holds only the records in use, dropping superseded records, content no
+longer referred to, and the space a shelf never reclaimed.  Recordings are
+also migrated to the current file format.
+
+Recordings used only for playback (such as those committed for a release)
+can also be stripped of the recorded contexts of calls, which are only used
+to explain a RecordedCallNotFoundError and to dump a recording.
+
+Each path is a recording or a directory that is searched for recordings,
+as for interposer.migrate.  Recordings are compacted in parallel processes.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from interposer.migrate import rewrite_in_place
+from interposer.migrate import run_all
+from interposer.storage import Compression
+from interposer.storage import SegmentStorage
+from interposer.tapedeck import Mode
+from interposer.tapedeck import TapeDeck
+
+
+def compact(
+    path: Path, forensics: bool = True, compression: Optional[Compression] = None
+) -> Tuple[int, int]:
+    """
+    Compact a recording in place.
+
+    A segment file keeps its compression unless another is given.
+
+    Args:
+        path (Path): the recording, gzipped if it ends in ".gz"
+        forensics (bool): False to strip the recorded contexts of calls
+        compression (Compression): how to compress the compacted recording
+
+    Returns:
+        The size of the recording before and after.
+    """
+    before = path.stat().st_size
+
+    def rewrite(source: Path, target: Path) -> bool:
+        with TapeDeck(source, Mode.Playback) as deck:
+            deck.migrate(target, compression or deck.file_compression, forensics)
+        return True
+
+    rewrite_in_place(path, rewrite)
+    return before, path.stat().st_size
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m interposer.compact", description=__doc__
+    )
+    parser.add_argument("paths", nargs="+", type=Path, metavar="PATH")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="the number of recordings to compact at once",
+    )
+    parser.add_argument(
+        "--strip-forensics",
+        action="store_true",
+        help="leave out the recorded contexts of calls",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=sorted(SegmentStorage.CODECS),
+        help="compress the records of the compacted recordings",
+    )
+    args = parser.parse_args(argv)
+    compression = Compression(args.compression) if args.compression else None
+
+    failed = False
+    saved = 0
+    for path, sizes, ex in run_all(
+        args.paths, args.jobs, compact, not args.strip_forensics, compression
+    ):
+        if ex is not None:
+            failed = True
+            print(f"{path}: {type(ex).__name__}: {ex}", file=sys.stderr)
+        else:
+            before, after = sizes
+            saved += before - after
+            print(f"{path}: {before} -> {after} bytes, saved {before - after}")
+    print(f"saved {saved} bytes")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+"""
+Compares two recordings of the same calls, such as those made before and
+after upgrading the library they call, channel by channel and ordinal by
+ordinal, and reports the calls added, removed, and changed.
+
+Calls are compared by their hash and the digests of what was recorded for
+them, using the index of each recording, so only the calls that differ are
+loaded.  Each changed call is shown as a unified diff of its dump (see
+TapeDeck.dump).  Recordings that end in ".gz" are decompressed to a
+temporary file first.  The exit status is 0 if the recordings are the same,
+1 if they differ, and 2 if there was trouble, as for diff(1).
+"""
+import argparse
+import difflib
+import sys
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+from dataclasses import field
+from enum import auto
+from enum import Enum
+from pathlib import Path
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import yaml
+
+from interposer.storage import gunzip_file
+from interposer.tapedeck import Dumper
+from interposer.tapedeck import IndexEntry
+from interposer.tapedeck import Mode
+from interposer.tapedeck import TapeDeck
+
+
+class Change(Enum):
+    """
+    How a call differs between two recordings.
+    """
+
+    Added = auto()
+    Removed = auto()
+    Changed = auto()
+
+
+@dataclass
+class Difference:
+    """
+    A call that differs between two recordings.
+    """
+
+    channel: str
+    ordinal: int
+    change: Change
+    # the unified diff of the dump of a changed call
+    lines: List[str] = field(default_factory=list)
+
+
+def diff(
+    old: TapeDeck,
+    new: TapeDeck,
+    channels: Optional[Iterable[str]] = None,
+    labels: Optional[Tuple[str, str]] = None,
+) -> Iterator[Difference]:
+    """
+    Compare two open recordings.
+
+    Args:
+        old (TapeDeck): the recording to compare against
+        new (TapeDeck): the recording to compare
+        channels (list): the channels to compare; all of them by default
+        labels (tuple): how to name the old and new recordings in the
+                        unified diffs; the paths of their files by default
+
+    Yields:
+        Each call that differs, in ordinal order within each channel.
+    """
+    wanted = None if channels is None else set(channels)
+    if labels is None:
+        labels = (str(old.deck), str(new.deck))
+    for channel in sorted(set(old.channels()) | set(new.channels())):
+        if wanted is not None and channel not in wanted:
+            continue
+        before = {call.ordinal: call for call in old.calls(channel)}
+        after = {call.ordinal: call for call in new.calls(channel)}
+        for ordinal in sorted(before.keys() | after.keys()):
+            was = before.get(ordinal)
+            now = after.get(ordinal)
+            if now is None:
+                yield Difference(channel, ordinal, Change.Removed)
+            elif was is None:
+                yield Difference(channel, ordinal, Change.Added)
+            else:
+                lines = _compare(old, new, channel, was, now, labels)
+                if lines:
+                    yield Difference(channel, ordinal, Change.Changed, lines)
+
+
+def _compare(
+    old: TapeDeck,
+    new: TapeDeck,
+    channel: str,
+    was: IndexEntry,
+    now: IndexEntry,
+    labels: Tuple[str, str],
+) -> List[str]:
+    """
+    Returns the unified diff of the dumps of a call in two recordings, or
+    nothing if the call is the same in both.
+    """
+    if was.hash == now.hash:
+        fingerprint = old.fingerprint(was)
+        if fingerprint is not None and fingerprint == new.fingerprint(now):
+            return []  # the same call got the same outcome
+
+    dumper = getattr(yaml, "CDumper", Dumper)
+    before = yaml.dump(old.dump_call(channel, was), Dumper=dumper)
+    after = yaml.dump(new.dump_call(channel, now), Dumper=dumper)
+    return list(
+        difflib.unified_diff(
+            before.splitlines(),
+            after.splitlines(),
+            f"{labels[0]} {channel} {was.ordinal}",
+            f"{labels[1]} {channel} {now.ordinal}",
+            lineterm="",
+        )
+    )
+
+
+@contextmanager
+def playback(path: Path) -> Iterator[TapeDeck]:
+    """
+    Open a recording, gzipped if it ends in ".gz", for playback.
+    """
+    if path.suffix != ".gz":
+        with TapeDeck(path, Mode.Playback) as deck:
+            yield deck
+        return
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        plain = Path(tempdir) / path.stem
+        gunzip_file(path, plain)
+        with TapeDeck(plain, Mode.Playback) as deck:
+            yield deck
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m interposer.diff", description=__doc__
+    )
+    parser.add_argument("old", type=Path, help="the recording to compare against")
+    parser.add_argument("new", type=Path, help="the recording to compare")
+    parser.add_argument(
+        "--channel",
+        action="append",
+        dest="channels",
+        metavar="NAME",
+        help="compare only this channel; may be given more than once",
+    )
+    parser.add_argument(
+        "--brief",
+        action="store_true",
+        help="list the calls that differ without showing how",
+    )
+    args = parser.parse_args(argv)
+
+    counts = {change: 0 for change in Change}
+    try:
+        with playback(args.old) as old, playback(args.new) as new:
+            labels = (str(args.old), str(args.new))
+            for difference in diff(old, new, args.channels, labels):
+                counts[difference.change] += 1
+                change = difference.change.name.lower()
+                print(f"{change}: {difference.channel} {difference.ordinal}")
+                if not args.brief:
+                    for line in difference.lines:
+                        print(line)
+    except Exception as ex:
+        print(f"{type(ex).__name__}: {ex}", file=sys.stderr)
+        return 2
+
+    print(
+        ", ".join(f"{count} {change.name.lower()}" for change, count in counts.items())
+    )
+    return 1 if any(counts.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
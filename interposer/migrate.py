@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+"""
+Migrates recordings to the current tape deck file format in place, so they
+keep playing back after support for older file formats is dropped, without
+recording them again.
+
+Each path is a recording or a directory that is searched for recordings:
+gzipped recordings (*.db.gz) kept by RecordedTestCase, compressed tapes
+(*.tape), and other recordings (*.db) that are not the decompressed copy
+of a gzipped recording.  Recordings are migrated in parallel processes.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from interposer.storage import Compression
+from interposer.storage import gunzip_file
+from interposer.storage import gzip_file
+from interposer.storage import SegmentStorage
+from interposer.tapedeck import Mode
+from interposer.tapedeck import TapeDeck
+
+
+def recordings(paths: Iterable[Path]) -> List[Path]:
+    """
+    Returns the recordings at or under the paths.
+    """
+    found = []
+    for path in paths:
+        if not path.is_dir():
+            found.append(path)
+            continue
+        for candidate in sorted(path.rglob("*")):
+            if candidate.name.endswith((".db.gz", ".tape")) or (
+                candidate.suffix == ".db" and not Path(f"{candidate}.gz").exists()
+            ):
+                found.append(candidate)
+    return found
+
+
+def migrate(path: Path, compression: Optional[Compression] = None) -> int:
+    """
+    Migrate a recording to the current file format in place.
+
+    A recording already in the current file format is left alone unless
+    a compression is given.  A segment file keeps its compression unless
+    another is given.
+
+    Args:
+        path (Path): the recording, gzipped if it ends in ".gz"
+        compression (Compression): how to compress the migrated recording
+
+    Returns:
+        The file format of the recording before it was migrated.
+
+    Raises:
+        RecordingTooOldError if the recording is too old to play back.
+    """
+    file_format = 0
+
+    def rewrite(source: Path, target: Path) -> bool:
+        nonlocal file_format
+        with TapeDeck(source, Mode.Playback) as deck:
+            file_format = deck.file_format
+            if compression is None and file_format == TapeDeck.CURRENT_FILE_FORMAT:
+                return False
+            deck.migrate(target, compression or deck.file_compression)
+        return True
+
+    rewrite_in_place(path, rewrite)
+    return file_format
+
+
+def rewrite_in_place(path: Path, rewrite: Callable[[Path, Path], bool]) -> None:
+    """
+    Rewrite a recording, gzipped if it ends in ".gz", in place.
+
+    The rewrite is given the recording (decompressed) and where to write
+    the new recording, and returns False if there was nothing to do.  The
+    new recording is written alongside the original one and replaces it
+    once complete.
+    """
+    rewritten = Path(f"{path}.rewritten")
+    if path.suffix != ".gz":
+        try:
+            if rewrite(path, rewritten):
+                os.replace(rewritten, path)
+        finally:
+            if rewritten.exists():
+                rewritten.unlink()
+        return
+
+    plain = Path(f"{path}.plain")
+    packed = Path(f"{path}.packed")
+    try:
+        gunzip_file(path, plain)
+        if rewrite(plain, rewritten):
+            gzip_file(rewritten, packed)
+            os.replace(packed, path)
+    finally:
+        for temporary in (plain, rewritten, packed):
+            if temporary.exists():
+                temporary.unlink()
+
+
+def run_all(
+    paths: Iterable[Path], jobs: Optional[int], function: Callable, *args: Any
+) -> Iterator[Tuple[Path, Any, Optional[Exception]]]:
+    """
+    Call the function for each recording at or under the paths, followed by
+    the arguments, in parallel processes.
+
+    Yields:
+        Each recording, with what the function returned or the exception
+        it raised, as they finish.
+    """
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(function, path, *args): path for path in recordings(paths)
+        }
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as ex:
+                yield futures[future], None, ex
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m interposer.migrate", description=__doc__
+    )
+    parser.add_argument("paths", nargs="+", type=Path, metavar="PATH")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="the number of recordings to migrate at once",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=sorted(SegmentStorage.CODECS),
+        help="compress the records of the migrated recordings",
+    )
+    args = parser.parse_args(argv)
+    compression = Compression(args.compression) if args.compression else None
+
+    failed = False
+    for path, file_format, ex in run_all(args.paths, args.jobs, migrate, compression):
+        if ex is not None:
+            failed = True
+            print(f"{path}: {type(ex).__name__}: {ex}", file=sys.stderr)
+        else:
+            print(
+                f"{path}: file format {file_format} -> {TapeDeck.CURRENT_FILE_FORMAT}"
+            )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import inspect
+import re
+from fnmatch import translate
+from typing import Any
+from typing import Callable
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+Rule = Union[str, type, Callable[[Any], bool]]
+
+
+class WrapPolicy(object):
+    """
+    Decides which entities an interposer tree wraps and which calls the
+    call handlers see.
+
+    Without a policy, an interposer wraps every attribute that comes from
+    outside the python distribution, so every helper, property value, and
+    method of a large client library becomes a proxy.  A policy limits the
+    interposing to what matters (typically the few methods that make
+    network calls) and everything else is returned raw and runs at native
+    speed.
+
+    Each rule can be:
+
+    - a glob (str) matched against the qualified name of the entity, which
+      is "module.qualname", for example "botocore.client.*.list_*"; the
+      qualified name of an object is that of its class
+    - a type, matching instances of that type
+    - a predicate, a callable given the entity that returns True to match
+
+    An entity that matches an exclude rule is never wrapped.  When there
+    are include rules, only functions and methods that match one are
+    wrapped; modules, classes, and objects that do not match are still
+    wrapped so their members can be reached, but calls on them (such as
+    instantiating a class) are not seen by the call handlers.
+
+    The rules are compiled once, and interposers only consult the policy
+    the first time they see an attribute.
+    """
+
+    def __init__(
+        self,
+        include: Optional[Iterable[Rule]] = None,
+        exclude: Optional[Iterable[Rule]] = None,
+    ) -> None:
+        """
+        Args:
+            include (list): rules for what call handlers see; everything
+                            if not specified
+            exclude (list): rules for what is never wrapped
+        """
+        self._include = _compile(include) if include is not None else None
+        self._exclude = _compile(exclude or ())
+
+    def interposes(self, entity: Any) -> bool:
+        """
+        Returns True if calls on the entity are seen by the call handlers.
+        """
+        name = qualified_name(entity)
+        if self._exclude(name, entity):
+            return False
+        return self._include is None or self._include(name, entity)
+
+    def wraps(self, entity: Any) -> bool:
+        """
+        Returns True if the entity should be wrapped by an interposer.
+        """
+        name = qualified_name(entity)
+        if self._exclude(name, entity):
+            return False
+        return (
+            self._include is None
+            or not inspect.isroutine(entity)
+            or self._include(name, entity)
+        )
+
+
+def qualified_name(entity: Any) -> str:
+    """
+    The name policy globs are matched against: "module.qualname".
+    """
+    if inspect.ismodule(entity):
+        return entity.__name__
+    if not (inspect.isroutine(entity) or inspect.isclass(entity)):
+        entity = type(entity)
+    qualname = str(
+        getattr(entity, "__qualname__", None) or getattr(entity, "__name__", "")
+    )
+    module = getattr(entity, "__module__", None)
+    return f"{module}.{qualname}" if module else qualname
+
+
+def _compile(rules: Iterable[Rule]) -> Callable[[str, Any], bool]:
+    """
+    Compiles rules into a single matcher that takes the qualified name
+    and the entity.  The globs are combined into one regular expression.
+    """
+    globs = []
+    types = []
+    predicates = []
+    for rule in rules:
+        if isinstance(rule, str):
+            globs.append(translate(rule))
+        elif isinstance(rule, type):
+            types.append(rule)
+        elif callable(rule):
+            predicates.append(rule)
+        else:
+            raise TypeError(
+                f"wrap policy rule {rule!r} is not a glob, type, or callable"
+            )
+
+    pattern = re.compile("|".join(globs)).match if globs else None
+    kinds: Tuple[type, ...] = tuple(types)
+    checks = tuple(predicates)
+
+    def matches(name: str, entity: Any) -> bool:
+        if pattern is not None and pattern(name):
+            return True
+        if kinds and isinstance(entity, kinds):
+            return True
+        return any(check(entity) for check in checks)
+
+    return matches
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import threading
+from time import perf_counter_ns
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from interposer import CallBypass
+from interposer import CallContext
+from interposer import CallHandler
+
+
+class LatencyHistogram(object):
+    """
+    A fixed-bucket log-linear histogram of latencies in nanoseconds.
+
+    Each power of two is split into SUB_BUCKETS linear buckets, so any
+    value is accurate to within 1/SUB_BUCKETS (about 6%) while the whole
+    range of a 64-bit nanosecond count fits in BUCKETS counters.  The
+    count, total, minimum, and maximum are exact.
+
+    The histogram does not lock; LatencyCallHandler serializes access.
+    """
+
+    SUB_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BITS
+    BUCKETS = 64 * SUB_BUCKETS
+
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def __repr__(self) -> str:
+        return f"LatencyHistogram({self.summary()})"
+
+    @classmethod
+    def index(cls, value: int) -> int:
+        """The bucket index for a value."""
+        exp = value.bit_length() - cls.SUB_BITS - 1
+        if exp <= 0:
+            return value
+        return exp * cls.SUB_BUCKETS + (value >> exp)
+
+    @classmethod
+    def upper(cls, index: int) -> int:
+        """The largest value that lands in a bucket."""
+        if index < 2 * cls.SUB_BUCKETS:
+            return index
+        exp = index // cls.SUB_BUCKETS - 1
+        return ((index - exp * cls.SUB_BUCKETS + 1) << exp) - 1
+
+    def record(self, value: int) -> None:
+        """Record a latency in nanoseconds."""
+        value = max(value, 0)
+        self.counts[self.index(value)] += 1
+        if not self.count or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.count += 1
+        self.total += value
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        """Add the content of another histogram to this one."""
+        if not other.count:
+            return
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.min = min(self.min, other.min) if self.count else other.min
+        self.max = max(self.max, other.max)
+        self.count += other.count
+        self.total += other.total
+
+    def percentile(self, percent: float) -> int:
+        """
+        The latency at or below which the given percent of the calls fall,
+        reported as the upper bound of its bucket (never more than max).
+        """
+        if not self.count:
+            return 0
+        rank = max(1, round(self.count * percent / 100.0))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.upper(index), self.max)
+        return self.max  # pragma: no cover
+
+    def summary(self) -> Dict[str, int]:
+        """The count and key latencies in nanoseconds."""
+        return {
+            "count": self.count,
+            "min": self.min,
+            "mean": self.total // self.count if self.count else 0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class LatencyCallHandler(CallHandler):
+    """
+    Measures the latency of each call from on_call_begin to its end, and
+    aggregates the latencies into a histogram for each called entity,
+    keyed by its qualified name.
+
+    Put this handler last to measure the call itself, or first to include
+    the time spent in the other handlers.  For coroutines the latency covers
+    the time to await the result; for iterator results it covers the time
+    to return the iterator, not to consume it.  The start of each call is
+    kept in the scratch storage of the context, so measuring a call does
+    not change how it is recorded.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def on_call_begin(self, context: CallContext) -> Optional[CallBypass]:
+        context.scratch[self] = perf_counter_ns()
+        return None
+
+    def on_call_end_exception(
+        self, context: CallContext, ex: Exception
+    ) -> Optional[Exception]:
+        self._measure(context, perf_counter_ns())
+        return None
+
+    def on_call_end_result(self, context: CallContext, result: Any) -> Any:
+        self._measure(context, perf_counter_ns())
+        return result
+
+    def reset(self) -> None:
+        """Discard all of the measurements."""
+        with self._lock:
+            self._histograms = {}
+
+    def snapshot(self, reset: bool = False) -> Dict[str, LatencyHistogram]:
+        """
+        Get the histograms, by qualified name of the called entity.
+
+        Arguments:
+            reset (bool): discard the measurements once they are taken
+        """
+        with self._lock:
+            histograms = self._histograms
+            if reset:
+                self._histograms = {}
+            else:
+                histograms = {
+                    name: self._copy(hist) for name, hist in histograms.items()
+                }
+        return histograms
+
+    def summary(self, reset: bool = False) -> Dict[str, Dict[str, int]]:
+        """
+        Get the count and key latencies in nanoseconds, by qualified name
+        of the called entity.
+        """
+        return {name: hist.summary() for name, hist in self.snapshot(reset).items()}
+
+    @staticmethod
+    def _copy(hist: LatencyHistogram) -> LatencyHistogram:
+        copy = LatencyHistogram()
+        copy.merge(hist)
+        return copy
+
+    def _measure(self, context: CallContext, end: int) -> None:
+        start = context.peek_scratch(self)
+        if start is None:
+            return  # the call began before this handler was watching
+        call = context.call
+        name = getattr(call, "__qualname__", None) or type(call).__qualname__
+        module = getattr(call, "__module__", None)
+        if module:
+            name = f"{module}.{name}"
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                hist = self._histograms[name] = LatencyHistogram()
+            hist.record(end - start)
@@ -3,7 +3,7 @@
 # Copyright (C) 2019 - 2020 Tuono, Inc.
 # Copyright (C) 2021 - 2022 CloudTruth, Inc.
 #
-import gzip
+import hashlib
 import inspect
 import os
 from contextlib import ExitStack
@@ -24,7 +24,14 @@ from interposer import CallBypass
 from interposer import CallContext
 from interposer import CallHandler
 from interposer import Interposer
+from interposer import isstreaming
+from interposer.policy import WrapPolicy
+from interposer.storage import CHUNK_SIZE
+from interposer.storage import Compression
+from interposer.storage import gunzip_file
+from interposer.storage import gzip_file
 from interposer.tapedeck import Mode
+from interposer.tapedeck import RecordedStream
 from interposer.tapedeck import TapeDeck
 
 
@@ -51,6 +58,13 @@ class RecordedTestCase(TestCase):
     # the name of the directory created alongside the test script
     TAPE_DIRECTORY_NAME: str = "tapes"
 
+    # record a tape with each record compressed (<class>.tape) that plays
+    # back directly, rather than gzip the whole recording (<class>.db.gz)
+    TAPE_COMPRESSION: ClassVar[Optional[Compression]] = None
+
+    # read the whole recording into memory for playback
+    TAPE_PRELOAD: ClassVar[bool] = False
+
     # the tape deck
     tapedeck: ClassVar[TapeDeck] = NotImplemented
 
@@ -61,7 +75,14 @@ class RecordedTestCase(TestCase):
 
         The location of the tape deck will depend on the location of the
         original test script.  A subdirectory named "tapes" is created and
-        one recording file per test class is created.
+        one recording file per test class is created.  A compressed tape
+        is played back in place, without decompressing it to disk.
+
+        A gzipped recording is decompressed to <class>.db and kept there
+        for later runs along with the checksum of the gzip file it came
+        from in <class>.db.sha256; it is decompressed again only when the
+        gzip file changes.  Recording removes a recording in the other
+        format, so switching TAPE_COMPRESSION never plays back a stale one.
         """
         super().setUpClass()
 
@@ -73,17 +94,30 @@ class RecordedTestCase(TestCase):
         recordings = Path(module.__file__).parent / cls.TAPE_DIRECTORY_NAME / testname
 
         recording = recordings / f"{cls.__name__}.db"
+        compressed = recordings / f"{cls.__name__}.tape"
         if mode == Mode.Playback:
-            # decompress the recording
-            with gzip.open(str(recording) + ".gz", "rb") as fin:
-                with recording.open("wb") as fout:
-                    fout.write(fin.read())
+            if compressed.exists():
+                # played back where it is
+                recording = compressed
+            else:
+                _decompress(Path(str(recording) + ".gz"), recording)
         else:
             recordings.mkdir(parents=True, exist_ok=True)
-            if recording.exists():
-                recording.unlink()
-
-        cls.tapedeck = TapeDeck(recording, mode)
+            # the recording in the other format would be played back instead
+            stales = [recording, _checksum_path(recording), compressed]
+            if cls.TAPE_COMPRESSION is not None:
+                stales.append(Path(str(recording) + ".gz"))
+                recording = compressed
+            for stale in stales:
+                if stale.exists():
+                    stale.unlink()
+
+        cls.tapedeck = TapeDeck(
+            recording,
+            mode,
+            compression=cls.TAPE_COMPRESSION,
+            preload=cls.TAPE_PRELOAD,
+        )
         cls.tapedeck.open()
 
     @classmethod
@@ -94,14 +128,15 @@ class RecordedTestCase(TestCase):
         mode = cls.tapedeck.mode
         recording = cls.tapedeck.deck
         cls.tapedeck.close()
-        if mode == Mode.Recording:
+        if recording.suffix != ".tape" and mode == Mode.Recording:
             # compress the recording
-            with recording.open("rb") as fin:
-                with gzip.open(str(recording) + ".gz", "wb") as fout:
-                    fout.write(fin.read())
+            gzip_file(recording, Path(str(recording) + ".gz"))
 
-        # recording is the uncompressed file - do not leave it around
-        recording.unlink()
+            # recording is the uncompressed file - do not leave it around
+            recording.unlink()
+            checksum = _checksum_path(recording)
+            if checksum.exists():
+                checksum.unlink()
 
         super().tearDownClass()
 
@@ -122,6 +157,38 @@ class RecordedTestCase(TestCase):
         return self.tapedeck.redact(secret, identifier)
 
 
+def _checksum_path(recording: Path) -> Path:
+    """
+    Where the checksum of the gzip file a recording came from is kept.
+    """
+    return Path(str(recording) + ".sha256")
+
+
+def _decompress(source: Path, recording: Path) -> None:
+    """
+    Decompresses a gzipped recording unless the recording was already
+    decompressed from the same gzip file.
+    """
+    digest = hashlib.sha256()
+    with source.open("rb") as fin:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    checksum = _checksum_path(recording)
+    if (
+        recording.exists()
+        and checksum.exists()
+        and checksum.read_text() == digest.hexdigest()
+    ):
+        return
+
+    if checksum.exists():
+        checksum.unlink()
+    partial = Path(str(recording) + ".partial")
+    gunzip_file(source, partial)
+    os.replace(partial, recording)
+    checksum.write_text(digest.hexdigest())
+
+
 class TapeDeckCallHandler(CallHandler):
     """
     A call handler that leverages the built-in tapedeck to record
@@ -144,7 +211,7 @@ class TapeDeckCallHandler(CallHandler):
     @staticmethod
     def isrecorded(context: CallContext) -> bool:
         """Determines if the call is or should be recorded."""
-        return context.meta.get("_handler", {}).get("record", True)
+        return context.peek("_handler", {}).get("record", True)
 
     @staticmethod
     def norecord(context: CallContext) -> None:
@@ -186,15 +253,39 @@ class TapeDeckCallHandler(CallHandler):
         as that instructs playback mode not to bypass the call.
         """
         if self.isrecorded(context):
-            self._self_deck.record(context, result, None, channel=self._self_channel)
+            if isstreaming(result):
+                # the items get recorded as the caller consumes them
+                self._self_deck.record(
+                    context, RecordedStream(), None, channel=self._self_channel
+                )
+            else:
+                self._self_deck.record(
+                    context, result, None, channel=self._self_channel
+                )
         return result
 
+    def on_call_yield(self, context: CallContext, item: Any) -> Any:
+        """
+        Record an item of an iterator result.
+        """
+        if self.isrecorded(context):
+            self._self_deck.record_item(context, item)
+        return item
+
+    def on_call_end_stream(self, context: CallContext, ex: Optional[Exception]) -> None:
+        """
+        Record the end of an iterator result.
+        """
+        if self.isrecorded(context):
+            self._self_deck.record_end(context, ex)
+
 
 def recorded(
     *,
     patches: Dict[str, Any],
     prehandlers: Union[CallHandler, List[CallHandler]] = list(),
     posthandlers: Union[CallHandler, List[CallHandler]] = list(),
+    policy: Optional[WrapPolicy] = None,
 ) -> Callable:
     """
     Closure to define a test method decorator that will record to a channel.
@@ -213,6 +304,7 @@ def recorded(
                             that gets added automatically
         posthandlers (list): call handlers to run after the tape deck handler
                              that gets added automatically
+        policy (WrapPolicy): limits what is wrapped and recorded
     """
 
     @wrapt.decorator
@@ -228,7 +320,7 @@ def recorded(
             for patched in list(patches.keys()):
                 patchee = patches[patched]
                 evil.enter_context(
-                    patch(patched, new=Interposer(patchee, call_handlers))
+                    patch(patched, new=Interposer(patchee, call_handlers, policy))
                 )
             return testmethod(*args, **kwargs)
 
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import re
+from typing import Dict
+from typing import Mapping
+from typing import Optional
+from typing import Pattern
+from typing import Union
+
+
+class Redactor(object):
+    """
+    Replaces every known secret in pickled bytes or in text in one pass.
+
+    The secrets are compiled into a single regular expression of escaped
+    literals, longest first so a secret that contains another is replaced
+    as a whole.  A single secret is replaced with a plain replace, which is
+    faster than any pattern.  A redactor is immutable; build a new one when
+    the secrets change.
+    """
+
+    def __init__(self, redactions: Mapping[Union[str, bytes], str]) -> None:
+        """
+        Args:
+            redactions (dict): each secret and the replacement for it
+        """
+        self._bytes: Dict[bytes, bytes] = {}
+        self._text: Dict[str, str] = {}
+        for secret, replacement in redactions.items():
+            if isinstance(secret, str):
+                self._bytes[secret.encode()] = replacement.encode()
+                self._text[secret] = replacement
+            else:
+                self._bytes[secret] = replacement.encode()
+                try:
+                    self._text[secret.decode()] = replacement
+                except UnicodeDecodeError:
+                    pass  # cannot appear in text
+        self._bytes_pattern: Optional[Pattern[bytes]] = _compile(list(self._bytes))
+        self._text_pattern: Optional[Pattern[str]] = _compile(list(self._text))
+
+    def __len__(self) -> int:
+        return len(self._bytes)
+
+    def redact_bytes(self, raw: bytes) -> bytes:
+        """
+        Returns the bytes with each secret replaced.
+        """
+        if self._bytes_pattern is None:
+            return raw
+        if len(self._bytes) == 1:
+            ((secret, replacement),) = self._bytes.items()
+            return raw.replace(secret, replacement)
+        table = self._bytes
+        return self._bytes_pattern.sub(lambda match: table[match.group(0)], raw)
+
+    def redact_text(self, text: str) -> str:
+        """
+        Returns the text with each secret replaced.
+        """
+        if self._text_pattern is None:
+            return text
+        if len(self._text) == 1:
+            ((secret, replacement),) = self._text.items()
+            return text.replace(secret, replacement)
+        table = self._text
+        return self._text_pattern.sub(lambda match: table[match.group(0)], text)
+
+
+def _compile(secrets: list) -> Optional[Pattern]:
+    """
+    Compiles literal secrets into one pattern, or None if there are none.
+    """
+    if not secrets:
+        return None
+    secrets.sort(key=len, reverse=True)
+    separator = b"|" if isinstance(secrets[0], bytes) else "|"
+    return re.compile(separator.join(re.escape(secret) for secret in secrets))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import itertools
+import random
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from interposer import CallBypass
+from interposer import CallContext
+from interposer import CallHandler
+from interposer import overrides
+
+
+class Sampler(object):
+    """
+    Decides which calls get sampled.
+
+    The decision is made from the call alone; the storage of the context
+    is not touched.
+    """
+
+    def sample(self, context: CallContext) -> bool:
+        """
+        Returns True if the call should be sampled.
+        """
+        raise NotImplementedError()
+
+
+class EveryNthSampler(Sampler):
+    """
+    Samples one in every N calls, starting with the first.
+    """
+
+    def __init__(self, n: int) -> None:
+        if n < 1:
+            raise ValueError("n must be at least 1")
+        self.n = n
+        self._counter = itertools.count()
+
+    def sample(self, context: CallContext) -> bool:
+        return next(self._counter) % self.n == 0
+
+
+class ProbabilitySampler(Sampler):
+    """
+    Samples each call with the given probability.
+    """
+
+    def __init__(self, probability: float) -> None:
+        if not 0.0 <= probability <= 1.0:
+            raise ValueError("probability must be between 0 and 1")
+        self.probability = probability
+        self._random = random.random
+
+    def sample(self, context: CallContext) -> bool:
+        return self._random() < self.probability  # nosec
+
+
+class TokenBucketSampler(Sampler):
+    """
+    Samples calls up to a rate per call signature (the module and qualified
+    name of the called entity), allowing bursts of up to burst calls.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+        self.rate = rate
+        self.burst = burst
+        # call signature and (tokens, time of last refill)
+        self._buckets: Dict[Tuple[Optional[str], str], Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def sample(self, context: CallContext) -> bool:
+        call = context.call
+        signature = (
+            getattr(call, "__module__", None),
+            getattr(call, "__qualname__", None) or type(call).__qualname__,
+        )
+        now = time.monotonic()
+        with self._lock:
+            tokens, then = self._buckets.get(signature, (float(self.burst), now))
+            tokens = min(float(self.burst), tokens + (now - then) * self.rate)
+            sampled = tokens >= 1.0
+            self._buckets[signature] = (tokens - 1.0 if sampled else tokens, now)
+        return sampled
+
+
+class SamplingCallHandler(CallHandler):
+    """
+    Forwards a sample of the calls to another call handler.
+
+    This keeps the cost of an expensive handler, such as one that audits
+    calls, bounded in hot code paths.  The sampler decides at the beginning
+    of each call; calls that are not sampled do not touch the storage of
+    the context and never reach the other handler.  Sampled calls are
+    marked in the scratch storage of the context, so sampling does not
+    change how the call is recorded.
+
+    Only the hooks the other handler implements are implemented here, so
+    for example iterator results are only streamed if the other handler
+    wants the items.
+    """
+
+    HOOKS: List[str] = [
+        "on_call_end_exception",
+        "on_call_end_result",
+        "on_call_yield",
+        "on_call_end_stream",
+        "on_call_begin_async",
+        "on_call_end_exception_async",
+        "on_call_end_result_async",
+    ]
+
+    def __init__(self, handler: CallHandler, sampler: Sampler) -> None:
+        """
+        Initializer.
+
+        Arguments:
+            handler (CallHandler): the handler that receives sampled calls
+            sampler (Sampler): decides which calls are sampled
+        """
+        super().__init__()
+        self.handler = handler
+        self.sampler = sampler
+        for name in self.HOOKS:
+            if overrides(handler, name):
+                setattr(self, name, getattr(self, f"_sampled_{name}"))
+
+    def on_call_begin(self, context: CallContext) -> Optional[CallBypass]:
+        if not self.sampler.sample(context):
+            return None
+        context.scratch[self] = True
+        return self.handler.on_call_begin(context)
+
+    def _sampled_on_call_end_exception(
+        self, context: CallContext, ex: Exception
+    ) -> Optional[Exception]:
+        if context.peek_scratch(self):
+            return self.handler.on_call_end_exception(context, ex)
+        return None
+
+    def _sampled_on_call_end_result(self, context: CallContext, result: Any) -> Any:
+        if context.peek_scratch(self):
+            return self.handler.on_call_end_result(context, result)
+        return result
+
+    def _sampled_on_call_yield(self, context: CallContext, item: Any) -> Any:
+        if context.peek_scratch(self):
+            return self.handler.on_call_yield(context, item)
+        return item
+
+    def _sampled_on_call_end_stream(
+        self, context: CallContext, ex: Optional[Exception]
+    ) -> Optional[Exception]:
+        if context.peek_scratch(self):
+            return self.handler.on_call_end_stream(context, ex)
+        return None
+
+    async def _sampled_on_call_begin_async(
+        self, context: CallContext
+    ) -> Optional[CallBypass]:
+        if not self.sampler.sample(context):
+            return None
+        context.scratch[self] = True
+        return await self.handler.on_call_begin_async(context)
+
+    async def _sampled_on_call_end_exception_async(
+        self, context: CallContext, ex: Exception
+    ) -> Optional[Exception]:
+        if context.peek_scratch(self):
+            return await self.handler.on_call_end_exception_async(context, ex)
+        return None
+
+    async def _sampled_on_call_end_result_async(
+        self, context: CallContext, result: Any
+    ) -> Any:
+        if context.peek_scratch(self):
+            return await self.handler.on_call_end_result_async(context, result)
+        return result
@@ -0,0 +1,687 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import gzip
+import lzma
+import mmap
+import pickle  # nosec
+import queue
+import shelve  # nosec
+import shutil
+import struct
+import threading
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+from typing import BinaryIO
+from typing import cast
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Type
+
+# the size of the chunks used to copy recordings in and out of gzip
+CHUNK_SIZE = 1 << 20
+
+
+class Storage(object):
+    """
+    Where a tape deck keeps its recording: a mapping of string keys to
+    objects that are pickled on the way in and unpickled on the way out.
+
+    Storage does not need to be thread-safe; the tape deck serializes
+    access to it.
+    """
+
+    def __init__(self, path: Path, writable: bool, protocol: int) -> None:
+        """
+        Open the storage.
+
+        Args:
+            path (Path): the recording file
+            writable (bool): True to record, False to play back
+            protocol (int): the pickle protocol for stored objects
+        """
+        self.path = path
+        self.writable = writable
+        self.protocol = protocol
+
+    @property
+    def compression(self) -> Optional["Compression"]:
+        """
+        The compression of the records, or None if they are not compressed.
+        """
+        return None
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self.get_raw(key) is not None
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key, NotImplemented)
+        if value is NotImplemented:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.set_raw(key, pickle.dumps(value, protocol=self.protocol))
+
+    def set_raw(self, key: str, raw: bytes) -> None:
+        """
+        Store an object that is already pickled, with the storage protocol
+        or a lower one, under the key.
+        """
+        raise NotImplementedError()
+
+    def set_buffer(self, key: str, data: Any) -> None:
+        """
+        Store binary data, anything supporting the buffer protocol, under
+        the key.  It is read back with get_buffer instead of unpickled.
+        """
+        self.set_raw(key, bytes(data))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        Returns the object stored under the key, or the default.
+        """
+        raw = self.get_raw(key)
+        return default if raw is None else pickle.loads(raw)  # nosec
+
+    def get_raw(self, key: str) -> Optional[bytes]:
+        """
+        Returns the pickled object stored under the key, or None.
+        """
+        raise NotImplementedError()
+
+    def get_buffer(self, key: str) -> Optional[memoryview]:
+        """
+        Returns a read-only view of the binary data stored under the key,
+        or None.
+        """
+        raw = self.get_raw(key)
+        return None if raw is None else memoryview(raw)
+
+    def keys(self) -> Iterable[str]:
+        """
+        Returns the keys stored.
+        """
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        """
+        Finish writing, if writable, and release the file.
+        """
+        raise NotImplementedError()
+
+
+class ShelveStorage(Storage):
+    """
+    Storage in a shelf over whatever dbm flavor the platform provides.
+
+    This is how recordings were stored before SegmentStorage; it is used
+    to play back older recordings.  Note some dbm flavors store a recording
+    in more than one file.
+    """
+
+    def __init__(self, path: Path, writable: bool, protocol: int) -> None:
+        super().__init__(path, writable, protocol)
+        self._shelf: shelve.Shelf[Any] = shelve.open(  # nosec
+            str(path), flag="c" if writable else "r", protocol=protocol
+        )
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._shelf[key] = value
+
+    def set_raw(self, key: str, raw: bytes) -> None:
+        # a shelf stores the pickle as the value in the underlying dbm
+        self._shelf.dict[key.encode(self._shelf.keyencoding)] = raw  # type: ignore
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and key in self._shelf
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._shelf.get(key, default)
+
+    def get_raw(self, key: str) -> Optional[bytes]:
+        return self._shelf.dict.get(key.encode(self._shelf.keyencoding))  # type: ignore
+
+    def keys(self) -> Iterable[str]:
+        return list(self._shelf.keys())
+
+    def close(self) -> None:
+        self._shelf.close()
+
+
+@dataclass
+class Compression:
+    """
+    Settings for compressing each record of a segment file.
+
+    Attributes:
+        codec (str): "zlib" or "lzma"
+        level (int): the compression level (zlib) or preset (lzma);
+                     None for the codec default
+    """
+
+    codec: str = "zlib"
+    level: Optional[int] = None
+
+
+class SegmentStorage(Storage):
+    """
+    Storage in a single append-only segment file.
+
+    Each record is appended as the lengths of the key and the value followed
+    by the key and the pickled value.  Storing a key again appends a new
+    record that supersedes the previous one.  The index of each key to the
+    location of its latest value is kept in memory and written as a footer
+    when the storage is closed, followed by a trailer holding the location
+    of the footer and the magic number:
+
+        MAGIC | records... | footer (pickled index) | footer offset | MAGIC
+
+    For playback the file is mapped into memory, so opening a recording
+    costs a read of the index, and a lookup is an index hit and a slice.
+
+    With compression, each value is compressed on its own, so playback
+    still only touches the records it needs and the file can be committed
+    and played back as it is.  A compressed file has a different magic
+    number followed by a byte identifying the codec:
+
+        MAGIC_COMPRESSED | codec | records... | footer | offset | MAGIC_COMPRESSED
+
+    Binary data stored with set_buffer is not compressed, and its record is
+    placed so the data starts on an ALIGNMENT boundary of the file (with
+    a record with an empty key as padding before it if necessary).  On
+    playback get_buffer returns a view straight into the mapped file.
+
+    Recording to an existing segment file appends to it, using the
+    compression of the file.  If the file was never closed (so there is no
+    footer), the index is rebuilt by scanning the records.
+    """
+
+    MAGIC = b"\x89TAPE\r\n\x1a"
+    MAGIC_COMPRESSED = b"\x89TAPZ\r\n\x1a"
+    CODECS = {"zlib": 1, "lzma": 2}
+    RECORD = struct.Struct("<II")  # key length, value length
+    BUFFER = 1 << 31  # set in the key length of a record made by set_buffer
+    TRAILER = struct.Struct("<Q8s")  # footer offset, magic
+    ALIGNMENT = 64
+
+    def __init__(
+        self,
+        path: Path,
+        writable: bool,
+        protocol: int,
+        compression: Optional[Compression] = None,
+    ) -> None:
+        """
+        Open the storage.
+
+        Args:
+            path (Path): the recording file
+            writable (bool): True to record, False to play back
+            protocol (int): the pickle protocol for stored objects
+            compression (Compression): how to compress the records of a
+                                       new file; None to not compress
+        """
+        super().__init__(path, writable, protocol)
+        # key and (value offset, value length)
+        self._index: Dict[str, Tuple[int, int]] = {}
+        self._file: Optional[BinaryIO] = None
+        self._map: Optional[mmap.mmap] = None
+        self._magic = self.MAGIC
+        self._codec = 0
+        self._level = compression.level if compression is not None else None
+        # the keys stored with set_buffer, which are never compressed
+        self._buffers: Set[str] = set()
+
+        if writable:
+            if self.sniff(path):
+                self._file = path.open("r+b")
+                # only the pages holding the trailer and footer are read,
+                # unless the records have to be scanned
+                with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    self._end = self._load(data, self._header(data))
+                self._file.truncate(self._end)
+                self._file.seek(self._end)
+            else:
+                header = self.MAGIC
+                if compression is not None:
+                    if compression.codec not in self.CODECS:
+                        raise ValueError(f"unknown codec {compression.codec}")
+                    self._magic = self.MAGIC_COMPRESSED
+                    self._codec = self.CODECS[compression.codec]
+                    header = self._magic + bytes((self._codec,))
+                self._file = path.open("w+b")
+                self._file.write(header)
+                self._end = len(header)
+        else:
+            with path.open("rb") as fin:
+                self._map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self._load(self._map, self._header(self._map))
+            except ValueError:
+                self._map.close()
+                raise
+
+    @property
+    def compression(self) -> Optional[Compression]:
+        """
+        The compression of the records, or None if they are not compressed.
+        """
+        for codec, number in self.CODECS.items():
+            if number == self._codec:
+                return Compression(codec, self._level)
+        return None
+
+    @classmethod
+    def sniff(cls, path: Path) -> bool:
+        """
+        Returns True if the path is a segment file.
+        """
+        try:
+            with path.open("rb") as fin:
+                return fin.read(len(cls.MAGIC)) in (cls.MAGIC, cls.MAGIC_COMPRESSED)
+        except OSError:
+            return False
+
+    def set_raw(self, key: str, raw: bytes) -> None:
+        if self._codec == 1:
+            raw = zlib.compress(raw, -1 if self._level is None else self._level)
+        elif self._codec == 2:
+            raw = lzma.compress(raw, preset=self._level, check=lzma.CHECK_NONE)
+        self._buffers.discard(key)
+        self._append(key, raw)
+
+    def set_buffer(self, key: str, data: Any) -> None:
+        raw_key = key.encode()
+        start = self._end + self.RECORD.size + len(raw_key)
+        if start % self.ALIGNMENT:
+            padding = -(start + self.RECORD.size) % self.ALIGNMENT
+            self._append("", bytes(padding))
+        self._buffers.add(key)
+        self._append(key, data, self.BUFFER)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._index
+
+    def get_raw(self, key: str) -> Optional[bytes]:
+        location = self._index.get(key)
+        if location is None:
+            return None
+        start, length = location
+        if self._map is not None:
+            end = start + length
+            raw = self._map[start:end]
+        else:
+            assert self._file is not None  # nosec
+            self._file.seek(start)
+            raw = self._file.read(length)
+            self._file.seek(self._end)
+        if self._codec == 1 and key not in self._buffers:
+            return zlib.decompress(raw)
+        if self._codec == 2 and key not in self._buffers:
+            return lzma.decompress(raw)
+        return raw
+
+    def get_buffer(self, key: str) -> Optional[memoryview]:
+        location = self._index.get(key)
+        if location is None or key not in self._buffers:
+            return super().get_buffer(key)
+        if self._map is None:
+            return memoryview(cast(bytes, self.get_raw(key)))
+        start, length = location
+        end = start + length
+        return memoryview(self._map)[start:end]
+
+    def keys(self) -> Iterable[str]:
+        return list(self._index.keys())
+
+    def close(self) -> None:
+        if self._file is not None:
+            footer = pickle.dumps((self._index, self._buffers), protocol=self.protocol)
+            self._file.write(footer)
+            self._file.write(self.TRAILER.pack(self._end, self._magic))
+            self._file.close()
+            self._file = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # views from get_buffer are in use and keep the map open
+            self._map = None
+
+    def _append(self, key: str, raw: Any, flags: int = 0) -> None:
+        """
+        Append a record, and index it unless it is padding.
+        """
+        assert self._file is not None  # nosec
+        raw_key = key.encode()
+        length = memoryview(raw).nbytes
+        self._file.write(self.RECORD.pack(len(raw_key) | flags, length))
+        self._file.write(raw_key)
+        self._file.write(raw)
+        offset = self._end + self.RECORD.size + len(raw_key)
+        if key:
+            self._index[key] = (offset, length)
+        self._end = offset + length
+
+    def _header(self, data: Any) -> int:
+        """
+        Read the magic number and the codec from the start of the file.
+
+        Returns:
+            The size of the header.
+
+        Raises:
+            ValueError if the file is not a segment file.
+        """
+        magic = bytes(data[: len(self.MAGIC)])
+        if magic == self.MAGIC:
+            return len(magic)
+        if magic == self.MAGIC_COMPRESSED and len(data) > len(magic):
+            self._magic = magic
+            self._codec = data[len(magic)]
+            if self._codec not in self.CODECS.values():
+                raise ValueError(f"{self.path} uses an unknown codec {self._codec}")
+            return len(magic) + 1
+        raise ValueError(f"{self.path} is not a segment file")
+
+    def _load(self, data: Any, offset: int) -> int:
+        """
+        Load the index from the footer, or by scanning the records that
+        start at the offset if the file has no footer.
+
+        Returns:
+            The offset of the end of the records.
+        """
+        size = len(data)
+        if size >= offset + self.TRAILER.size:
+            trailer = size - self.TRAILER.size
+            end, magic = self.TRAILER.unpack_from(data, trailer)
+            if magic == self._magic and end < trailer:
+                footer = pickle.loads(data[end:trailer])  # nosec
+                if isinstance(footer, tuple):
+                    self._index, self._buffers = footer
+                else:
+                    self._index = footer  # written before set_buffer
+                return end
+
+        while offset + self.RECORD.size <= size:
+            keylen, length = self.RECORD.unpack_from(data, offset)
+            flags = keylen & self.BUFFER
+            keylen &= ~self.BUFFER
+            start = offset + self.RECORD.size + keylen
+            if start + length > size:
+                break  # truncated by a crash while writing
+            first = offset + self.RECORD.size
+            key = bytes(data[first:start]).decode()
+            if key:
+                self._index[key] = (start, length)
+                if flags:
+                    self._buffers.add(key)
+                else:
+                    self._buffers.discard(key)
+            offset = start + length
+        return offset
+
+
+@dataclass
+class WriteBehind:
+    """
+    Settings for write-behind recording.
+
+    Attributes:
+        capacity (int): the most records waiting to be written
+        batch (int): the most records written at once
+        block (bool): when the buffer is full, wait for room (True) or
+                      raise WriteBehindFullError (False)
+        timeout (float): the longest to wait for room, in seconds, before
+                         raising WriteBehindFullError; None waits forever
+    """
+
+    capacity: int = 1024
+    batch: int = 64
+    block: bool = True
+    timeout: Optional[float] = None
+
+
+class WriteBehindFullError(RuntimeError):
+    """
+    The write-behind buffer is full.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        super().__init__(f"The write-behind buffer of {capacity} records is full.")
+
+
+class WriteBehindStorage(Storage):
+    """
+    Queues writes to another storage and persists them in batches from a
+    background thread, so recording does not add disk latency to each
+    call.
+
+    Reads see the writes that are still queued.  close() waits for every
+    queued write to be persisted before closing the other storage.  If the
+    writer thread fails, the error is raised by the next write or by close().
+    """
+
+    def __init__(self, storage: Storage, settings: WriteBehind) -> None:
+        """
+        Args:
+            storage (Storage): where the records are persisted
+            settings (WriteBehind): the buffering and back-pressure settings
+        """
+        super().__init__(storage.path, storage.writable, storage.protocol)
+        self.storage = storage
+        self.settings = settings
+        # None tells the writer to stop; the flag marks set_buffer writes
+        self._queue: "queue.Queue[Optional[Tuple[str, bytes, bool]]]" = queue.Queue(
+            maxsize=settings.capacity
+        )
+        # the writes not yet persisted, and the lock guarding them; the
+        # other storage has its own lock so callers never wait on the disk
+        self._pending: Dict[str, bytes] = {}
+        self._pending_lock = threading.Lock()
+        self._storage_lock = threading.Lock()
+        self._error: Optional[Exception] = None
+        self._writer = threading.Thread(
+            target=self._write, name=f"write-behind {self.path}", daemon=True
+        )
+        self._writer.start()
+
+    @property
+    def compression(self) -> Optional[Compression]:
+        return self.storage.compression
+
+    def __contains__(self, key: object) -> bool:
+        with self._pending_lock:
+            if key in self._pending:
+                return True
+        with self._storage_lock:
+            return key in self.storage
+
+    def set_raw(self, key: str, raw: bytes) -> None:
+        self._enqueue(key, raw, False)
+
+    def set_buffer(self, key: str, data: Any) -> None:
+        # the caller may reuse its buffer before the write happens
+        self._enqueue(key, bytes(data), True)
+
+    def _enqueue(self, key: str, raw: bytes, buffer: bool) -> None:
+        self._raise_error()
+        with self._pending_lock:
+            self._pending[key] = raw
+        try:
+            self._queue.put(
+                (key, raw, buffer),
+                block=self.settings.block,
+                timeout=self.settings.timeout,
+            )
+        except queue.Full:
+            with self._pending_lock:
+                if self._pending.get(key) is raw:
+                    del self._pending[key]
+            raise WriteBehindFullError(self.settings.capacity)
+
+    def get_raw(self, key: str) -> Optional[bytes]:
+        # a write leaves pending only once it is persisted
+        with self._pending_lock:
+            raw = self._pending.get(key)
+        if raw is not None:
+            return raw
+        with self._storage_lock:
+            return self.storage.get_raw(key)
+
+    def get_buffer(self, key: str) -> Optional[memoryview]:
+        with self._pending_lock:
+            raw = self._pending.get(key)
+        if raw is not None:
+            return memoryview(raw)
+        with self._storage_lock:
+            return self.storage.get_buffer(key)
+
+    def keys(self) -> Iterable[str]:
+        with self._pending_lock:
+            pending = list(self._pending)
+        with self._storage_lock:
+            return list(dict.fromkeys([*self.storage.keys(), *pending]))
+
+    def flush(self) -> None:
+        """
+        Wait for every queued write to be persisted.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self.storage.close()
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self) -> None:
+        """
+        The writer thread: persist queued writes in batches until told to stop.
+        """
+        stop = False
+        while not stop:
+            batch: List[Optional[Tuple[str, bytes, bool]]] = [self._queue.get()]
+            while len(batch) < self.settings.batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            written = []
+            with self._storage_lock:
+                for entry in batch:
+                    if entry is None:
+                        stop = True
+                        continue
+                    key, raw, buffer = entry
+                    try:
+                        if buffer:
+                            self.storage.set_buffer(key, raw)
+                        else:
+                            self.storage.set_raw(key, raw)
+                    except Exception as ex:
+                        self._error = self._error or ex
+                    written.append((key, raw))
+            with self._pending_lock:
+                for key, raw in written:
+                    if self._pending.get(key) is raw:
+                        del self._pending[key]
+            for _ in batch:
+                self._queue.task_done()
+
+
+class PreloadedStorage(Storage):
+    """
+    Plays back from memory: every record of another storage is read once,
+    in the order it is stored, and the other storage is closed.
+
+    The records are kept pickled and are only unpickled when asked for, so
+    preloading costs no more than reading the file.  Each get unpickles a
+    fresh object since playback hands the result to the caller.
+    """
+
+    def __init__(self, storage: Storage) -> None:
+        """
+        Args:
+            storage (Storage): the recording to read, which is closed
+        """
+        if storage.writable:
+            raise ValueError("only a recording being played back can be preloaded")
+        super().__init__(storage.path, storage.writable, storage.protocol)
+        self._compression = storage.compression
+        self._records: Dict[str, bytes] = {}
+        try:
+            for key in storage.keys():
+                raw = storage.get_raw(key)
+                if raw is not None:
+                    self._records[key] = raw
+        finally:
+            storage.close()
+
+    @property
+    def compression(self) -> Optional[Compression]:
+        return self._compression
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._records
+
+    def set_raw(self, key: str, raw: bytes) -> None:
+        raise TypeError("a preloaded recording cannot be written")
+
+    def get_raw(self, key: str) -> Optional[bytes]:
+        return self._records.get(key)
+
+    def keys(self) -> Iterable[str]:
+        return list(self._records)
+
+    def close(self) -> None:
+        self._records.clear()
+
+
+def gzip_file(source: Path, target: Path) -> None:
+    """
+    Compress a recording with gzip.  The copy is made in chunks so memory
+    use does not grow with the size of the recording.
+    """
+    with source.open("rb") as fin:
+        with gzip.open(target, "wb") as fout:
+            shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+
+
+def gunzip_file(source: Path, target: Path) -> None:
+    """
+    Decompress a gzipped recording, in chunks like gzip_file.
+    """
+    with gzip.open(source, "rb") as fin:
+        with target.open("wb") as fout:
+            shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+
+
+def storage_for(path: Path, writable: bool) -> Type[Storage]:
+    """
+    Determines the storage to use for a recording file.
+
+    Segment files are recognized by their magic number.  Anything else that
+    exists is a shelf, and new (or empty) recordings use segment storage.
+    """
+    if SegmentStorage.sniff(path):
+        return SegmentStorage
+    if writable and (not path.exists() or path.stat().st_size == 0):
+        return SegmentStorage
+    return ShelveStorage
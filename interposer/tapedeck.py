@@ -5,11 +5,15 @@
 #
 import difflib
 import io
+import json
 import logging
+import os
 import pickle  # nosec
 import pickletools  # nosec
-import shelve  # nosec
+import threading
 from contextlib import AbstractContextManager
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
 from enum import auto
 from enum import Enum
@@ -19,12 +23,30 @@ from typing import Any
 from typing import Callable
 from typing import cast
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
 from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Type
 from typing import Union
 
 import yaml
 
 from interposer import CallContext
+from interposer.redaction import Redactor
+from interposer.storage import Compression
+from interposer.storage import PreloadedStorage
+from interposer.storage import SegmentStorage
+from interposer.storage import Storage
+from interposer.storage import storage_for
+from interposer.storage import WriteBehind
+from interposer.storage import WriteBehindStorage
+
+
+# the channel scope of the current thread or task, see TapeDeck.scope
+_scope: ContextVar[Optional[str]] = ContextVar("tapedeck_scope", default=None)
 
 
 class Mode(Enum):
@@ -43,6 +65,9 @@ class Mode(Enum):
 class Payload:
     """
     The record for the content behind each hash.
+
+    Since file format 9 this is only stored in older recordings, and
+    is assembled from the blobs a PayloadRef refers to by dump().
     """
 
     context: CallContext
@@ -50,6 +75,69 @@ class Payload:
     ex: Optional[Exception]
 
 
+@dataclass
+class Outcome:
+    """
+    The result of a call or the exception it raised.
+    """
+
+    result: Any
+    ex: Optional[Exception]
+    # the type of a binary result kept out-of-band, rebuilt on playback
+    binary: Optional[type] = None
+
+
+@dataclass
+class PayloadRef:
+    """
+    The record for each call: the digests of the blobs holding the
+    redacted context and the Outcome, and of the binary buffers kept
+    out-of-band of the Outcome pickle.
+
+    Blobs are stored once by the digest of their content, so calls that
+    get the same response share it.
+    """
+
+    context: str
+    outcome: str
+    buffers: Tuple[str, ...] = ()
+
+
+@dataclass
+class RecordedStream:
+    """
+    The recorded result of a call that returned an iterator.
+
+    The items are recorded separately as the caller consumes them,
+    followed by a StreamEnd.
+    """
+
+    pass
+
+
+@dataclass
+class StreamEnd:
+    """
+    The record for the end of an iterator result.
+    """
+
+    count: int
+    ex: Optional[Exception]
+
+
+@dataclass(frozen=True)
+class IndexEntry:
+    """
+    A recorded call in the index of a tape deck, see TapeDeck.calls().
+    """
+
+    ordinal: int
+    hash: str
+    # the bytes of the recorded outcome, or None if the recording was
+    # made before the index was kept
+    size: Optional[int]
+
+
 class TapeDeckError(RuntimeError):
     """
     Base class for tape deck errors.
@@ -106,6 +194,23 @@ class Dumper(yaml.Dumper):
         return super().increase_indent(flow, False)
 
 
+def _json_keys(value: Any) -> Any:
+    """
+    Returns value with the dict keys JSON cannot represent, in it and in the
+    dicts, lists and tuples it holds, replaced by their repr.
+    """
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if key is not None and not isinstance(key, (str, int, float)):
+                key = repr(key)
+            result[key] = _json_keys(item)
+        return result
+    if isinstance(value, (list, tuple)):
+        return [_json_keys(item) for item in value]
+    return value
+
+
 class TapeDeck(AbstractContextManager):
     """
     A pickling call recording and playback class.
@@ -113,8 +218,31 @@ class TapeDeck(AbstractContextManager):
     Known limitations:
 
     1. All arguments, results, and exceptions must be safe to pickle.
-    2. Asynchronous calls have not been tested and likely will not work.
-    3. The recorder does not expect to be active in multiple threads.
+    2. Coroutines are recorded and played back with their awaited result,
+       however the recording itself is synchronous.
+    3. Calls made concurrently in one channel get ordinals in the order
+       they arrive, which is not repeatable; see scope() for a way to
+       make concurrent recordings play back reliably.
+
+    Recordings are kept in a single append-only segment file by default
+    (see interposer.storage).  Older recordings kept in a shelf are
+    recognized and played back.  When recording from live traffic, the
+    writes can be handed to a background thread (see WriteBehind) so the
+    calls being recorded do not wait on the disk.  Playback can read the
+    whole recording into memory when the tape deck is opened (preload) so
+    long test suites do not go to the disk for each call.  Bulk recording can
+    keep the recorded context of only some calls (forensics_every), which
+    halves the records written per call, at the cost of less detail when a
+    call is not found on playback.
+
+    The tape deck keeps an index of the calls in each channel, written when
+    it is closed after recording, so listing the channels and calls of a
+    recording (see channels() and calls()), or dumping some channels, reads
+    only the index rather than the whole recording.
+
+    The tape deck can record and play back from multiple threads at once.
+    The ordinal counters and the storage are each guarded by their own lock,
+    and pickling and redaction happen outside of either lock.
 
     By recording your interaction with an imported library, you can
     prove actual behavior occasionally, and generate a recording that
@@ -139,46 +267,96 @@ class TapeDeck(AbstractContextManager):
       -  5: support datetime and enum in argument lists
       -  6: major refactor rendered previous recordings unusable
       -  7: added original secret length redaction mapping
+      -  8: added streaming of iterator results
+      -  9: contexts, outcomes, and stream items stored once by content digest
+      - 10: large binary results stored out-of-band of the pickle
 
     NOTE: We are expressly not using `dill` because it stores class
           definitions and as a result would not actually catch errors
           when a third party library is updated.
     """
 
-    CURRENT_FILE_FORMAT = 7
+    CURRENT_FILE_FORMAT = 10
+    BLOB_FILE_FORMAT = 9
     EARLIEST_FILE_FORMAT_SUPPORTED = 7
     PICKLE_PROTOCOL = 4
+    # results are pickled with protocol 5 where it is available so binary
+    # buffers of at least OUT_OF_BAND_SIZE bytes are stored on their own
+    OUT_OF_BAND_PROTOCOL = 5
+    OUT_OF_BAND_SIZE = 64 * 1024
 
     LABEL_CHANNEL = "channel"
     LABEL_HASH = "hash"
+    LABEL_ITEMS = "items"
     LABEL_ORDINAL = "ordinal"
     LABEL_RESULT = "result"
     LABEL_TAPE = "tape"
 
+    SCOPE_SEPARATOR = "/"
+
+    PREFIX_BLOB = "_blob_"
+    PREFIX_BUFFER = "_buffer_"
+
     LABEL_FILE_FORMAT = "_file_format"
+    LABEL_INDEX = "_index"  # the channel, ordinal, hash, and size of each call
+    LABEL_STRIPPED = "_stripped"  # recorded contexts were left out
     LABEL_VERSION = "_version"  # extant; use LABEL_FILE_FORMAT
 
     # a logging level lower than logging.DEBUG (10)
     DEBUG_WITH_RESULTS = 7
 
-    def __init__(self, deck: Path, mode: Mode) -> None:
+    def __init__(
+        self,
+        deck: Path,
+        mode: Mode,
+        storage: Optional[Type[Storage]] = None,
+        write_behind: Optional[WriteBehind] = None,
+        compression: Optional[Compression] = None,
+        preload: bool = False,
+        forensics_every: int = 1,
+    ) -> None:
         """
         Initializer.
 
         Arguments:
             deck (Path): The full path to the recording filename.
             mode (Mode): The operational mode - Playback or Recording.
+            storage (type): The Storage to use; by default this is chosen
+                            from the contents of the recording file.
+            write_behind (WriteBehind): When recording, write to storage
+                                        from a background thread.
+            compression (Compression): When recording a new file, compress
+                                       each record; playback detects it.
+            preload (bool): When playing back, read the whole recording
+                            into memory when opened.
+            forensics_every (int): When recording, keep the context of one
+                                   call in this many in each channel for
+                                   forensics; 0 to keep none.
         """
+        if forensics_every < 0:
+            raise ValueError("forensics_every cannot be negative")
         self.deck = deck
         self.file_format: int = 0
         self.mode = mode
+        self.storage = storage
+        self.write_behind = write_behind
+        self.compression = compression
+        self.preload = preload
+        self.forensics_every = forensics_every
 
         # call ordinal key (channel name) and value (ordinal number)
         self._call_ordinals: Dict[str, int] = {}
+        self._ordinal_lock = threading.Lock()
         self._logger = logging.getLogger(__name__)
         self._redactions: Dict[Union[str, bytes], str] = dict()
-        # the open file resource
-        self._tape: shelve.Shelf[object] = NotImplemented
+        # the redactions compiled, rebuilt whenever a secret is added
+        self._redactor = Redactor(self._redactions)
+        # the open file resource, and the lock guarding access to it
+        self._tape: Storage = NotImplemented
+        self._tape_lock = threading.Lock()
+        # channel, ordinal, and (hash, size) of each recorded call, guarded
+        # by the storage lock; loaded on first use for playback
+        self._index: Optional[Dict[str, Dict[int, Tuple[str, Optional[int]]]]] = None
 
     def __enter__(self):
         """AbstractContextManager"""
@@ -189,42 +367,252 @@ class TapeDeck(AbstractContextManager):
         """AbstractContextManager"""
         self.close()
 
-    def dump(self, outfile: Path) -> None:
+    @property
+    def file_compression(self) -> Optional[Compression]:
+        """
+        The compression of the records of the open recording, or None if
+        they are not compressed.
+
+        Raises:
+            TapeDeckOpenError if the tape deck is not open.
+        """
+        if self._tape == NotImplemented:
+            raise TapeDeckOpenError()
+        return self._tape.compression
+
+    def calls(self, channel: str) -> List[IndexEntry]:
+        """
+        Returns the recorded calls in a channel in ordinal order.
+
+        Raises:
+            TapeDeckOpenError if the tape deck is not open.
         """
-        Dump the database file for analysis.
+        index = self._get_index()
+        with self._tape_lock:
+            calls = sorted(index.get(channel, {}).items())
+        return [IndexEntry(ordinal, uniq, size) for ordinal, (uniq, size) in calls]
 
-        The resulting output is:
+    def channels(self) -> List[str]:
+        """
+        Returns the channels with recorded calls, sorted.
 
-        _file_format: N
-        channel:
-          - payload (sorted by ordinal)
+        Scoped channels (see scope()) are listed separately as
+        "<channel>/<scope>".
 
         Raises:
             TapeDeckOpenError if the tape deck is not open.
         """
-        results: Dict[str, Any] = {}
+        index = self._get_index()
+        with self._tape_lock:
+            return sorted(index)
+
+    def fingerprint(self, call: IndexEntry) -> Optional[Tuple[str, ...]]:
+        """
+        Returns the digests of everything recorded for a call: the outcome,
+        its out-of-band buffers, and any stream items.  Calls with the same
+        hash and fingerprint got the same outcome, even in different
+        recordings, so they can be compared without loading them.
+
+        Returns None before file format 9, when calls are stored by value.
 
+        Raises:
+            TapeDeckOpenError if the tape deck is not open.
+        """
         if self._tape == NotImplemented:
             raise TapeDeckOpenError()
+        return self._fingerprint(call.hash)
 
-        for key in self._tape.keys():
-            payload = self._tape[key]
-            if key[0] == "_":
-                results[key] = payload
-            else:
-                channel = payload.context.meta["tape"]["channel"]  # type: ignore
-                results.setdefault(channel, []).append(payload)
-
-        for channel in results.keys():
-            if channel[0] != "_":
-                results[channel] = list(
-                    sorted(
-                        results[channel],
-                        key=lambda item: item.context.meta["tape"]["ordinal"],
+    def dump_call(self, channel: str, call: IndexEntry) -> Dict[str, Any]:
+        """
+        Returns the record dump() writes for one of the calls in a channel.
+
+        Raises:
+            TapeDeckOpenError if the tape deck is not open.
+        """
+        if self._tape == NotImplemented:
+            raise TapeDeckOpenError()
+        return self._dump_call(channel, call.ordinal, call.hash)
+
+    def dump(
+        self,
+        outfile: Path,
+        channels: Optional[Iterable[str]] = None,
+        jsonl: bool = False,
+    ) -> None:
+        """
+        Dump the recording for analysis.
+
+        The calls are read and written one at a time, in ordinal order
+        within each channel, so memory use does not grow with the size of
+        the recording.  The first record holds the labels of the recording
+        (such as _file_format), and then each call is written as:
+
+        channel: the channel name
+        ordinal: N
+        context: the recorded call context
+        result: the result, or items: the items of an iterator result
+        ex: the exception raised, if any
+
+        As YAML each record is a document, written with the libyaml emitter
+        when it is available.  As JSON Lines each record is a line, and values
+        JSON cannot represent, and dict keys other than strings, numbers,
+        booleans and None, are written as their repr.  The channels and
+        ordinals come from the index, so limiting the channels reads only the
+        calls in them.  Calls missing from the index (only in recordings made
+        before it was kept, without their context) are written last, without
+        a channel or ordinal, unless the channels are limited.  The dump is
+        written alongside outfile and replaces it once complete, so a dump
+        that fails leaves outfile as it was.
+
+        Args:
+            outfile (Path): where to write the dump
+            channels (list): the channels to dump; all of them by default
+            jsonl (bool): write JSON Lines instead of YAML
+
+        Raises:
+            TapeDeckOpenError if the tape deck is not open.
+        """
+        if self._tape == NotImplemented:
+            raise TapeDeckOpenError()
+
+        records = self._dump_records(None if channels is None else set(channels))
+        partial = Path(f"{outfile}.partial")
+        try:
+            with partial.open("w") as fout:
+                if jsonl:
+                    for record in records:
+                        fout.write(json.dumps(_json_keys(record), default=repr))
+                        fout.write("\n")
+                else:
+                    dumper = getattr(yaml, "CDumper", Dumper)
+                    yaml.dump_all(records, fout, Dumper=dumper)
+            os.replace(partial, outfile)
+        finally:
+            if partial.exists():
+                partial.unlink()
+
+    def migrate(
+        self,
+        target: Path,
+        compression: Optional[Compression] = None,
+        forensics: bool = True,
+    ) -> None:
+        """
+        Rewrite the recording in the current file format.
+
+        The records are read and written one at a time, so memory use does
+        not grow with the size of the recording; blobs and buffers are copied
+        along with the first record that refers to them, so the new recording
+        holds only what is still in use.  They are copied as they are, so the
+        classes of recorded results do not need to be importable; only the
+        records of file formats before 9 are unpickled and pickled again.
+        The content is not redacted again, since it was redacted when it was
+        recorded.  The index of the new
+        recording is rebuilt, so it has the size of every call.
+
+        Without forensics, the recorded contexts of calls, which are only
+        used to explain a RecordedCallNotFoundError and by dump(), are left
+        out.  Playback is not affected.
+
+        Args:
+            target (Path): the new recording, in a segment file
+            compression (Compression): how to compress the new recording
+            forensics (bool): False to leave out the recorded contexts
+
+        Raises:
+            TapeDeckOpenError if the tape deck is not open.
+        """
+        if self._tape == NotImplemented:
+            raise TapeDeckOpenError()
+
+        blobs = self.file_format >= self.BLOB_FILE_FORMAT
+        calls: Dict[str, List[Tuple[str, int]]] = {}
+        for channel in self.channels():
+            for call in self.calls(channel):
+                calls.setdefault(call.hash, []).append((channel, call.ordinal))
+        with TapeDeck(target, Mode.Recording, compression=compression) as deck:
+            if not forensics:
+                deck._tape[self.LABEL_STRIPPED] = True
+            for key in self._tape.keys():
+                if key.startswith((self.PREFIX_BLOB, self.PREFIX_BUFFER)):
+                    continue  # copied with the records that refer to them
+                if key in (
+                    self.LABEL_FILE_FORMAT,
+                    self.LABEL_INDEX,
+                    self.LABEL_VERSION,
+                ):
+                    continue  # written by the new tape deck
+                if key.startswith("_call_") and not forensics:
+                    continue
+                with self._tape_lock:
+                    entry = self._tape.get_raw(key)
+                if entry is None:
+                    continue
+                # the records of the current file format only hold digests
+                # and labels, so results are never unpickled here
+                value = pickle.loads(entry)  # nosec
+
+                if key.startswith(("_call_", "_item_")):
+                    if blobs:
+                        raw = self._get_blob_raw(value)
+                    elif key.startswith("_call_"):
+                        raw = value  # the pickled context
+                    else:
+                        raw = pickle.dumps(value, protocol=self.PICKLE_PROTOCOL)
+                    value = deck._put_blob(raw)
+                elif isinstance(value, PayloadRef):
+                    # the blobs are copied as they are, with the same digests
+                    raw = self._get_blob_raw(value.outcome)
+                    with self._tape_lock:
+                        context = self._tape.get_raw(
+                            f"{self.PREFIX_BLOB}{value.context}"
+                        )
+                        buffers = [
+                            self._tape.get_buffer(f"{self.PREFIX_BUFFER}{digest}")
+                            for digest in value.buffers
+                        ]
+                    if forensics and context is not None:
+                        deck._put_blob(context)
+                    deck._put_blob(raw)
+                    for buffer in buffers:
+                        if buffer is None:
+                            raise KeyError(f"{self.PREFIX_BUFFER}{value.buffers}")
+                        deck._put_buffer(buffer)
+                    self._migrate_index(deck, calls.get(key, []), key, raw, buffers)
+                elif isinstance(value, Payload):
+                    outcome = Outcome(value.result, value.ex)
+                    context = pickle.dumps(value.context, protocol=self.PICKLE_PROTOCOL)
+                    digest = sha256(context).hexdigest()
+                    if forensics:
+                        digest = deck._put_blob(context)
+                    raw, buffers = deck._redact_outcome(outcome)
+                    value = PayloadRef(
+                        context=digest,
+                        outcome=deck._put_blob(raw),
+                        buffers=tuple(deck._put_buffer(buffer) for buffer in buffers),
                     )
-                )
-        with outfile.open("w") as fout:
-            yaml.dump(results, fout, Dumper=Dumper)
+                    self._migrate_index(deck, calls.get(key, []), key, raw, buffers)
+                with deck._tape_lock:
+                    if blobs:
+                        deck._tape.set_raw(key, entry)  # digests are unchanged
+                    else:
+                        deck._tape[key] = value
+
+    def _migrate_index(
+        self,
+        deck: "TapeDeck",
+        calls: List[Tuple[str, int]],
+        uniq: str,
+        raw: bytes,
+        buffers: List[Any],
+    ) -> None:
+        """
+        Add a migrated call to the index of the new recording.
+        """
+        size = len(raw) + sum(memoryview(buffer).nbytes for buffer in buffers)
+        with deck._tape_lock:
+            for channel, ordinal in calls:
+                deck._add_to_index(channel, ordinal, uniq, size)
 
     def open(self) -> None:
         """
@@ -239,10 +627,21 @@ class TapeDeck(AbstractContextManager):
 
         self._reset()
 
-        if self.mode == Mode.Playback:
-            self._tape = shelve.open(  # nosec
-                str(self.deck), flag="r", protocol=self.PICKLE_PROTOCOL
+        writable = self.mode == Mode.Recording
+        storage = self.storage or storage_for(self.deck, writable)
+        if writable and self.compression is not None:
+            if not issubclass(storage, SegmentStorage):
+                raise TypeError(f"{storage.__name__} does not support compression")
+            self._tape = storage(
+                self.deck, writable, self.PICKLE_PROTOCOL, self.compression
             )
+        else:
+            self._tape = storage(self.deck, writable, self.PICKLE_PROTOCOL)
+        if writable and self.write_behind is not None:
+            self._tape = WriteBehindStorage(self._tape, self.write_behind)
+        if not writable and self.preload:
+            self._tape = PreloadedStorage(self._tape)
+        if self.mode == Mode.Playback:
             self.file_format = cast(
                 int,
                 self._tape.get(
@@ -256,17 +655,19 @@ class TapeDeck(AbstractContextManager):
                     self.CURRENT_FILE_FORMAT,
                 )
         else:
-            self._tape = shelve.open(  # nosec
-                str(self.deck), flag="c", protocol=self.PICKLE_PROTOCOL
-            )
             self._tape[self.LABEL_FILE_FORMAT] = self.CURRENT_FILE_FORMAT
             self.file_format = self.CURRENT_FILE_FORMAT
+            if self.forensics_every != 1:
+                self._tape[self.LABEL_STRIPPED] = True
+            # recording to an existing file adds to its index
+            self._index = self._read_index()
 
         self._log(
             logging.DEBUG,
             "open",
             "file",
-            f"{self.deck} for {self.mode} using file format {self.file_format}",
+            f"{self.deck} for {self.mode} using file format {self.file_format} "
+            f"in {type(self._tape).__name__}",
         )
 
     def close(self) -> None:
@@ -276,8 +677,22 @@ class TapeDeck(AbstractContextManager):
         If the tape deck is not open, this does nothing.
         """
         if self._tape != NotImplemented:  # prevents errors closing after failed open()
-            self._tape.close()
-            self._tape = NotImplemented
+            try:
+                if self.mode == Mode.Recording and self._index is not None:
+                    self._tape[self.LABEL_INDEX] = {
+                        channel: [
+                            (ordinal, uniq, size)
+                            for ordinal, (uniq, size) in sorted(calls.items())
+                        ]
+                        for channel, calls in self._index.items()
+                    }
+            finally:
+                # even if the index could not be written (such as when the
+                # write-behind writer failed), so the file is finished
+                try:
+                    self._tape.close()
+                finally:
+                    self._tape = NotImplemented
             self._log(
                 logging.DEBUG,
                 "close",
@@ -308,21 +723,55 @@ class TapeDeck(AbstractContextManager):
         """
         uniq = self._advance(context, channel)
 
-        payload = Payload(context=context, result=result, ex=ex)
-        try:
-            self._tape[uniq] = self._redact(payload)
-        except (pickle.PicklingError, TypeError):
-            save_call = self._reduce_call(context)
-            try:
-                self._tape[uniq] = self._redact(payload)
-            finally:
-                context.call = save_call
+        raw, buffers = self._redact_outcome(Outcome(result, ex))
+        outcome = self._put_blob(raw)
+        digests = tuple(self._put_buffer(buffer) for buffer in buffers)
+        size = len(raw) + sum(memoryview(buffer).nbytes for buffer in buffers)
+        our_meta = context.meta[self.LABEL_TAPE]
+        with self._tape_lock:
+            self._tape[uniq] = PayloadRef(
+                context=uniq, outcome=outcome, buffers=digests
+            )
+            self._add_to_index(
+                our_meta[self.LABEL_CHANNEL], our_meta[self.LABEL_ORDINAL], uniq, size
+            )
 
         if ex is None:
             self._log_result("record", context, result)
         else:
             self._log_ex("record", context, ex)
 
+    def record_item(self, context: CallContext, item: Any) -> None:
+        """
+        Record the next item of an iterator result.
+
+        The call itself must have been recorded first with a RecordedStream
+        result, and the items must be recorded in the order they are consumed.
+
+        Args:
+            context (CallContext): the call context that was recorded
+            item (Any): the item, as any python object that can be pickled
+        """
+        our_meta = context.meta[self.LABEL_TAPE]
+        index = our_meta[self.LABEL_ITEMS] = our_meta.get(self.LABEL_ITEMS, 0) + 1
+        digest = self._put_blob(self._redact(item, return_bytes=True))
+        with self._tape_lock:
+            self._tape[f"_item_{our_meta[self.LABEL_HASH]}_{index - 1}"] = digest
+
+    def record_end(self, context: CallContext, ex: Optional[Exception]) -> None:
+        """
+        Record the end of an iterator result.
+
+        Args:
+            context (CallContext): the call context that was recorded
+            ex (Exception): The exception raised while iterating, if any
+        """
+        our_meta = context.meta[self.LABEL_TAPE]
+        end = StreamEnd(count=our_meta.get(self.LABEL_ITEMS, 0), ex=ex)
+        digest = self._put_blob(self._redact(end, return_bytes=True))
+        with self._tape_lock:
+            self._tape[f"_item_{our_meta[self.LABEL_HASH]}_end"] = digest
+
     def playback(self, context: CallContext, channel: str = "default") -> Any:
         """
         Playback a previously recorded call.
@@ -339,15 +788,21 @@ class TapeDeck(AbstractContextManager):
             If an exception was recorded for this call, it is raised.
         """
         uniq = self._advance(context, channel)
-        recorded: Payload = cast(Payload, self._tape.get(uniq, NotImplemented))
+        with self._tape_lock:
+            recorded = self._tape.get(uniq, NotImplemented)
         if recorded is NotImplemented:
-            self._forensics(context, channel)
+            self._forensics(context)
             raise RecordedCallNotFoundError(context)
 
-        payload = recorded
+        if isinstance(recorded, PayloadRef):
+            payload = self._get_outcome(recorded)
+        else:
+            payload = cast(Outcome, recorded)  # a Payload, before format 9
 
         if payload.ex is None:
             self._log_result("playback", context, payload.result)
+            if isinstance(payload.result, RecordedStream):
+                return self._playback_stream(context, uniq)
             return payload.result
         else:
             self._log_ex("playback", context, payload.ex)
@@ -390,19 +845,23 @@ class TapeDeck(AbstractContextManager):
         if self.mode == Mode.Recording:
             secretlen = len(secret)
             redacted = (identifier + ("_" * secretlen))[:secretlen]
-            if self._redactions.get(secret) == redacted:
-                # calling it more than once for the same secret and ID is ok
-                return secret
-
-            if self._tape.get(key):
-                raise AttributeError(
-                    f"{identifier} has already been used to redact another secret"
-                )
-            self._redactions[secret] = redacted
-            self._tape[key] = secretlen
+            with self._tape_lock:
+                if self._redactions.get(secret) == redacted:
+                    # calling it more than once for the same secret and ID is ok
+                    return secret
+
+                if self._tape.get(key):
+                    raise AttributeError(
+                        f"{identifier} has already been used to redact another secret"
+                    )
+                # copy on write, so redaction in other threads is not disturbed
+                self._redactions = {**self._redactions, secret: redacted}
+                self._redactor = Redactor(self._redactions)
+                self._tape[key] = secretlen
             return secret
         else:
-            secretlen = cast(int, self._tape.get(key))
+            with self._tape_lock:
+                secretlen = cast(int, self._tape.get(key))
             if not secretlen:
                 raise AttributeError(
                     f"{identifier} was not used during recording to redact this secret"
@@ -412,6 +871,27 @@ class TapeDeck(AbstractContextManager):
                 return result.encode()
             return result
 
+    @contextmanager
+    def scope(self, name: str) -> Iterator[None]:
+        """
+        Scope the channels used by the current thread or task.
+
+        Calls recorded or played back within the scope use their own
+        channel named "<channel>/<name>" with its own ordinals.  When work
+        is fanned out across threads or tasks, give each unit of work a
+        scope with a repeatable name (for example, the index of the item
+        it processes) so the calls line up on playback regardless of how
+        the work was scheduled.
+
+        The scope is held in a context variable, so it applies to the
+        current thread or asyncio task only.
+        """
+        token = _scope.set(name)
+        try:
+            yield
+        finally:
+            _scope.reset(token)
+
     def _advance(self, context: CallContext, channel: str) -> str:
         """
         Advance to processing the next call.
@@ -420,9 +900,13 @@ class TapeDeck(AbstractContextManager):
         hash together the channel name, call ordinal, and context to get a
         unique signature that can be used to find the call again later.
         """
-        ordinal = self._call_ordinals[channel] = (
-            self._call_ordinals.setdefault(channel, -1) + 1
-        )
+        scope = _scope.get()
+        if scope is not None:
+            channel = f"{channel}{self.SCOPE_SEPARATOR}{scope}"
+        with self._ordinal_lock:
+            ordinal = self._call_ordinals[channel] = (
+                self._call_ordinals.get(channel, -1) + 1
+            )
         our_meta = context.meta.setdefault(self.LABEL_TAPE, {})
         our_meta[self.LABEL_CHANNEL] = channel
         our_meta[self.LABEL_ORDINAL] = ordinal
@@ -441,7 +925,88 @@ class TapeDeck(AbstractContextManager):
         our_meta[self.LABEL_HASH] = result
         return result
 
-    def _forensics(self, context: CallContext, channel: str) -> None:
+    def _dump_records(self, channels: Optional[Set[str]]) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the records of dump(): the labels, then each call.
+        """
+        with self._tape_lock:
+            keys = list(self._tape.keys())
+
+        labels = {}
+        for key in keys:
+            if (
+                key[0] == "_"
+                and key != self.LABEL_INDEX
+                and not key.startswith(
+                    ("_call_", "_item_", self.PREFIX_BLOB, self.PREFIX_BUFFER)
+                )
+            ):
+                with self._tape_lock:
+                    labels[key] = self._tape.get(key)
+        yield labels
+
+        seen = set()
+        for channel in self.channels():
+            if channels is None or channel in channels:
+                for call in self.calls(channel):
+                    seen.add(call.hash)
+                    yield self._dump_call(channel, call.ordinal, call.hash)
+
+        if channels is None:
+            for key in keys:
+                if key[0] != "_" and key not in seen:
+                    yield self._dump_call(None, None, key)
+
+    def _add_to_index(
+        self, channel: str, ordinal: int, uniq: str, size: Optional[int]
+    ) -> None:
+        """
+        Add a recorded call to the index; the storage lock must be held.
+        """
+        cast(dict, self._index).setdefault(channel, {})[ordinal] = (uniq, size)
+
+    def _dump_call(
+        self, channel: Optional[str], ordinal: Optional[int], uniq: str
+    ) -> Dict[str, Any]:
+        """
+        Returns the dump() record for a call.
+        """
+        with self._tape_lock:
+            recorded = self._tape.get(uniq)
+        if isinstance(recorded, PayloadRef):
+            with self._tape_lock:
+                context = self._tape.get(f"{self.PREFIX_BLOB}{recorded.context}")
+            outcome = self._get_outcome(recorded)
+        else:
+            context = recorded.context  # a Payload, before format 9
+            outcome = recorded
+
+        record: Dict[str, Any] = {
+            "channel": channel,
+            "ordinal": ordinal,
+            "context": context,
+        }
+        if isinstance(outcome.result, RecordedStream):
+            blobs = self.file_format >= self.BLOB_FILE_FORMAT
+            items: List[Any] = []
+            while True:
+                with self._tape_lock:
+                    item = self._tape.get(f"_item_{uniq}_{len(items)}", NotImplemented)
+                if item is NotImplemented:
+                    break
+                items.append(self._get_blob(item) if blobs else item)
+            with self._tape_lock:
+                end = self._tape.get(f"_item_{uniq}_end")
+            if end is not None and blobs:
+                end = self._get_blob(end)
+            record["items"] = items
+            record["ex"] = end.ex if end is not None else None
+        else:
+            record["result"] = outcome.result
+            record["ex"] = outcome.ex
+        return record
+
+    def _forensics(self, context: CallContext) -> None:
         """
         Perform forensic analysis of RecordedCallNotFoundError and log:
 
@@ -449,9 +1014,15 @@ class TapeDeck(AbstractContextManager):
         - The playback pickled context
         - The difference
         """
-        ordinal = self._call_ordinals[channel]
-
-        recorded_raw = cast(bytes, self._tape.get(f"_call_{channel}_{ordinal}"))
+        our_meta = context.meta[self.LABEL_TAPE]
+        channel = our_meta[self.LABEL_CHANNEL]
+        ordinal = our_meta[self.LABEL_ORDINAL]
+
+        with self._tape_lock:
+            recorded_raw = self._tape.get(f"_call_{channel}_{ordinal}")
+            if recorded_raw is not None and self.file_format >= self.BLOB_FILE_FORMAT:
+                recorded_raw = self._tape.get_raw(f"{self.PREFIX_BLOB}{recorded_raw}")
+            stripped = self._tape.get(self.LABEL_STRIPPED, False)
         playback_call = self._reduce_call(context)
         try:
             playback_raw = self._redact(context, return_bytes=True)
@@ -477,7 +1048,8 @@ class TapeDeck(AbstractContextManager):
                 logging.DEBUG,
                 "mismatch",
                 "recorded",
-                f"NO RECORDED CALL IN CHANNEL {channel} ORDINAL {ordinal}",
+                f"NO RECORDED CALL IN CHANNEL {channel} ORDINAL {ordinal}"
+                + (" (NOT EVERY RECORDED CALL WAS KEPT)" if stripped else ""),
             )
 
         playback_io = io.StringIO()
@@ -502,34 +1074,172 @@ class TapeDeck(AbstractContextManager):
     def _hickle(self, context: CallContext) -> str:
         """
         Hash a context using a redacted pickle.  In addition we stuff
-        the original redacted call into the database so we can compare
+        the original redacted call into the database (as the blob for the
+        hash, referenced by _call_<channel>_<ordinal>) so we can compare
         that call's raw content against a playback call to see why they
-        are different.
+        are different.  Only one call in forensics_every is stuffed.
 
         Raises:
             PicklingError if something in the context cannot be pickled.
         """
         raw = self._redact(context, return_bytes=True)
-        if self.mode == Mode.Recording:
-            our_meta = context.meta[self.LABEL_TAPE]
-            channel = our_meta[self.LABEL_CHANNEL]
-            ordinal = our_meta[self.LABEL_ORDINAL]
-            self._tape[f"_call_{channel}_{ordinal}"] = raw
-        uniq = sha256(raw)
-        result = uniq.hexdigest()
-        return result
+        if self.mode != Mode.Recording:
+            return sha256(raw).hexdigest()
+
+        our_meta = context.meta[self.LABEL_TAPE]
+        channel = our_meta[self.LABEL_CHANNEL]
+        ordinal = our_meta[self.LABEL_ORDINAL]
+        if not self.forensics_every or ordinal % self.forensics_every:
+            return sha256(raw).hexdigest()
+
+        uniq = self._put_blob(raw)
+        with self._tape_lock:
+            self._tape[f"_call_{channel}_{ordinal}"] = uniq
+        return uniq
+
+    def _fingerprint(self, uniq: str) -> Optional[Tuple[str, ...]]:
+        """
+        Returns the digests of everything recorded for a call: the outcome,
+        its out-of-band buffers, and any stream items, so calls can be
+        compared without loading them.
+
+        Returns None before file format 9, when calls are stored by value.
+        """
+        if self.file_format < self.BLOB_FILE_FORMAT:
+            return None
+        with self._tape_lock:
+            recorded = self._tape.get(uniq)
+            if not isinstance(recorded, PayloadRef):
+                return None
+            digests = [recorded.outcome, *recorded.buffers]
+            items = 0
+            while True:
+                item = self._tape.get(f"_item_{uniq}_{items}")
+                if item is None:
+                    break
+                digests.append(item)
+                items += 1
+            end = self._tape.get(f"_item_{uniq}_end")
+        return (*digests, end) if end is not None else tuple(digests)
+
+    def _get_blob(self, digest: str) -> Any:
+        """
+        Load the content stored under a digest.
+        """
+        with self._tape_lock:
+            return self._tape[f"{self.PREFIX_BLOB}{digest}"]
+
+    def _put_blob(self, raw: bytes) -> str:
+        """
+        Store pickled content once by its digest.
+
+        Returns:
+            The digest.
+        """
+        digest = sha256(raw).hexdigest()
+        key = f"{self.PREFIX_BLOB}{digest}"
+        with self._tape_lock:
+            if key not in self._tape:
+                self._tape.set_raw(key, raw)
+        return digest
+
+    def _get_blob_raw(self, digest: str) -> bytes:
+        """
+        Load the pickled content stored under a digest.
+        """
+        key = f"{self.PREFIX_BLOB}{digest}"
+        with self._tape_lock:
+            raw = self._tape.get_raw(key)
+        if raw is None:
+            raise KeyError(key)
+        return raw
+
+    def _get_outcome(self, ref: PayloadRef) -> Outcome:
+        """
+        Load the outcome of a call along with its out-of-band buffers.
+
+        A binary result is rebuilt as the type it was recorded as; a
+        memoryview is returned as a read-only view of the recording.
+        """
+        if not ref.buffers:
+            outcome = cast(Outcome, self._get_blob(ref.outcome))
+        else:
+            key = f"{self.PREFIX_BLOB}{ref.outcome}"
+            with self._tape_lock:
+                raw = self._tape.get_raw(key)
+                buffers = [
+                    self._tape.get_buffer(f"{self.PREFIX_BUFFER}{digest}")
+                    for digest in ref.buffers
+                ]
+            if raw is None or None in buffers:
+                raise KeyError(key)
+            outcome = cast(Outcome, pickle.loads(raw, buffers=buffers))  # nosec
+        # a buffer kept in the pickle unpickles as bytes
+        if outcome.binary is not None and type(outcome.result) is not outcome.binary:
+            return Outcome(outcome.binary(outcome.result), outcome.ex)
+        return outcome
+
+    def _put_buffer(self, buffer: Any) -> str:
+        """
+        Store binary data once by its digest.
+
+        Returns:
+            The digest.
+        """
+        digest = sha256(buffer).hexdigest()
+        key = f"{self.PREFIX_BUFFER}{digest}"
+        with self._tape_lock:
+            if key not in self._tape:
+                self._tape.set_buffer(key, buffer)
+        return digest
+
+    def _get_index(self) -> Dict[str, Dict[int, Tuple[str, Optional[int]]]]:
+        """
+        Returns the index of the recorded calls, reading it on first use.
+
+        Raises:
+            TapeDeckOpenError if the tape deck is not open.
+        """
+        if self._tape == NotImplemented:
+            raise TapeDeckOpenError()
+        if self._index is None:
+            self._index = self._read_index()
+        return self._index
+
+    def _read_index(self) -> Dict[str, Dict[int, Tuple[str, Optional[int]]]]:
+        """
+        Read the index of the recorded calls: the hash and size of the call
+        at each ordinal of each channel.
+
+        Recordings made before the index was kept are indexed from their
+        forensic entries (_call_<channel>_<ordinal>), without sizes.
+        """
+        with self._tape_lock:
+            stored = self._tape.get(self.LABEL_INDEX)
+        if stored is not None:
+            return {
+                channel: {ordinal: (uniq, size) for ordinal, uniq, size in calls}
+                for channel, calls in stored.items()
+            }
+
+        index: Dict[str, Dict[int, Tuple[str, Optional[int]]]] = {}
+        with self._tape_lock:
+            keys = [key for key in self._tape.keys() if key.startswith("_call_")]
+        for key in keys:
+            channel, ordinal = key.replace("_call_", "", 1).rsplit("_", 1)
+            with self._tape_lock:
+                uniq = self._tape.get(key)
+            if isinstance(uniq, bytes):
+                uniq = sha256(uniq).hexdigest()  # the context, before format 9
+            index.setdefault(channel, {})[int(ordinal)] = (uniq, None)
+        return index
 
     def _log(self, level: int, category: str, action: str, msg: str) -> None:
         """
         Common funnel for logs.
         """
         msg = f"TAPE: {category}({action}): {msg}"
-        for secret, replacement in self._redactions.items():
-            if isinstance(secret, str):
-                msg = msg.replace(secret, replacement)
-            else:
-                msg = msg.encode().replace(secret, replacement.encode()).decode()
-        self._logger.log(level, msg)
+        self._logger.log(level, self._redactor.redact_text(msg))
 
     def _log_ex(self, action: str, context: CallContext, ex: Exception) -> None:
         """
@@ -569,20 +1279,87 @@ class TapeDeck(AbstractContextManager):
         binary form, then doing a binary secret replacement, then unpickling.
 
         This is used before we hash contexts and before we store results to
-        make sure there are no secrets in the recording.  The secrets must
-        be fed to us from the consumer (self._redactions).
+        make sure there are no secrets in the recording.  Results are stored
+        as the redacted bytes, so they are only pickled once.  The secrets must
+        be fed to us from the consumer (self._redactions), and all of them
+        are replaced in a single pass over the bytes.
 
         Raises:
             PicklingError if something in the context cannot be pickled.
         """
         raw = pickle.dumps(entity, protocol=self.PICKLE_PROTOCOL)
-        for secret, replacement in self._redactions.items():
-            raw = raw.replace(
-                secret.encode() if isinstance(secret, str) else secret,
-                replacement.encode(),
-            )
+        raw = self._redactor.redact_bytes(raw)
         return pickle.loads(raw) if not return_bytes else raw  # nosec
 
+    def _redact_outcome(self, outcome: Outcome) -> Tuple[bytes, List[Any]]:
+        """
+        Redacts an outcome like _redact, except binary buffers of at least
+        OUT_OF_BAND_SIZE bytes are kept out-of-band of the pickle and each
+        is redacted on its own.  A binary result (bytes, bytearray, or
+        memoryview, but not a subclass, which may not be rebuilt from its
+        data alone) is pickled as a buffer, as are objects that support
+        out-of-band pickling themselves.
+
+        Returns:
+            The redacted pickle and the buffers it refers to, in order.
+        """
+        if pickle.HIGHEST_PROTOCOL < self.OUT_OF_BAND_PROTOCOL:
+            return self._redact(outcome, return_bytes=True), []
+
+        result = outcome.result
+        if isinstance(result, memoryview) or (
+            type(result) in (bytes, bytearray) and len(result) >= self.OUT_OF_BAND_SIZE
+        ):
+            if isinstance(result, memoryview) and not result.contiguous:
+                result = memoryview(result.tobytes())
+            outcome = Outcome(
+                pickle.PickleBuffer(result), outcome.ex, type(outcome.result)
+            )
+
+        buffers: List[Any] = []
+
+        def out_of_band(buffer: pickle.PickleBuffer) -> bool:
+            data = buffer.raw()
+            if data.nbytes < self.OUT_OF_BAND_SIZE:
+                return True  # kept in the pickle
+            buffers.append(
+                self._redactor.redact_bytes(data.tobytes()) if self._redactor else data
+            )
+            return False
+
+        raw = pickle.dumps(
+            outcome, protocol=self.OUT_OF_BAND_PROTOCOL, buffer_callback=out_of_band
+        )
+        return self._redactor.redact_bytes(raw), buffers
+
+    def _playback_stream(self, context: CallContext, uniq: str) -> Iterator[Any]:
+        """
+        Lazily play back the items of a recorded iterator result.
+
+        If the caller consumed fewer items during recording than it does
+        during playback, RecordedCallNotFoundError is raised.
+        """
+        blobs = self.file_format >= self.BLOB_FILE_FORMAT
+        index = 0
+        while True:
+            with self._tape_lock:
+                item = self._tape.get(f"_item_{uniq}_{index}", NotImplemented)
+            if item is NotImplemented:
+                break
+            yield self._get_blob(item) if blobs else item
+            index += 1
+
+        with self._tape_lock:
+            end = self._tape.get(f"_item_{uniq}_end")
+        if end is not None and blobs:
+            end = self._get_blob(end)
+        end = cast(Optional[StreamEnd], end)
+        if end is None:
+            raise RecordedCallNotFoundError(context)
+        if end.ex is not None:
+            self._log_ex("playback", context, end.ex)
+            raise end.ex
+
     def _reduce_call(self, context: CallContext) -> Callable:
         """
         Normally we try to store the call verbatim but if pickling fails
@@ -612,4 +1389,6 @@ class TapeDeck(AbstractContextManager):
         """Clean out stuff at open and close."""
         self.file_format = 0
         self._call_ordinals = dict()
+        self._index = None
         self._redactions = dict()
+        self._redactor = Redactor(self._redactions)
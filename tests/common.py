@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from unittest import TestCase
+
+from interposer import CallContext
+from interposer.tapedeck import Mode
+from interposer.tapedeck import RecordedStream
+from interposer.tapedeck import TapeDeck
+
+
+def fetch(page: object) -> str:
+    return str(page)
+
+
+class RecordingTestCase(TestCase):
+    """
+    Records calls that fetch pages into recordings in a temporary directory
+    (datadir), and plays them back.
+    """
+
+    # more arguments of each call, to make the recorded contexts larger
+    ARGS: Tuple[Any, ...] = ()
+
+    def setUp(self) -> None:
+        self.datadir = Path(tempfile.mkdtemp())
+
+    def tearDown(self) -> None:
+        shutil.rmtree(str(self.datadir))
+
+    def context(self, page: object) -> CallContext:
+        return CallContext(call=fetch, args=(page, *self.ARGS), kwargs={})
+
+    def record(
+        self,
+        path: Path,
+        responses: Sequence[Any] = (),
+        items: Optional[Sequence[Any]] = None,
+        channel: str = "default",
+        redact: bool = False,
+        **options: Any,
+    ) -> None:
+        """
+        Record fetching each page, numbered from 0, getting its response, or
+        raising it if it is an exception.  With items, also record fetching
+        "download" in the default channel, which returns an iterator of the
+        items.  With redact, "secret" is redacted as "password".
+
+        Recording to an existing segment file appends to it.
+        """
+        with TapeDeck(path, Mode.Recording, **options) as deck:
+            if redact:
+                deck.redact("secret", "password")
+            for page, response in enumerate(responses):
+                if isinstance(response, Exception):
+                    deck.record(self.context(page), None, response, channel)
+                else:
+                    deck.record(self.context(page), response, None, channel)
+            if items is not None:
+                context = self.context("download")
+                deck.record(context, RecordedStream(), None)
+                for item in items:
+                    deck.record_item(context, item)
+                deck.record_end(context, None)
+
+    def assertPlayback(
+        self,
+        path: Path,
+        responses: Sequence[Any] = (),
+        items: Optional[Sequence[Any]] = None,
+        channel: str = "default",
+    ) -> None:
+        """
+        Play back what record() recorded.
+        """
+        with TapeDeck(path, Mode.Playback) as deck:
+            for page, response in enumerate(responses):
+                if isinstance(response, Exception):
+                    with self.assertRaises(type(response)):
+                        deck.playback(self.context(page), channel)
+                else:
+                    self.assertEqual(
+                        deck.playback(self.context(page), channel), response
+                    )
+            if items is not None:
+                played = deck.playback(self.context("download"))
+                self.assertEqual(list(played), list(items))
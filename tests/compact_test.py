@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import sys
+import types
+from dataclasses import dataclass
+from typing import List
+
+import yaml
+
+from interposer.compact import compact
+from interposer.compact import main
+from interposer.tapedeck import Mode
+from interposer.tapedeck import RecordedCallNotFoundError
+from interposer.tapedeck import TapeDeck
+from tests.common import RecordingTestCase
+
+
+def pages(response: str) -> List[str]:
+    return [f"{response}{page}" for page in range(10)]
+
+
+class CompactTest(RecordingTestCase):
+    ARGS = ("x" * 1000,)
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.path = self.datadir / "recording.db"
+
+    def test_compact(self) -> None:
+        self.record(self.path, pages("old"))
+        self.record(self.path, pages("new"))
+        before, after = compact(self.path)
+        self.assertEqual(after, self.path.stat().st_size)
+        self.assertLess(after, before)
+        self.assertPlayback(self.path, pages("new"))
+        with TapeDeck(self.path, Mode.Playback) as deck:
+            keys = list(deck._tape.keys())
+        self.assertEqual(len([key for key in keys if key.startswith("_call_")]), 10)
+        # one context and one outcome per call
+        self.assertEqual(len([key for key in keys if key.startswith("_blob_")]), 20)
+        self.assertEqual(sorted(self.datadir.iterdir()), [self.path])
+
+    def test_strip_forensics(self) -> None:
+        self.record(self.path, pages("one"))
+        _, kept = compact(self.path)
+        _, stripped = compact(self.path, forensics=False)
+        self.assertLess(stripped, kept / 2)
+        self.assertPlayback(self.path, pages("one"))
+
+        with TapeDeck(self.path, Mode.Playback) as deck:
+            self.assertFalse([key for key in deck._tape.keys() if key[:6] == "_call_"])
+            deck.dump(self.datadir / "dump.yaml")
+            with self.assertLogs("interposer.tapedeck", "DEBUG") as logs:
+                with self.assertRaises(RecordedCallNotFoundError):
+                    deck.playback(self.context(100))
+        self.assertIn("NOT EVERY RECORDED CALL WAS KEPT", "\n".join(logs.output))
+        with (self.datadir / "dump.yaml").open() as fin:
+            labels, *calls = yaml.unsafe_load_all(fin)
+        self.assertTrue(labels[TapeDeck.LABEL_STRIPPED])
+        # the index keeps the channel and ordinal of each call
+        self.assertEqual(
+            [(call["channel"], call["ordinal"]) for call in calls],
+            [("default", page) for page in range(10)],
+        )
+        self.assertEqual([call["result"] for call in calls], pages("one"))
+
+    def test_unimportable_result(self) -> None:
+        # a result class defined by a script that is not running now
+        script = types.ModuleType("recording_script")
+
+        @dataclass
+        class Response:
+            page: int
+            body: bytes
+
+        Response.__module__ = "recording_script"
+        Response.__qualname__ = "Response"
+        script.Response = Response  # type: ignore
+        responses: List[object] = [
+            Response(page, bytes(TapeDeck.OUT_OF_BAND_SIZE * page + 1))
+            for page in range(2)
+        ]
+        responses.append(memoryview(b"view"))
+        sys.modules["recording_script"] = script
+        try:
+            self.record(self.path, responses)
+        finally:
+            del sys.modules["recording_script"]
+
+        with TapeDeck(self.path, Mode.Playback) as deck:
+            calls = deck.calls("default")
+        compact(self.path)
+        with TapeDeck(self.path, Mode.Playback) as deck:
+            self.assertEqual(deck.calls("default"), calls)
+
+        sys.modules["recording_script"] = script
+        try:
+            self.assertPlayback(self.path, responses)
+        finally:
+            del sys.modules["recording_script"]
+
+    def test_main(self) -> None:
+        self.record(self.path, pages("one"))
+        self.record(self.path, pages("two"))
+        (self.datadir / "broken.tape").write_bytes(b"")
+        self.assertEqual(main([str(self.datadir), "--strip-forensics"]), 1)
+        self.assertPlayback(self.path, pages("two"))
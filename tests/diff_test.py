@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import gzip
+import shutil
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+from typing import List
+from unittest.mock import patch
+
+from interposer.diff import Change
+from interposer.diff import diff
+from interposer.diff import main
+from interposer.tapedeck import Mode
+from interposer.tapedeck import TapeDeck
+from tests.common import RecordingTestCase
+
+
+class DiffTest(RecordingTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.old = self.datadir / "old.db"
+        self.new = self.datadir / "new.db"
+
+    def record_pages(self, path: Path, pages: List[str], items: List[bytes]) -> None:
+        self.record(path, pages, items, channel="pages")
+
+    def test_diff(self) -> None:
+        self.record_pages(self.old, ["one", "two", "three", "four"], [b"a", b"b"])
+        self.record_pages(self.new, ["one", "TWO", "three"], [b"a", b"c"])
+
+        with TapeDeck(self.old, Mode.Playback) as old:
+            with TapeDeck(self.new, Mode.Playback) as new:
+                with patch.object(
+                    TapeDeck,
+                    "dump_call",
+                    autospec=True,
+                    side_effect=TapeDeck.dump_call,
+                ) as dump_call:
+                    differences = list(diff(old, new))
+                # only the changed calls were loaded
+                self.assertEqual(dump_call.call_count, 4)
+                self.assertEqual(list(diff(old, old)), [])
+                self.assertEqual(list(diff(old, new, channels=["other"])), [])
+
+        self.assertEqual(
+            [(d.channel, d.ordinal, d.change) for d in differences],
+            [
+                ("default", 0, Change.Changed),
+                ("pages", 1, Change.Changed),
+                ("pages", 3, Change.Removed),
+            ],
+        )
+        # the items are base64: b"b" became b"c"
+        self.assertEqual(
+            [line for line in differences[0].lines if line[0] in "+-"][2:],
+            ["-  Yg==", "+  Yw=="],
+        )
+        self.assertEqual(
+            [line for line in differences[1].lines if line[0] in "+-"],
+            [
+                f"--- {self.old} pages 1",
+                f"+++ {self.new} pages 1",
+                "-result: two",
+                "+result: TWO",
+            ],
+        )
+        self.assertEqual(differences[2].lines, [])
+
+    def test_main(self) -> None:
+        self.record_pages(self.old, ["one", "two"], [])
+        self.record_pages(self.new, ["one", "TWO", "three"], [])
+        with self.old.open("rb") as fin:
+            with gzip.open(f"{self.old}.gz", "wb") as fout:
+                shutil.copyfileobj(fin, fout)
+
+        out = StringIO()
+        with redirect_stdout(out):
+            self.assertEqual(main([f"{self.old}.gz", str(self.new), "--brief"]), 1)
+            self.assertEqual(main([str(self.old), str(self.old)]), 0)
+        self.assertEqual(
+            out.getvalue().splitlines(),
+            [
+                "changed: pages 1",
+                "added: pages 2",
+                "1 added, 0 removed, 1 changed",
+                "0 added, 0 removed, 0 changed",
+            ],
+        )
+
+        out = StringIO()
+        with redirect_stdout(out):
+            self.assertEqual(main([f"{self.old}.gz", str(self.new)]), 1)
+        # named as given rather than by the decompressed copy
+        self.assertIn(f"--- {self.old}.gz pages 1", out.getvalue().splitlines())
+        self.assertIn(f"+++ {self.new} pages 1", out.getvalue().splitlines())
+
+        (self.datadir / "broken.db").write_bytes(b"")
+        with redirect_stdout(StringIO()):
+            self.assertEqual(main([str(self.datadir / "broken.db"), str(self.new)]), 2)
@@ -3,21 +3,28 @@
 # Copyright (C) 2019 - 2020 Tuono, Inc.
 # Copyright (C) 2021 - 2022 CloudTruth, Inc.
 #
+import asyncio
 import datetime
+import gc
 import inspect
 import logging
+import pickle  # nosec
+import weakref
 from dataclasses import asdict
+from dataclasses import replace
 from typing import Any
 from typing import Dict
 from typing import List
 from typing import Optional
 from unittest import TestCase
+from unittest.mock import patch
 
 from interposer import CallBypass
 from interposer import CallContext
 from interposer import CallHandler
 from interposer import Interposer
 from interposer import isinterposed
+from interposer import isstreaming
 
 
 def standalone_function(foo: int):
@@ -49,6 +56,44 @@ class SimpleClass(object):
         return "DON'T PANIC!"
 
 
+class Countdown(object):
+    """A class whose instances are their own iterator."""
+
+    def __init__(self, start: int) -> None:
+        self.current = start
+
+    def __iter__(self) -> "Countdown":
+        return self
+
+    def __next__(self) -> int:
+        if self.current <= 0:
+            raise StopIteration
+        self.current -= 1
+        return self.current + 1
+
+    def remaining(self) -> int:
+        return self.current
+
+
+class AsyncClass(object):
+    """A simple class with coroutine methods."""
+
+    async def async_call(self, arg1, arg2):
+        await asyncio.sleep(0)
+        if arg2 == 3:
+            raise NotImplementedError("3 is not implemented")
+        if arg2 != 42:
+            raise SimpleError("arg2 must be 42")
+        return arg1
+
+
+def paged_function(pages: int, fail: bool = False):
+    for page in range(pages):
+        yield {"page": page}
+    if fail:
+        raise SimpleError("no more pages")
+
+
 class AdventureError(RuntimeError):
     """Used to prove a bypass exception can be raised."""
 
@@ -63,7 +108,7 @@ class AdventureCallHandler(CallHandler):
 
     def on_call_begin(self, context: CallContext) -> Optional[CallBypass]:
         if inspect.ismethod(context.call):
-            if context.args[1] != 42:  # type: ignore
+            if context.args[1] != 42:
                 raise AdventureError("PLUGH")
             return CallBypass(result="XYZZY")
         return None
@@ -112,6 +157,37 @@ class AuditingCallHandler(CallHandler):
         return result
 
 
+class AsyncAuditingCallHandler(AuditingCallHandler):
+    """
+    Awaits something of its own before auditing the end of a call.
+    """
+
+    async def on_call_end_result_async(self, context: CallContext, result: Any) -> Any:
+        await asyncio.sleep(0)
+        return self.on_call_end_result(context, result)
+
+
+class StreamingCallHandler(CallHandler):
+    """
+    Collects the items of iterator results as they are consumed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.items: List[Any] = []
+        self.ends: List[Optional[Exception]] = []
+
+    def on_call_yield(self, context: CallContext, item: Any) -> Any:
+        self.items.append(item)
+        return item["page"]
+
+    def on_call_end_stream(
+        self, context: CallContext, ex: Optional[Exception]
+    ) -> Optional[Exception]:
+        self.ends.append(ex)
+        return ValueError("replaced") if ex else None
+
+
 class LoggingCallHandler(CallHandler):
     """
     Logs a JSON representation of every call as a debug message and of any
@@ -381,3 +457,286 @@ class InterposerTest(TestCase):
         self.assertEqual(calls[0]["name"], "datetime.utcnow")
         self.assertIsInstance(calls[0]["result"], datetime.datetime)
         self.assertIn("builtin_function_or_method", str(calls[0]["type"]))
+
+    def test_interposer_attribute_cache(self):
+        """
+        Tests repeated attribute lookups reuse the child interposer until
+        the underlying attribute changes.
+        """
+        auditor = AuditingCallHandler()
+        obj = SimpleClass()
+        uut = Interposer(obj, auditor)
+
+        method = uut.regular_call
+        self.assertTrue(isinterposed(method))
+        self.assertIs(uut.regular_call, method)
+        self.assertEqual(uut.regular_call("foo", 42, kwarg1="sam"), "sam")
+        self.assertEqual(len(auditor.calls), 1)
+
+        # replacing the attribute on the wrapped object invalidates the cache
+        obj.regular_call = standalone_function
+        replaced = uut.regular_call
+        self.assertIsNot(replaced, method)
+        self.assertIs(uut.regular_call, replaced)
+        self.assertEqual(replaced(24), 42)
+
+        # a different object with the same method is a different attribute
+        other = Interposer(SimpleClass(), auditor)
+        self.assertIsNot(other.regular_call, method)
+
+        # builtins are cached as well
+        dt = Interposer(datetime.datetime, auditor)
+        self.assertIs(dt.utcnow, dt.utcnow)
+
+        # a value stored on the object is held, since the object keeps it
+        # alive anyway, until the attribute changes
+        obj.helper = SimpleClass()
+        self.assertEqual(uut.helper.regular_call("foo", 42, kwarg1="sam"), "sam")
+        released = weakref.ref(obj.helper)
+        obj.helper = SimpleClass()
+        self.assertIs(uut.helper.__wrapped__, obj.helper)
+        gc.collect()
+        self.assertIsNone(released())
+
+        # other values are cached without keeping them alive
+        class Factory(SimpleClass):
+            @property
+            def fresh(self) -> SimpleClass:
+                return SimpleClass()
+
+        fresh = Interposer(Factory(), auditor).fresh
+        released = weakref.ref(fresh.__wrapped__)
+        del fresh
+        gc.collect()
+        self.assertIsNone(released())
+
+    def test_interposer_attribute_cache_chains(self):
+        """
+        Tests chains of lookups through stored values and through stacked
+        interposers make no new child interposers once cached.
+        """
+
+        class Passing(CallHandler):
+            def on_call_begin(self, context: CallContext) -> Optional[CallBypass]:
+                return None
+
+        handler = Passing()
+        obj = SimpleClass()
+        obj.helper = SimpleClass()
+        chained = Interposer(obj, handler)
+        stacked = Interposer(Interposer(Interposer(obj, handler), handler), handler)
+        for _ in range(2):
+            with patch.object(
+                Interposer,
+                "_self_wrap",
+                autospec=True,
+                side_effect=Interposer._self_wrap,
+            ) as wrap:
+                chained.helper.regular_call("foo", 42)
+                stacked.regular_call("foo", 42)
+                stacked.helper.regular_call("foo", 42)
+        # only the first time around
+        self.assertEqual(wrap.call_count, 0)
+
+    def test_interposer_attribute_cache_equal_objects(self):
+        """
+        Tests methods bound to objects that compare equal are told apart,
+        which method equality itself does not do before Python 3.8.
+        """
+
+        class Equal(SimpleClass):
+            def __eq__(self, other: object) -> bool:
+                return True
+
+            __hash__ = SimpleClass.__hash__
+
+        first = Equal()
+        second = Equal()
+        obj = SimpleClass()
+        obj.delegate = first.regular_call
+        uut = Interposer(obj, AuditingCallHandler())
+        method = uut.delegate
+        self.assertIs(uut.delegate, method)
+        obj.delegate = second.regular_call
+        self.assertIsNot(uut.delegate, method)
+        self.assertIs(uut.delegate.__wrapped__.__self__, second)
+
+    def test_interposer_dispatch(self):
+        """
+        Tests that only the hooks a handler overrides are dispatched.
+        """
+        rewrapper = RewrapCallHandler()
+        uut = Interposer(standalone_function, [CallHandler(), rewrapper])
+        self.assertEqual(uut._self_on_begin, ())
+        self.assertEqual(uut._self_on_exception, ())
+        self.assertEqual(uut._self_on_result, (rewrapper.on_call_end_result,))
+        self.assertFalse(uut._self_passthru)
+        self.assertTrue(isinterposed(uut(24)))
+
+        # no handler does anything so the call goes straight through
+        uut = Interposer(SimpleClass, [CallHandler(), CallHandler()])
+        self.assertTrue(uut._self_passthru)
+        obj = uut()
+        self.assertTrue(isinterposed(obj))
+        self.assertEqual(obj.regular_call("foo", 42, kwarg1="sam"), "sam")
+        with self.assertRaises(SimpleError):
+            obj.regular_call("foo", "bar")
+
+        # an instance-level hook counts as an override
+        handler = CallHandler()
+        handler.on_call_begin = lambda context: CallBypass("bypassed")
+        self.assertEqual(Interposer(standalone_function, handler)(24), "bypassed")
+
+        # changing the list of handlers changes what is dispatched
+        handlers = []
+        uut = Interposer(standalone_function, handlers)
+        self.assertEqual(uut(24), 42)
+        handlers.append(handler)
+        self.assertEqual(uut(24), "bypassed")
+        handlers.clear()
+        self.assertEqual(uut(24), 42)
+
+        # child interposers share the hooks of their list of handlers, which
+        # are collected again only once the list changes
+        handlers.append(AuditingCallHandler())
+        parent = Interposer(SimpleClass(), handlers)
+        method = parent.regular_call
+        self.assertIs(method._self_hooks, parent._self_hooks)
+        self.assertIs(
+            Interposer(standalone_function, handlers)._self_hooks, parent._self_hooks
+        )
+        planned = parent._self_hooks
+        handlers.append(handler)
+        self.assertEqual(method("foo", 42, kwarg1="sam"), "bypassed")
+        self.assertIsNot(method._self_hooks, planned)
+        self.assertIs(
+            Interposer(standalone_function, handlers)._self_hooks, method._self_hooks
+        )
+
+    def test_call_context(self):
+        """
+        Tests the meta storage is only allocated when used, and that the
+        pickled form carries the rewrap flag in meta like it always has.
+        """
+        context = CallContext(standalone_function, (24,), {})
+        self.assertIsNone(context.rewrap)
+        self.assertEqual(context.peek("foo", "bar"), "bar")
+        self.assertIsNone(context._meta)
+        self.assertFalse(hasattr(context, "__dict__"))
+        self.assertIn("meta={}", repr(context))
+        self.assertIsNone(context._meta)
+
+        context.meta["foo"] = "baz"
+        self.assertEqual(context.peek("foo"), "baz")
+        context.rewrap = True
+        self.assertEqual(
+            context.__getstate__()["meta"],
+            {"_flags": {"rewrap": True}, "foo": "baz"},
+        )
+
+        copy = pickle.loads(pickle.dumps(context))  # nosec
+        self.assertEqual(copy, context)
+        self.assertTrue(copy.rewrap)
+        self.assertEqual(copy.meta, {"foo": "baz"})
+        self.assertEqual(asdict(copy)["args"], (24,))
+
+        # meta is a field like any other
+        self.assertEqual(asdict(copy)["meta"], {"foo": "baz"})
+        self.assertEqual(replace(copy, args=(42,)).meta, {"foo": "baz"})
+        copy.meta["foo"] = "qux"
+        self.assertNotEqual(copy, context)
+        self.assertEqual(
+            CallContext(standalone_function, (24,), {}),
+            CallContext(standalone_function, (24,), {}, {}),
+        )
+
+        # scratch is never pickled, compared, or kept
+        self.assertIsNone(context.peek_scratch(self))
+        self.assertIsNone(context._scratch)
+        context.scratch[self] = "started"
+        self.assertEqual(context.peek_scratch(self), "started")
+        self.assertEqual(
+            context, CallContext(standalone_function, (24,), {}, {"foo": "baz"}, True)
+        )
+        self.assertIsNone(pickle.loads(pickle.dumps(context))._scratch)  # nosec
+        self.assertNotIn("scratch", asdict(context))
+
+    def test_interposer_async(self):
+        """
+        Tests the handlers see the result or exception of a coroutine
+        once it has been awaited, not the coroutine itself.
+        """
+        auditor = AsyncAuditingCallHandler()
+        uut = Interposer(AsyncClass, auditor)()
+
+        self.assertEqual(asyncio.run(uut.async_call("foo", 42)), "foo")
+        with self.assertRaises(SimpleError):
+            asyncio.run(uut.async_call("foo", "bar"))
+        with self.assertRaises(ValueError):
+            asyncio.run(uut.async_call("foo", 3))
+
+        calls = auditor.calls
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(calls[1]["name"], "AsyncClass.async_call")
+        self.assertEqual(calls[1]["result"], "foo")
+        self.assertIsInstance(calls[2]["exception"], SimpleError)
+        self.assertIsInstance(calls[3]["exception"], NotImplementedError)
+
+        # a bypass on a coroutine never makes the actual call
+        uut = Interposer(AsyncClass(), AdventureCallHandler())
+        self.assertEqual(asyncio.run(uut.async_call("foo", 42)), "XYZZY")
+        with self.assertRaises(AdventureError):
+            asyncio.run(uut.async_call("foo", "bar"))
+
+        # stacked, with rewrap of the awaited result
+        rewrapper = RewrapCallHandler()
+        uut = Interposer(Interposer(AsyncClass(), auditor), rewrapper)
+        result = asyncio.run(uut.async_call(SimpleClass(), 42))
+        self.assertTrue(isinterposed(result))
+        self.assertIsInstance(result, SimpleClass)
+        self.assertEqual(len(calls), 5)
+
+        # stacking does not look up attributes of the inner interposer
+        inner = Interposer(AsyncClass().async_call, auditor)
+        self.assertTrue(Interposer(inner, rewrapper)._self_isasync)
+        self.assertEqual(inner._self_attrs, {})
+
+    def test_interposer_streaming(self):
+        """
+        Tests handlers see the items of an iterator result as they are
+        consumed, and the end of the stream.
+        """
+        streamer = StreamingCallHandler()
+        uut = Interposer(paged_function, streamer)
+
+        result = uut(3)
+        self.assertTrue(isstreaming(result))
+        self.assertTrue(inspect.isgenerator(result))
+        self.assertEqual(streamer.items, [])
+        self.assertEqual(next(result), 0)
+        self.assertEqual(streamer.items, [{"page": 0}])
+        self.assertEqual(list(result), [1, 2])
+        self.assertEqual(len(streamer.items), 3)
+        self.assertEqual(streamer.ends, [None])
+        self.assertEqual(list(result), [])
+        self.assertEqual(streamer.ends, [None])
+
+        with self.assertRaises(ValueError):
+            list(uut(2, fail=True))
+        self.assertIsInstance(streamer.ends[1], SimpleError)
+
+        # without a streaming handler the result is left alone
+        result = Interposer(paged_function, AuditingCallHandler())(1)
+        self.assertFalse(isstreaming(result))
+        self.assertEqual(list(result), [{"page": 0}])
+
+        # containers are not iterators
+        result = Interposer(lambda: [1, 2], streamer)()
+        self.assertFalse(isstreaming(result))
+
+        # objects that are their own iterator are rewrapped, not streamed
+        countdown = Interposer(Countdown, streamer)(2)
+        self.assertFalse(isstreaming(countdown))
+        self.assertTrue(isinterposed(countdown))
+        self.assertEqual(countdown.remaining(), 2)
+        self.assertFalse(isstreaming(Interposer(iter, streamer)([1, 2])))
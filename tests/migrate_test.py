@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import gzip
+import shutil
+from pathlib import Path
+from typing import Optional
+
+from interposer.migrate import main
+from interposer.migrate import migrate
+from interposer.migrate import recordings
+from interposer.storage import Compression
+from interposer.storage import SegmentStorage
+from interposer.tapedeck import Mode
+from interposer.tapedeck import Payload
+from interposer.tapedeck import PayloadRef
+from interposer.tapedeck import TapeDeck
+from tests.common import RecordingTestCase
+
+RESPONSES = ["one", ValueError("two"), bytes(TapeDeck.OUT_OF_BAND_SIZE)]
+ITEMS = [b"page"]
+
+
+class MigrateTest(RecordingTestCase):
+    def record_all(self, path: Path, compression: Optional[Compression] = None) -> None:
+        self.record(path, RESPONSES, ITEMS, redact=True, compression=compression)
+
+    def downgrade(self, path: Path) -> None:
+        """Rewrite the recording the way file format 8 stored it."""
+        storage = SegmentStorage(path, True, TapeDeck.PICKLE_PROTOCOL)
+        for key in storage.keys():
+            if key.startswith(("_blob_", "_buffer_")):
+                continue
+            value = storage[key]
+            if isinstance(value, PayloadRef):
+                context = storage[f"_blob_{value.context}"]
+                if value.buffers:
+                    download = bytes(TapeDeck.OUT_OF_BAND_SIZE)
+                    storage[key] = Payload(context, download, None)
+                else:
+                    outcome = storage[f"_blob_{value.outcome}"]
+                    storage[key] = Payload(context, outcome.result, outcome.ex)
+            elif key.startswith("_call_"):
+                storage[key] = storage.get_raw(f"_blob_{value}")
+            elif key.startswith("_item_"):
+                storage[key] = storage[f"_blob_{value}"]
+        storage[TapeDeck.LABEL_FILE_FORMAT] = 8
+        storage.close()
+
+    def assertMigrated(self, path: Path) -> None:
+        self.assertPlayback(path, RESPONSES, ITEMS)
+        with TapeDeck(path, Mode.Playback) as deck:
+            self.assertEqual(deck.file_format, TapeDeck.CURRENT_FILE_FORMAT)
+            self.assertEqual(deck.redact("anything", "password"), "passwo")
+            for key in deck._tape.keys():
+                if not key.startswith(("_blob_", "_buffer_")):
+                    self.assertNotIsInstance(deck._tape[key], Payload)
+
+    def test_migrate(self) -> None:
+        path = self.datadir / "recording"
+        self.record_all(path)
+        self.downgrade(path)
+        self.assertEqual(migrate(path), 8)
+        self.assertMigrated(path)
+        # already current
+        size = path.stat().st_size
+        self.assertEqual(migrate(path), TapeDeck.CURRENT_FILE_FORMAT)
+        self.assertEqual(path.stat().st_size, size)
+        self.assertEqual(sorted(self.datadir.iterdir()), [path])
+
+    def test_migrate_keeps_compression(self) -> None:
+        path = self.datadir / "recording.tape"
+        self.record_all(path, Compression("lzma"))
+        self.assertEqual(migrate(path, Compression()), TapeDeck.CURRENT_FILE_FORMAT)
+        storage = SegmentStorage(path, False, TapeDeck.PICKLE_PROTOCOL)
+        self.assertEqual(storage.compression, Compression("zlib"))
+        storage.close()
+        self.assertMigrated(path)
+
+    def test_main(self) -> None:
+        tapes = self.datadir / "tapes"
+        tapes.mkdir()
+        for name in ("first", "second"):
+            recording = tapes / f"{name}.db"
+            self.record_all(recording)
+            self.downgrade(recording)
+            with recording.open("rb") as fin:
+                with gzip.open(f"{recording}.gz", "wb") as fout:
+                    shutil.copyfileobj(fin, fout)
+        # the second is also decompressed, as RecordedTestCase leaves it
+        (tapes / "first.db").unlink()
+        (tapes / "broken.tape").write_bytes(SegmentStorage.MAGIC_COMPRESSED)
+        self.assertEqual(
+            recordings([tapes]),
+            [tapes / "broken.tape", tapes / "first.db.gz", tapes / "second.db.gz"],
+        )
+
+        self.assertEqual(main([str(tapes), "--jobs", "2"]), 1)
+        names = ["broken.tape", "first.db.gz", "second.db", "second.db.gz"]
+        self.assertEqual(sorted(path.name for path in tapes.iterdir()), names)
+        for name in ("first", "second"):
+            recording = tapes / f"{name}.db"
+            with gzip.open(f"{recording}.gz", "rb") as fin:
+                with recording.open("wb") as fout:
+                    shutil.copyfileobj(fin, fout)
+            self.assertMigrated(recording)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+from typing import List
+from typing import Optional
+from unittest import TestCase
+
+from interposer import CallBypass
+from interposer import CallContext
+from interposer import CallHandler
+from interposer import Interposer
+from interposer import isinterposed
+from interposer.policy import qualified_name
+from interposer.policy import WrapPolicy
+
+
+class Session(object):
+    """Stands in for a helper a client hands out."""
+
+    def send(self, request: str) -> str:
+        return request.upper()
+
+
+class Client(object):
+    """Stands in for a third party client."""
+
+    def __init__(self) -> None:
+        self.session = Session()
+
+    def fetch(self, item: int) -> int:
+        return item
+
+    def fetch_all(self) -> List[int]:
+        return [self.fetch(item) for item in range(3)]
+
+    def helper(self, item: int) -> int:
+        return item + 1
+
+
+class NamingCallHandler(CallHandler):
+    """Remembers the names of the calls it sees."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls: List[str] = []
+
+    def on_call_begin(self, context: CallContext) -> Optional[CallBypass]:
+        self.calls.append(context.call.__name__)
+        return None
+
+
+class WrapPolicyTest(TestCase):
+    def test_qualified_name(self) -> None:
+        client = Client()
+        self.assertEqual(qualified_name(Client), f"{__name__}.Client")
+        self.assertEqual(qualified_name(client), f"{__name__}.Client")
+        self.assertEqual(qualified_name(client.fetch), f"{__name__}.Client.fetch")
+        self.assertEqual(qualified_name("".upper), "str.upper")
+
+    def test_include(self) -> None:
+        handler = NamingCallHandler()
+        policy = WrapPolicy(include=["*.Client.fetch*"])
+        uut = Interposer(Client, handler, policy=policy)
+        client = uut()
+        self.assertTrue(isinterposed(client))
+        self.assertEqual(client.fetch(1), 1)
+        self.assertEqual(client.fetch_all(), [0, 1, 2])
+        self.assertTrue(isinterposed(client.fetch))
+        self.assertFalse(isinterposed(client.helper))
+        self.assertEqual(client.helper(1), 2)
+        # objects that do not match are reached but not seen
+        self.assertTrue(isinterposed(client.session))
+        self.assertEqual(client.session.send("a"), "A")
+        self.assertEqual(handler.calls, ["fetch", "fetch_all"])
+
+    def test_exclude(self) -> None:
+        handler = NamingCallHandler()
+        policy = WrapPolicy(
+            exclude=[Session, lambda entity: getattr(entity, "__name__", "") == "fetch"]
+        )
+        client = Interposer(Client(), handler, policy=policy)
+        self.assertFalse(isinterposed(client.session))
+        self.assertEqual(client.session.send("a"), "A")
+        self.assertFalse(isinterposed(client.fetch))
+        self.assertEqual(client.helper(1), 2)
+        self.assertEqual(handler.calls, ["helper"])
+
+        policy = WrapPolicy(include=[Client], exclude=["*.helper"])
+        client = Interposer(Client(), handler, policy=policy)
+        self.assertFalse(isinterposed(client.helper))
+        self.assertFalse(isinterposed(client.fetch))
+
+    def test_bad_rule(self) -> None:
+        with self.assertRaises(TypeError):
+            WrapPolicy(include=[42])  # type: ignore
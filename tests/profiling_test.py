@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import shutil
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from interposer import CallContext
+from interposer import Interposer
+from interposer.profiling import LatencyCallHandler
+from interposer.profiling import LatencyHistogram
+from interposer.recorder import TapeDeckCallHandler
+from interposer.tapedeck import Mode
+from interposer.tapedeck import TapeDeck
+
+
+class Client(object):
+    def fetch(self, value: int) -> int:
+        if value < 0:
+            raise ValueError("negative")
+        return value
+
+
+class LatencyHistogramTest(TestCase):
+    def test_buckets(self) -> None:
+        """Every value lands in the bucket whose range covers it."""
+        previous = -1
+        for value in list(range(200)) + [1 << bits for bits in range(8, 63)]:
+            index = LatencyHistogram.index(value)
+            self.assertLess(index, LatencyHistogram.BUCKETS)
+            self.assertLessEqual(value, LatencyHistogram.upper(index))
+            if index:
+                self.assertLess(LatencyHistogram.upper(index - 1), value)
+            self.assertGreaterEqual(index, previous)
+            previous = index
+
+    def test_percentiles(self) -> None:
+        uut = LatencyHistogram()
+        self.assertEqual(uut.summary()["p50"], 0)
+        for value in range(1, 1001):
+            uut.record(value * 1000)
+        summary = uut.summary()
+        self.assertEqual(summary["count"], 1000)
+        self.assertEqual(summary["min"], 1000)
+        self.assertEqual(summary["max"], 1000000)
+        self.assertEqual(summary["mean"], 500500)
+        # within the resolution of a bucket
+        self.assertAlmostEqual(summary["p50"], 500000, delta=500000 / 16)
+        self.assertAlmostEqual(summary["p99"], 990000, delta=990000 / 16)
+        self.assertEqual(uut.percentile(100), 1000000)
+
+        other = LatencyHistogram()
+        other.record(5)
+        uut.merge(other)
+        uut.merge(LatencyHistogram())
+        self.assertEqual(uut.count, 1001)
+        self.assertEqual(uut.min, 5)
+        self.assertEqual(uut.percentile(0), 5)
+
+
+class LatencyCallHandlerTest(TestCase):
+    def test_latency(self) -> None:
+        handler = LatencyCallHandler()
+        uut = Interposer(Client(), handler)
+        clock = iter(range(0, 1000000, 1000))
+        with patch("interposer.profiling.perf_counter_ns", side_effect=clock):
+            for value in range(10):
+                uut.fetch(value)
+            with self.assertRaises(ValueError):
+                uut.fetch(-1)
+
+        summary = handler.summary()
+        self.assertEqual(list(summary), [f"{__name__}.Client.fetch"])
+        self.assertEqual(summary[f"{__name__}.Client.fetch"]["count"], 11)
+        self.assertEqual(summary[f"{__name__}.Client.fetch"]["max"], 1000)
+
+        # a snapshot is a copy unless it resets
+        snapshot = handler.snapshot()
+        snapshot[f"{__name__}.Client.fetch"].record(1)
+        self.assertEqual(handler.summary()[f"{__name__}.Client.fetch"]["count"], 11)
+        self.assertEqual(len(handler.snapshot(reset=True)), 1)
+        self.assertEqual(handler.snapshot(), {})
+
+        uut.fetch(1)
+        handler.reset()
+        self.assertEqual(handler.summary(), {})
+
+        # an end without a beginning is ignored
+        handler.on_call_end_result(CallContext(Client().fetch, (1,), {}), 1)
+        self.assertEqual(handler.summary(), {})
+
+    def test_record_playback(self) -> None:
+        """Measuring calls first does not change how they are recorded."""
+        recording = Path(tempfile.mkdtemp()) / "recording"
+        try:
+            for mode in (Mode.Recording, Mode.Playback):
+                with TapeDeck(recording, mode) as deck:
+                    handler = LatencyCallHandler()
+                    uut = Interposer(Client(), [handler, TapeDeckCallHandler(deck)])
+                    self.assertEqual(
+                        [uut.fetch(value) for value in range(3)], [0, 1, 2]
+                    )
+            # played back calls are bypassed so they are not measured
+            self.assertEqual(handler.summary(), {})
+        finally:
+            shutil.rmtree(str(recording.parent))
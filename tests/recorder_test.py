@@ -5,10 +5,13 @@
 #
 import gzip
 import os
+import shutil
+import tempfile
 import uuid
 from pathlib import Path
 from typing import Any
 from typing import Optional
+from unittest import TestCase
 from unittest.mock import patch
 
 from noaa_sdk import noaa
@@ -18,21 +21,46 @@ from interposer import CallContext
 from interposer import CallHandler
 from interposer import Interposer
 from interposer import isinterposed
+from interposer import isstreaming
 from interposer.example.weather import Weather
 from interposer.recorder import RecordedTestCase
 from interposer.recorder import TapeDeckCallHandler
+from interposer.storage import Compression
+from interposer.storage import SegmentStorage
 from interposer.tapedeck import Mode
 from interposer.tapedeck import RecordedCallNotFoundError
+from interposer.tapedeck import TapeDeck
 
 
 class SomeClass(object):
     def times_two(self, value: int):
         return value * 2
 
+    def pages(self, count: int):
+        for page in range(count):
+            yield {"page": page}
+
     def raise_exception(self):
         raise ValueError(42)
 
 
+class Countdown(object):
+    def __init__(self, start: int) -> None:
+        self.current = start
+
+    def __iter__(self) -> "Countdown":
+        return self
+
+    def __next__(self) -> int:
+        if self.current <= 0:
+            raise StopIteration
+        self.current -= 1
+        return self.current + 1
+
+    def remaining(self) -> int:
+        return self.current
+
+
 class DoNotRecordCallHandler(CallHandler):
     """
     Tells the framework not to record almost anything.
@@ -352,3 +380,164 @@ class SecretsTestCase(RecordedTestCase):
         self.tapedeck.close()
         self.tapedeck.mode = Mode.Recording
         self.tapedeck.open()
+
+
+class StreamingTestCase(TestCase):
+    """
+    Tests recording and playback of iterator results.
+    """
+
+    def setUp(self) -> None:
+        self.datadir = Path(tempfile.mkdtemp())
+
+    def tearDown(self) -> None:
+        shutil.rmtree(str(self.datadir))
+
+    def test_streaming(self) -> None:
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as deck:
+            uut = Interposer(SomeClass(), TapeDeckCallHandler(deck))
+            self.assertTrue(isstreaming(uut.pages(3)))
+            self.assertEqual(len(list(uut.pages(100))), 100)
+            self.assertEqual(next(uut.pages(5)), {"page": 0})
+            countdown = Interposer(Countdown, TapeDeckCallHandler(deck))(2)
+            self.assertEqual(countdown.remaining(), 2)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as deck:
+            uut = Interposer(SomeClass(), TapeDeckCallHandler(deck))
+            # nothing was consumed so nothing was recorded, which proves
+            # this is being played back
+            with self.assertRaises(RecordedCallNotFoundError):
+                list(uut.pages(3))
+            self.assertEqual(
+                list(uut.pages(100)), [{"page": page} for page in range(100)]
+            )
+            self.assertEqual(next(uut.pages(5)), {"page": 0})
+            # an object that is its own iterator plays back as itself
+            countdown = Interposer(Countdown, TapeDeckCallHandler(deck))(2)
+            self.assertFalse(isstreaming(countdown))
+            self.assertEqual(countdown.remaining(), 2)
+
+
+class CompressedTapeTestCase(TestCase):
+    """
+    Tests a RecordedTestCase that records a compressed tape.
+    """
+
+    def test_compressed_tape(self) -> None:
+        class Compressed(RecordedTestCase):
+            TAPE_COMPRESSION = Compression(codec="zlib", level=9)
+
+        recordings = Path(__file__).parent / "tapes" / "recorder_test"
+        tape = recordings / "Compressed.tape"
+        try:
+            with patch.dict(os.environ, {"RECORDING": "1"}):
+                Compressed.setUpClass()
+                self.assertEqual(Compressed.tapedeck.deck, tape)
+                uut = Interposer(SomeClass(), TapeDeckCallHandler(Compressed.tapedeck))
+                self.assertEqual(uut.times_two(21), 42)
+                Compressed.tearDownClass()
+            self.assertTrue(SegmentStorage.sniff(tape))
+            self.assertFalse((recordings / "Compressed.db.gz").exists())
+
+            os.environ.pop("RECORDING", None)
+            Compressed.setUpClass()
+            self.assertEqual(Compressed.tapedeck.deck, tape)
+            uut = Interposer(SomeClass(), TapeDeckCallHandler(Compressed.tapedeck))
+            self.assertEqual(Compressed.tapedeck.mode, Mode.Playback)
+            self.assertEqual(uut.times_two(21), 42)
+            Compressed.tearDownClass()
+            # played back in place, and left alone
+            self.assertTrue(tape.exists())
+            self.assertFalse((recordings / "Compressed.db").exists())
+        finally:
+            if tape.exists():
+                tape.unlink()
+
+    def test_switch_format(self) -> None:
+        class Switched(RecordedTestCase):
+            TAPE_COMPRESSION = Compression()
+
+        recordings = Path(__file__).parent / "tapes" / "recorder_test"
+        tape = recordings / "Switched.tape"
+        archive = recordings / "Switched.db.gz"
+        recording = recordings / "Switched.db"
+        checksum = recordings / "Switched.db.sha256"
+
+        def record(compression: Optional[Compression], result: int) -> None:
+            with patch.object(Switched, "TAPE_COMPRESSION", compression):
+                with patch.dict(os.environ, {"RECORDING": "1"}):
+                    Switched.setUpClass()
+                    uut = Interposer(
+                        SomeClass(), TapeDeckCallHandler(Switched.tapedeck)
+                    )
+                    self.assertEqual(uut.times_two(result // 2), result)
+                    Switched.tearDownClass()
+
+        def playback() -> Path:
+            os.environ.pop("RECORDING", None)
+            Switched.setUpClass()
+            deck = Switched.tapedeck.deck
+            Switched.tearDownClass()
+            return deck
+
+        try:
+            record(Compression(), 42)
+            record(None, 24)
+            # the tape recorded before would be played back instead
+            self.assertFalse(tape.exists())
+            self.assertEqual(playback(), recording)
+
+            record(Compression(), 42)
+            self.assertFalse(archive.exists())
+            self.assertFalse(recording.exists())
+            self.assertFalse(checksum.exists())
+            self.assertEqual(playback(), tape)
+        finally:
+            for path in (tape, archive, recording, checksum):
+                if path.exists():
+                    path.unlink()
+
+
+class GzippedTapeTestCase(TestCase):
+    """
+    Tests that a gzipped recording is only decompressed when it changes.
+    """
+
+    def test_decompress_once(self) -> None:
+        class Gzipped(RecordedTestCase):
+            pass
+
+        recordings = Path(__file__).parent / "tapes" / "recorder_test"
+        archive = recordings / "Gzipped.db.gz"
+        recording = recordings / "Gzipped.db"
+        checksum = recordings / "Gzipped.db.sha256"
+        try:
+            with patch.dict(os.environ, {"RECORDING": "1"}):
+                Gzipped.setUpClass()
+                uut = Interposer(SomeClass(), TapeDeckCallHandler(Gzipped.tapedeck))
+                self.assertEqual(uut.times_two(21), 42)
+                Gzipped.tearDownClass()
+            self.assertTrue(archive.exists())
+            self.assertFalse(recording.exists())
+
+            os.environ.pop("RECORDING", None)
+            with patch.object(gzip, "open", wraps=gzip.open) as opened:
+                for _ in range(2):
+                    Gzipped.setUpClass()
+                    uut = Interposer(SomeClass(), TapeDeckCallHandler(Gzipped.tapedeck))
+                    self.assertEqual(uut.times_two(21), 42)
+                    Gzipped.tearDownClass()
+                    # kept for the next run
+                    self.assertTrue(recording.exists())
+                    self.assertTrue(checksum.exists())
+                self.assertEqual(opened.call_count, 1)
+
+                # a new recording is decompressed again
+                checksum.write_text("stale")
+                Gzipped.setUpClass()
+                Gzipped.tearDownClass()
+                self.assertEqual(opened.call_count, 2)
+        finally:
+            for path in (archive, recording, checksum):
+                if path.exists():
+                    path.unlink()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+from unittest import TestCase
+
+from interposer.redaction import Redactor
+
+
+class RedactorTest(TestCase):
+    def test_no_secrets(self) -> None:
+        uut = Redactor({})
+        self.assertEqual(len(uut), 0)
+        self.assertEqual(uut.redact_bytes(b"anything"), b"anything")
+        self.assertEqual(uut.redact_text("anything"), "anything")
+
+    def test_redact(self) -> None:
+        uut = Redactor(
+            {
+                "hunter2": "PASSWRD",
+                "hunter22": "PASSWORD",
+                b"\x00token\xff": "TOKEN__",
+                b"apikey": "APIKEY",
+            }
+        )
+        self.assertEqual(len(uut), 4)
+        self.assertEqual(
+            uut.redact_bytes(b"hunter22 hunter2 \x00token\xff apikey"),
+            b"PASSWORD PASSWRD TOKEN__ APIKEY",
+        )
+        # bytes secrets that are not text cannot be in text
+        self.assertEqual(
+            uut.redact_text("hunter2 hunter22 b'apikey'"),
+            "PASSWRD PASSWORD b'APIKEY'",
+        )
+
+    def test_special_characters(self) -> None:
+        uut = Redactor({"a.b*c": "X____"})
+        self.assertEqual(uut.redact_text("aXbbc a.b*c"), "aXbbc X____")
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import asyncio
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any
+from typing import List
+from typing import Optional
+from unittest import TestCase
+from unittest.mock import patch
+
+from interposer import CallContext
+from interposer import CallHandler
+from interposer import Interposer
+from interposer import isstreaming
+from interposer.recorder import TapeDeckCallHandler
+from interposer.sampling import EveryNthSampler
+from interposer.sampling import ProbabilitySampler
+from interposer.sampling import SamplingCallHandler
+from interposer.sampling import TokenBucketSampler
+from interposer.tapedeck import Mode
+from interposer.tapedeck import TapeDeck
+
+
+def double(value: int) -> int:
+    return value * 2
+
+
+def triple(value: int) -> int:
+    return value * 3
+
+
+def pages(count: int):
+    yield from range(count)
+
+
+async def adouble(value: int) -> int:
+    return value * 2
+
+
+class CountingCallHandler(CallHandler):
+    """Counts the calls it sees."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.begins: List[Any] = []
+        self.results: List[Any] = []
+        self.exceptions: List[Exception] = []
+
+    def on_call_begin(self, context: CallContext) -> None:
+        self.begins.append(context.args)
+
+    def on_call_end_exception(
+        self, context: CallContext, ex: Exception
+    ) -> Optional[Exception]:
+        self.exceptions.append(ex)
+        return None
+
+    def on_call_end_result(self, context: CallContext, result: Any) -> Any:
+        self.results.append(result)
+        return result
+
+
+class SamplingTest(TestCase):
+    def test_every_nth(self) -> None:
+        counter = CountingCallHandler()
+        uut = Interposer(double, SamplingCallHandler(counter, EveryNthSampler(3)))
+        self.assertEqual([uut(value) for value in range(7)], [0, 2, 4, 6, 8, 10, 12])
+        self.assertEqual(counter.begins, [(0,), (3,), (6,)])
+        self.assertEqual(counter.results, [0, 6, 12])
+
+        with self.assertRaises(TypeError):
+            uut(None)  # sampled, the 8th call is number 7
+        with self.assertRaises(TypeError):
+            uut(None)
+        self.assertEqual(len(counter.exceptions), 0)
+        with self.assertRaises(TypeError):
+            uut(None)
+        self.assertEqual(len(counter.exceptions), 1)
+
+        with self.assertRaises(ValueError):
+            EveryNthSampler(0)
+
+    def test_unsampled_calls_do_not_touch_storage(self) -> None:
+        sampler = EveryNthSampler(2)
+        handler = SamplingCallHandler(CountingCallHandler(), sampler)
+        sampled = CallContext(double, (1,), {})
+        unsampled = CallContext(double, (2,), {})
+        handler.on_call_begin(sampled)
+        handler.on_call_begin(unsampled)
+        handler.on_call_end_result(unsampled, 4)
+        self.assertIsNotNone(sampled._scratch)
+        self.assertIsNone(unsampled._scratch)
+        # the mark of a sampled call is not part of the call
+        self.assertIsNone(sampled._meta)
+        self.assertEqual(sampled, CallContext(double, (1,), {}))
+
+    def test_record_playback(self) -> None:
+        recording = Path(tempfile.mkdtemp()) / "recording"
+        try:
+            for mode in (Mode.Recording, Mode.Playback):
+                with TapeDeck(recording, mode) as deck:
+                    counter = CountingCallHandler()
+                    sampler = SamplingCallHandler(counter, EveryNthSampler(2))
+                    uut = Interposer(double, [sampler, TapeDeckCallHandler(deck)])
+                    self.assertEqual([uut(value) for value in range(4)], [0, 2, 4, 6])
+                    self.assertEqual(counter.begins, [(0,), (2,)])
+        finally:
+            shutil.rmtree(str(recording.parent))
+
+    def test_probability(self) -> None:
+        counter = CountingCallHandler()
+        handler = SamplingCallHandler(counter, ProbabilitySampler(0.25))
+        uut = Interposer(double, handler)
+        with patch.object(handler.sampler, "_random", side_effect=[0.1, 0.3, 0.2]):
+            for value in range(3):
+                uut(value)
+        self.assertEqual(counter.results, [0, 4])
+
+        with self.assertRaises(ValueError):
+            ProbabilitySampler(1.5)
+
+    def test_token_bucket(self) -> None:
+        counter = CountingCallHandler()
+        sampler = TokenBucketSampler(rate=10.0, burst=2)
+        handlers = SamplingCallHandler(counter, sampler)
+        with patch("interposer.sampling.time.monotonic", return_value=100.0):
+            for value in range(5):
+                Interposer(double, handlers)(value)
+                Interposer(triple, handlers)(value)
+        # each signature has its own bucket
+        self.assertEqual(counter.results, [0, 0, 2, 3])
+        with patch("interposer.sampling.time.monotonic", return_value=100.15):
+            for value in range(5):
+                Interposer(double, handlers)(value)
+        self.assertEqual(counter.results, [0, 0, 2, 3, 0])
+
+        # the same name in another module is another signature
+        def elsewhere(value: int) -> int:
+            return value * 4
+
+        elsewhere.__module__ = "elsewhere"
+        elsewhere.__qualname__ = double.__qualname__
+        with patch("interposer.sampling.time.monotonic", return_value=100.15):
+            Interposer(elsewhere, handlers)(1)
+        self.assertEqual(counter.results, [0, 0, 2, 3, 0, 4])
+
+        with self.assertRaises(ValueError):
+            TokenBucketSampler(rate=0)
+        with self.assertRaises(ValueError):
+            TokenBucketSampler(rate=1, burst=0)
+
+    def test_only_implemented_hooks(self) -> None:
+        uut = Interposer(
+            pages, SamplingCallHandler(CountingCallHandler(), EveryNthSampler(1))
+        )
+        self.assertEqual(uut._self_on_yield, ())
+        self.assertFalse(isstreaming(uut(3)))
+
+    def test_async(self) -> None:
+        counter = CountingCallHandler()
+        uut = Interposer(adouble, SamplingCallHandler(counter, EveryNthSampler(2)))
+        self.assertEqual([asyncio.run(uut(value)) for value in range(4)], [0, 2, 4, 6])
+        self.assertEqual(counter.results, [0, 4])
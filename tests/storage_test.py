@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2022 CloudTruth, Inc.
+#
+import gzip
+import mmap
+import pickle  # nosec
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from unittest import TestCase
+
+from interposer.storage import CHUNK_SIZE
+from interposer.storage import Compression
+from interposer.storage import gunzip_file
+from interposer.storage import gzip_file
+from interposer.storage import PreloadedStorage
+from interposer.storage import SegmentStorage
+from interposer.storage import ShelveStorage
+from interposer.storage import storage_for
+from interposer.storage import WriteBehind
+from interposer.storage import WriteBehindFullError
+from interposer.storage import WriteBehindStorage
+from interposer.tapedeck import Mode
+from interposer.tapedeck import TapeDeck
+from interposer.tapedeck import TapeDeckOpenError
+
+PROTOCOL = TapeDeck.PICKLE_PROTOCOL
+
+
+class SegmentStorageTest(TestCase):
+    def setUp(self) -> None:
+        self.datadir = Path(tempfile.mkdtemp())
+        self.path = self.datadir / "tape.db"
+
+    def tearDown(self) -> None:
+        shutil.rmtree(str(self.datadir))
+
+    def test_record_playback(self) -> None:
+        uut = SegmentStorage(self.path, True, PROTOCOL)
+        uut["one"] = {"value": 1}
+        uut["two"] = [2]
+        uut["one"] = {"value": "uno"}  # supersedes
+        self.assertEqual(uut.get("one"), {"value": "uno"})
+        self.assertIsNone(uut.get("three"))
+        uut.close()
+
+        self.assertTrue(SegmentStorage.sniff(self.path))
+        self.assertIs(storage_for(self.path, False), SegmentStorage)
+        uut = SegmentStorage(self.path, False, PROTOCOL)
+        self.assertEqual(sorted(uut.keys()), ["one", "two"])
+        self.assertEqual(uut["one"], {"value": "uno"})
+        self.assertEqual(uut["two"], [2])
+        self.assertIn("two", uut)
+        self.assertNotIn("three", uut)
+        self.assertNotIn(2, uut)
+        with self.assertRaises(KeyError):
+            uut["three"]
+        uut.close()
+
+    def test_set_raw(self) -> None:
+        raw = pickle.dumps({"value": 1}, protocol=PROTOCOL)
+        for storage in (SegmentStorage, ShelveStorage):
+            path = self.datadir / storage.__name__
+            uut = storage(path, True, PROTOCOL)
+            uut.set_raw("one", raw)
+            uut.close()
+            uut = storage(path, False, PROTOCOL)
+            self.assertEqual(uut["one"], {"value": 1})
+            self.assertIn("one", uut)
+            self.assertNotIn(1, uut)
+            uut.close()
+
+    def test_append(self) -> None:
+        uut = SegmentStorage(self.path, True, PROTOCOL)
+        uut["one"] = 1
+        uut.close()
+        size = self.path.stat().st_size
+
+        uut = SegmentStorage(self.path, True, PROTOCOL)
+        self.assertEqual(uut["one"], 1)
+        uut["two"] = 2
+        uut.close()
+        self.assertGreater(self.path.stat().st_size, size)
+
+        uut = SegmentStorage(self.path, False, PROTOCOL)
+        self.assertEqual((uut["one"], uut["two"]), (1, 2))
+        uut.close()
+
+    def test_recover_without_footer(self) -> None:
+        uut = SegmentStorage(self.path, True, PROTOCOL)
+        uut["one"] = 1
+        uut["two"] = 2
+        uut._file.flush()  # type: ignore
+        complete = self.path.read_bytes()
+        uut.close()
+
+        # a crash while writing the third record
+        self.path.write_bytes(complete + b"\x05\x00\x00\x00\xff\x00\x00\x00thr")
+        uut = SegmentStorage(self.path, False, PROTOCOL)
+        self.assertEqual(sorted(uut.keys()), ["one", "two"])
+        self.assertEqual(uut["two"], 2)
+        uut.close()
+
+    def test_buffers(self) -> None:
+        data = bytes(range(256)) * 10
+        for compression in (None, Compression()):
+            path = self.datadir / f"buffers{compression is not None}"
+            uut = SegmentStorage(path, True, PROTOCOL, compression)
+            for index in range(3):
+                uut[f"odd{index}"] = "x" * index
+                uut.set_buffer(f"buffer{index}", memoryview(data))
+                self.assertEqual(uut.get_buffer(f"buffer{index}"), data)
+            uut._file.flush()  # type: ignore
+            unfinished = path.read_bytes()
+            uut.close()
+
+            path.write_bytes(unfinished)  # without a footer
+            for _ in range(2):
+                uut = SegmentStorage(path, False, PROTOCOL)
+                self.assertEqual(len(list(uut.keys())), 6)
+                for index in range(3):
+                    self.assertEqual(uut[f"odd{index}"], "x" * index)
+                    view = uut.get_buffer(f"buffer{index}")
+                    self.assertEqual(view, data)
+                    self.assertIsInstance(view.obj, mmap.mmap)  # type: ignore
+                    start, _ = uut._index[f"buffer{index}"]
+                    self.assertEqual(start % SegmentStorage.ALIGNMENT, 0)
+                    del view
+                uut.close()
+                # played back from the footer the second time
+                SegmentStorage(path, True, PROTOCOL).close()
+
+    def test_not_a_segment_file(self) -> None:
+        self.path.write_bytes(b"not a tape")
+        self.assertFalse(SegmentStorage.sniff(self.path))
+        with self.assertRaises(ValueError):
+            SegmentStorage(self.path, False, PROTOCOL)
+
+    def test_storage_for(self) -> None:
+        self.assertIs(storage_for(self.path, True), SegmentStorage)
+        self.assertIs(storage_for(self.path, False), ShelveStorage)
+        self.path.touch()
+        self.assertIs(storage_for(self.path, True), SegmentStorage)
+        self.path.write_bytes(b"a shelf")
+        self.assertIs(storage_for(self.path, True), ShelveStorage)
+
+    def test_gzip(self) -> None:
+        data = bytes(range(256)) * (CHUNK_SIZE // 128 + 1)
+        self.path.write_bytes(data)
+        packed = self.datadir / "tape.db.gz"
+        gzip_file(self.path, packed)
+        self.assertEqual(gzip.decompress(packed.read_bytes()), data)
+        plain = self.datadir / "plain.db"
+        gunzip_file(packed, plain)
+        self.assertEqual(plain.read_bytes(), data)
+
+    def test_tapedeck_shelve_playback(self) -> None:
+        with TapeDeck(self.path, Mode.Recording, storage=ShelveStorage) as deck:
+            self.assertIsInstance(deck._tape, ShelveStorage)
+        with TapeDeck(self.path, Mode.Playback) as deck:
+            self.assertIsInstance(deck._tape, ShelveStorage)
+            self.assertEqual(deck.file_format, TapeDeck.CURRENT_FILE_FORMAT)
+
+
+class FailingStorage(SegmentStorage):
+    """Fails to write a particular key."""
+
+    def set_raw(self, key: str, raw: bytes) -> None:
+        if key == "bad":
+            raise OSError("disk on fire")
+        super().set_raw(key, raw)
+
+
+class GatedStorage(SegmentStorage):
+    """Holds up writes until the gate is opened."""
+
+    def __init__(self, path: Path, writable: bool, protocol: int) -> None:
+        super().__init__(path, writable, protocol)
+        self.gate = threading.Event()
+
+    def set_raw(self, key: str, raw: bytes) -> None:
+        self.gate.wait()
+        super().set_raw(key, raw)
+
+
+class WriteBehindStorageTest(TestCase):
+    def setUp(self) -> None:
+        self.datadir = Path(tempfile.mkdtemp())
+        self.path = self.datadir / "tape.db"
+
+    def tearDown(self) -> None:
+        shutil.rmtree(str(self.datadir))
+
+    def test_write_behind(self) -> None:
+        inner = SegmentStorage(self.path, True, PROTOCOL)
+        uut = WriteBehindStorage(inner, WriteBehind(capacity=4, batch=2))
+        for index in range(50):
+            uut[f"key{index}"] = index
+            # visible whether or not it has been written yet
+            self.assertEqual(uut[f"key{index}"], index)
+            self.assertIn(f"key{index}", uut)
+        data = bytearray(b"binary")
+        uut.set_buffer("buffer", data)
+        data[:] = b"reused"
+        self.assertEqual(uut.get_buffer("buffer"), b"binary")
+        uut.flush()
+        self.assertEqual(len(list(inner.keys())), 51)
+        self.assertEqual(inner.get_buffer("buffer"), b"binary")
+        uut.close()
+
+        played = SegmentStorage(self.path, False, PROTOCOL)
+        self.assertEqual(
+            [played[f"key{index}"] for index in range(50)], list(range(50))
+        )
+        played.close()
+
+    def test_back_pressure(self) -> None:
+        inner = GatedStorage(self.path, True, PROTOCOL)
+        uut = WriteBehindStorage(inner, WriteBehind(capacity=1, block=False))
+        uut["one"] = 1
+        # the writer may or may not have taken the first record yet
+        with self.assertRaises(WriteBehindFullError):
+            for index in range(3):
+                uut[f"more{index}"] = index
+        self.assertEqual(uut["one"], 1)
+        inner.gate.set()
+        uut.close()
+
+        inner = GatedStorage(self.path, True, PROTOCOL)
+        uut = WriteBehindStorage(inner, WriteBehind(capacity=1, timeout=0.01))
+        with self.assertRaises(WriteBehindFullError):
+            for index in range(3):
+                uut[f"more{index}"] = index
+        inner.gate.set()
+        uut.close()
+
+    def test_writer_error(self) -> None:
+        inner = FailingStorage(self.path, True, PROTOCOL)
+        uut = WriteBehindStorage(inner, WriteBehind())
+        uut["bad"] = 1
+        uut["good"] = 2
+        with self.assertRaises(OSError):
+            uut.flush()
+        self.assertEqual(uut["good"], 2)
+        uut.close()
+
+    def test_tapedeck(self) -> None:
+        with TapeDeck(self.path, Mode.Recording, write_behind=WriteBehind()) as deck:
+            self.assertIsInstance(deck._tape, WriteBehindStorage)
+            deck.redact("secret", "password")
+        with TapeDeck(self.path, Mode.Playback, write_behind=WriteBehind()) as deck:
+            self.assertIsInstance(deck._tape, SegmentStorage)
+            self.assertEqual(deck.redact("anything", "password"), "passwo")
+
+    def test_tapedeck_writer_error(self) -> None:
+        deck = TapeDeck(
+            self.path,
+            Mode.Recording,
+            storage=FailingStorage,
+            write_behind=WriteBehind(),
+        )
+        deck.open()
+        uut = deck._tape
+        assert isinstance(uut, WriteBehindStorage)  # nosec
+        uut["bad"] = 1
+        uut._queue.join()
+        # the writer is stopped and the file finished before the error is raised
+        with self.assertRaises(OSError):
+            deck.close()
+        self.assertFalse(uut._writer.is_alive())
+        self.assertTrue(self.path.read_bytes().endswith(SegmentStorage.MAGIC))
+        with TapeDeck(self.path, Mode.Playback) as deck:
+            self.assertEqual(deck.calls("default"), [])
+
+
+class CompressedSegmentStorageTest(TestCase):
+    def setUp(self) -> None:
+        self.datadir = Path(tempfile.mkdtemp())
+        self.value = {"body": "compressible " * 1000}
+
+    def tearDown(self) -> None:
+        shutil.rmtree(str(self.datadir))
+
+    def test_codecs(self) -> None:
+        plain = self.datadir / "plain"
+        uut = SegmentStorage(plain, True, PROTOCOL)
+        uut["one"] = self.value
+        uut.close()
+
+        for compression in (Compression(), Compression("lzma", 1)):
+            path = self.datadir / compression.codec
+            uut = SegmentStorage(path, True, PROTOCOL, compression)
+            uut["one"] = self.value
+            self.assertEqual(uut["one"], self.value)
+            uut.close()
+            self.assertTrue(SegmentStorage.sniff(path))
+            self.assertLess(path.stat().st_size, plain.stat().st_size / 10)
+
+            # appending keeps the compression of the file
+            uut = SegmentStorage(path, True, PROTOCOL)
+            uut["two"] = self.value
+            uut.close()
+
+            uut = SegmentStorage(path, False, PROTOCOL)
+            self.assertEqual(uut["one"], self.value)
+            self.assertEqual(uut["two"], self.value)
+            uut.close()
+
+    def test_bad_codec(self) -> None:
+        path = self.datadir / "tape"
+        with self.assertRaises(ValueError):
+            SegmentStorage(path, True, PROTOCOL, Compression("zip"))
+        path.write_bytes(SegmentStorage.MAGIC_COMPRESSED + b"\x09")
+        with self.assertRaises(ValueError):
+            SegmentStorage(path, False, PROTOCOL)
+
+    def test_tapedeck(self) -> None:
+        path = self.datadir / "tape"
+        with self.assertRaises(TypeError):
+            TapeDeck(
+                path, Mode.Recording, ShelveStorage, compression=Compression()
+            ).open()
+        with TapeDeck(path, Mode.Recording, compression=Compression()) as deck:
+            deck.redact("secret", "password")
+        with TapeDeck(path, Mode.Playback) as deck:
+            self.assertEqual(deck.redact("anything", "password"), "passwo")
+            self.assertEqual(deck.file_compression, Compression())
+
+        # whatever storage holds the segment file
+        with TapeDeck(path, Mode.Recording, write_behind=WriteBehind()) as deck:
+            self.assertEqual(deck.file_compression, Compression())
+        with TapeDeck(path, Mode.Playback, preload=True) as deck:
+            self.assertEqual(deck.file_compression, Compression())
+        with TapeDeck(self.datadir / "shelf", Mode.Recording, ShelveStorage) as deck:
+            self.assertIsNone(deck.file_compression)
+        with self.assertRaises(TapeDeckOpenError):
+            deck.file_compression
+
+
+class PreloadedStorageTest(TestCase):
+    def setUp(self) -> None:
+        self.datadir = Path(tempfile.mkdtemp())
+
+    def tearDown(self) -> None:
+        shutil.rmtree(str(self.datadir))
+
+    def test_preload(self) -> None:
+        for storage in (SegmentStorage, ShelveStorage):
+            path = self.datadir / storage.__name__
+            recording = storage(path, True, PROTOCOL)
+            recording["one"] = {"value": 1}
+            recording["two"] = [2]
+            recording.close()
+
+            with self.assertRaises(ValueError):
+                PreloadedStorage(storage(path, True, PROTOCOL))
+
+            uut = PreloadedStorage(storage(path, False, PROTOCOL))
+            self.assertEqual(sorted(uut.keys()), ["one", "two"])
+            self.assertEqual(uut["one"], {"value": 1})
+            # each object is unpickled fresh
+            self.assertIsNot(uut["one"], uut["one"])
+            self.assertIn("two", uut)
+            self.assertNotIn("three", uut)
+            self.assertIsNone(uut.get("three"))
+            with self.assertRaises(TypeError):
+                uut["three"] = 3
+            uut.close()
+
+    def test_tapedeck(self) -> None:
+        path = self.datadir / "tape"
+        with TapeDeck(path, Mode.Recording, preload=True) as deck:
+            self.assertIsInstance(deck._tape, SegmentStorage)
+            deck.redact("secret", "password")
+        with TapeDeck(path, Mode.Playback, preload=True) as deck:
+            self.assertIsInstance(deck._tape, PreloadedStorage)
+            self.assertEqual(deck.file_format, TapeDeck.CURRENT_FILE_FORMAT)
+            self.assertEqual(deck.redact("anything", "password"), "passwo")
@@ -3,25 +3,44 @@
 # Copyright (C) 2019 - 2020 Tuono, Inc.
 # Copyright (C) 2021 - 2022 CloudTruth, Inc.
 #
+import json
 import logging
+import mmap
 import os
 import pickle  # nosec
 import shutil
 import tempfile
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from hashlib import sha256
 from pathlib import Path
 from unittest import TestCase
+from unittest.mock import patch
+
+import yaml
 
 from interposer import CallContext
+from interposer.storage import SegmentStorage
+from interposer.tapedeck import IndexEntry
 from interposer.tapedeck import Mode
+from interposer.tapedeck import Payload
+from interposer.tapedeck import PayloadRef
 from interposer.tapedeck import RecordedCallNotFoundError
+from interposer.tapedeck import RecordedStream
 from interposer.tapedeck import RecordingTooOldError
 from interposer.tapedeck import TapeDeck
 from interposer.tapedeck import TapeDeckOpenError
 
 
+def storage_value(recording: Path, key: str) -> object:
+    storage = SegmentStorage(recording, False, TapeDeck.PICKLE_PROTOCOL)
+    try:
+        return storage[key]
+    finally:
+        storage.close()
+
+
 class SomeClass(object):
     def __init__(self, thing: object):
         self.logger = logging.getLogger(__name__)
@@ -31,6 +50,20 @@ class SomeClass(object):
         return uuid.uuid4()
 
 
+class Blob(bytes):
+    """Binary data with a name, which cannot be made from the data alone."""
+
+    name: str
+
+    def __new__(cls, name: str, data: bytes) -> "Blob":
+        blob = super().__new__(cls, data)
+        blob.name = name
+        return blob
+
+    def __getnewargs__(self):
+        return (self.name, bytes(self))
+
+
 class KeeperOfFineSecrets(object):
     """
     A typical object that holds a secret (token).
@@ -151,6 +184,150 @@ class TapeDeckTest(TestCase):
             with self.assertRaises(RecordedCallNotFoundError):
                 uut.playback(self.context1)
 
+    def test_record_pickles_once(self):
+        """Tests that recording stores the redacted pickle as it is."""
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.redact("grumbly", "angel")
+            with patch("interposer.tapedeck.pickle.loads") as mock_loads:
+                uut.record(self.context1, {"castiel": "grumbly"}, None)
+            mock_loads.assert_not_called()
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            uut.redact("grumbly", "angel")
+            self.context1.kwargs["castiel"] = "angel__"
+            self.assertEqual(uut.playback(self.context1), {"castiel": "angel__"})
+
+    def test_deduplicate_payloads(self):
+        """Tests that identical outcomes are stored once."""
+        response = {"body": "x" * 100000}
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            for _ in range(20):
+                uut.record(self.context1, response, None)
+            blobs = [key for key in uut._tape.keys() if key.startswith("_blob_")]
+            # one context per call (each has its own ordinal) and one outcome
+            self.assertEqual(len(blobs), 21)
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+        self.assertLess((self.datadir / "recording").stat().st_size, 2 * 100000)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            for _ in range(20):
+                self.assertEqual(uut.playback(self.context1), response)
+
+    def test_out_of_band_buffers(self):
+        """Tests that large binary results are stored out-of-band."""
+        size = TapeDeck.OUT_OF_BAND_SIZE
+        download = b"secret" + bytes(range(256)) * (size // 256)
+        results = [download, bytearray(download), memoryview(download), b"small"]
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.redact("secret", "hidden")
+            for result in results:
+                uut.record(self.context1, result, None)
+            buffers = [key for key in uut._tape.keys() if key.startswith("_buffer_")]
+            # the same content is stored once, and small results in the pickle
+            self.assertEqual(len(buffers), 1)
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+        recording = (self.datadir / "recording").read_bytes()
+        self.assertNotIn(b"secret", recording)
+        self.assertLess(len(recording), 2 * len(download))
+
+        redacted = download.replace(b"secret", b"hidden")
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            played = [uut.playback(self.context1) for _ in results]
+            self.assertEqual(
+                [type(result) for result in played],
+                [bytes, bytearray, memoryview, bytes],
+            )
+            self.assertEqual(played[0], redacted)
+            self.assertEqual(played[1], redacted)
+            # a view of the recording itself, without a copy
+            self.assertEqual(played[2], redacted)
+            self.assertTrue(played[2].readonly)
+            self.assertIsInstance(played[2].obj, mmap.mmap)
+            self.assertEqual(played[3], b"small")
+        # the view outlives the tape deck
+        self.assertEqual(played[2].tobytes(), redacted)
+
+    def test_small_binary_results(self):
+        """Tests that small binary results kept in the pickle keep their type."""
+        results = [b"small", bytearray(b"small"), memoryview(b"small")]
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            for result in results:
+                uut.record(self.context1, result, None)
+            buffers = [key for key in uut._tape.keys() if key.startswith("_buffer_")]
+            self.assertEqual(buffers, [])
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            played = [uut.playback(self.context1) for _ in results]
+            self.assertEqual(
+                [type(result) for result in played], [bytes, bytearray, memoryview]
+            )
+            self.assertEqual(played, results)
+            self.assertTrue(played[2].readonly)
+
+    def test_binary_subclass_result(self):
+        """Tests that a large result of a bytes subclass is pickled normally."""
+        blob = Blob("download", bytes(TapeDeck.OUT_OF_BAND_SIZE))
+        blob.extra = "kept"
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.record(self.context1, blob, None)
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            played = uut.playback(self.context1)
+        self.assertIs(type(played), Blob)
+        self.assertEqual(played, blob)
+        self.assertEqual((played.name, played.extra), ("download", "kept"))
+
+    def test_forensics_every(self):
+        """Tests keeping the contexts of only some calls for forensics."""
+        with self.assertRaises(ValueError):
+            TapeDeck(self.datadir / "recording", Mode.Recording, forensics_every=-1)
+        for every, kept in ((0, 0), (3, 4), (1, 10)):
+            recording = self.datadir / f"recording{every}"
+            with TapeDeck(recording, Mode.Recording, forensics_every=every) as uut:
+                for _ in range(10):
+                    uut.record(self.context2, "sam", None)
+                calls = [key for key in uut._tape.keys() if key.startswith("_call_")]
+                self.assertEqual(len(calls), kept)
+                self.assertEqual(TapeDeck.LABEL_STRIPPED in uut._tape, every != 1)
+            self.context2.meta.pop(TapeDeck.LABEL_TAPE)
+
+            with TapeDeck(recording, Mode.Playback) as uut:
+                for _ in range(10):
+                    self.assertEqual(uut.playback(self.context2), "sam")
+                with self.assertRaises(RecordedCallNotFoundError):
+                    uut.playback(self.context2)
+            self.context2.meta.pop(TapeDeck.LABEL_TAPE)
+
+    def test_playback_format_8(self):
+        """Tests playback of recordings made before blobs."""
+        recording = self.datadir / "recording"
+        with TapeDeck(recording, Mode.Recording) as uut:
+            uut.record(self.context1, "dean", None)
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+
+        storage = SegmentStorage(recording, True, TapeDeck.PICKLE_PROTOCOL)
+        for key in storage.keys():
+            ref = storage[key]
+            if isinstance(ref, PayloadRef):
+                outcome = storage[f"_blob_{ref.outcome}"]
+                context = storage[f"_blob_{ref.context}"]
+                storage[key] = Payload(context, outcome.result, outcome.ex)
+        storage[TapeDeck.LABEL_FILE_FORMAT] = 8
+        storage[TapeDeck.LABEL_INDEX] = None  # not kept yet
+        storage.close()
+
+        with TapeDeck(recording, Mode.Playback) as uut:
+            self.assertEqual(uut.file_format, 8)
+            self.assertEqual(uut.playback(self.context1), "dean")
+            # indexed from the forensic entries
+            self.assertEqual(uut.channels(), ["default"])
+            [call] = uut.calls("default")
+            self.assertEqual((call.ordinal, call.size), (0, None))
+            self.assertIsInstance(storage_value(recording, call.hash), Payload)
+
     def test_open_close_twice(self):
         """Tests calling open and close twice."""
         with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
@@ -158,6 +335,109 @@ class TapeDeckTest(TestCase):
                 uut.open()  # 2nd time, not idempotent (works as designed)
         uut.close()  # 2nd time, idempotent
 
+    def test_dump(self):
+        """Tests dumping calls in ordinal order, as YAML or JSON Lines."""
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.redact("grumbly", "angel")
+            for ordinal in range(12):
+                uut.record(self.context2, ordinal, None, channel="numbers")
+                self.context2.meta.pop(TapeDeck.LABEL_TAPE)
+            uut.record(self.context1, None, ValueError("nope"), channel="other")
+            uut.record(self.context2, RecordedStream(), None, channel="other")
+            uut.record_item(self.context2, "item")
+            uut.record_end(self.context2, None)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            uut.dump(self.datadir / "dump.yaml")
+            uut.dump(self.datadir / "dump.jsonl", channels=["numbers"], jsonl=True)
+
+        with (self.datadir / "dump.yaml").open() as fin:
+            labels, *calls = yaml.unsafe_load_all(fin)
+        self.assertEqual(labels["_file_format"], TapeDeck.CURRENT_FILE_FORMAT)
+        self.assertEqual(labels["_redact_angel"], 7)
+        self.assertEqual(
+            [(call["channel"], call["ordinal"]) for call in calls],
+            [("numbers", ordinal) for ordinal in range(12)]
+            + [("other", 0), ("other", 1)],
+        )
+        self.assertEqual([call["result"] for call in calls[:12]], list(range(12)))
+        self.assertEqual(calls[12]["context"].kwargs["castiel"], "angel__")
+        self.assertIsInstance(calls[12]["ex"], ValueError)
+        self.assertEqual(calls[13]["items"], ["item"])
+
+        lines = (self.datadir / "dump.jsonl").read_text().splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual(len(records), 13)
+        self.assertEqual(records[1]["channel"], "numbers")
+        self.assertEqual(records[12]["result"], 11)
+        self.assertIn("CallContext", records[12]["context"])
+
+    def test_index(self):
+        """Tests listing the channels and calls of a recording."""
+        recording = self.datadir / "recording"
+        download = bytes(TapeDeck.OUT_OF_BAND_SIZE)
+        with TapeDeck(recording, Mode.Recording, forensics_every=0) as uut:
+            for ordinal in range(3):
+                uut.record(self.context2, ordinal, None, channel="numbers")
+                self.context2.meta.pop(TapeDeck.LABEL_TAPE)
+            uut.record(self.context2, download, None)
+            self.context2.meta.pop(TapeDeck.LABEL_TAPE)
+            self.assertEqual(uut.channels(), ["default", "numbers"])
+        # recording again adds to the index
+        with TapeDeck(recording, Mode.Recording) as uut:
+            with uut.scope("worker"):
+                uut.record(self.context1, "castiel", None)
+
+        with TapeDeck(recording, Mode.Playback) as uut:
+            self.assertEqual(uut.channels(), ["default", "default/worker", "numbers"])
+            calls = uut.calls("numbers")
+            self.assertEqual([call.ordinal for call in calls], [0, 1, 2])
+            self.assertEqual(len({call.hash for call in calls}), 3)
+            for call in calls:
+                self.assertIsInstance(uut._tape[call.hash], PayloadRef)
+                self.assertLess(0, call.size)
+            [call] = uut.calls("default")
+            self.assertLess(TapeDeck.OUT_OF_BAND_SIZE, call.size)
+            self.assertEqual(uut.calls("missing"), [])
+            self.assertIsInstance(uut.calls("default/worker")[0], IndexEntry)
+
+            # without their contexts, the calls are still dumped in order
+            uut.dump(self.datadir / "dump.jsonl", jsonl=True)
+        lines = (self.datadir / "dump.jsonl").read_text().splitlines()
+        records = [json.loads(line) for line in lines[1:]]
+        self.assertEqual(
+            [(record["channel"], record["ordinal"]) for record in records],
+            [("default", 0), ("default/worker", 0)]
+            + [("numbers", ordinal) for ordinal in range(3)],
+        )
+
+        with self.assertRaises(TapeDeckOpenError):
+            uut.channels()  # not open!
+
+    def test_dump_keys(self):
+        """Tests dumping results with dict keys JSON cannot represent."""
+        result = {("a", 1): [{b"key": "value"}], None: {2: "two"}}
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.record(self.context1, result, None)
+
+        dump = self.datadir / "dump.jsonl"
+        dump.write_text("previous")
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            uut.dump(dump, jsonl=True)
+            records = [json.loads(line) for line in dump.read_text().splitlines()]
+            self.assertEqual(
+                records[1]["result"],
+                {"('a', 1)": [{"b'key'": "value"}], "null": {"2": "two"}},
+            )
+
+            # a dump that fails leaves the previous one
+            dump.write_text("previous")
+            with patch("interposer.tapedeck.json.dumps", side_effect=TypeError("nope")):
+                with self.assertRaises(TypeError):
+                    uut.dump(dump, jsonl=True)
+            self.assertEqual(dump.read_text(), "previous")
+            self.assertEqual(list(self.datadir.glob("dump.jsonl*")), [dump])
+
     def test_dump_closed(self):
         """Tests calling dump when not open."""
         with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
@@ -311,3 +591,77 @@ class TapeDeckTest(TestCase):
                         call=KeeperOfFineSecrets, args=(), kwargs={"sam": "dean"}
                     )
                 )
+
+    def test_threaded_record_playback(self):
+        """
+        Tests recording and playback with calls fanned out across threads,
+        where each unit of work has its own scope.
+        """
+
+        def work(uut: TapeDeck, item: int, action: str) -> list:
+            results = []
+            with uut.scope(f"item{item}"):
+                for call in range(10):
+                    context = CallContext(
+                        call=self.someclass.amethod, args=(item, call), kwargs={}
+                    )
+                    if action == "record":
+                        uut.record(context, item * 100 + call, None, channel="fan")
+                    else:
+                        results.append(uut.playback(context, channel="fan"))
+            return results
+
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                list(pool.map(lambda item: work(uut, item, "record"), range(16)))
+            self.assertEqual(uut._call_ordinals["fan/item3"], 9)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                # play back in the opposite order to the recording
+                results = list(
+                    pool.map(
+                        lambda item: work(uut, item, "playback"), range(15, -1, -1)
+                    )
+                )
+            self.assertEqual(
+                results,
+                [
+                    [item * 100 + call for call in range(10)]
+                    for item in range(15, -1, -1)
+                ],
+            )
+
+    def test_record_playback_stream(self):
+        """
+        Tests recording the items of an iterator result one at a time and
+        playing them back lazily.
+        """
+        with TapeDeck(self.datadir / "recording", Mode.Recording) as uut:
+            uut.record(self.context1, RecordedStream(), None)
+            for page in range(3):
+                uut.record_item(self.context1, {"page": page})
+            uut.record_end(self.context1, None)
+            uut.record(self.context2, RecordedStream(), None)
+            uut.record_item(self.context2, "only")
+            uut.record_end(self.context2, ValueError("broken stream"))
+            # a stream the caller did not finish consuming
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+            uut.record(self.context1, RecordedStream(), None)
+            uut.record_item(self.context1, "first")
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+            self.context2.meta.pop(TapeDeck.LABEL_TAPE)
+
+        with TapeDeck(self.datadir / "recording", Mode.Playback) as uut:
+            stream = uut.playback(self.context1)
+            self.assertEqual(next(stream), {"page": 0})
+            self.assertEqual(list(stream), [{"page": 1}, {"page": 2}])
+            stream = uut.playback(self.context2)
+            self.assertEqual(next(stream), "only")
+            with self.assertRaises(ValueError):
+                next(stream)
+            self.context1.meta.pop(TapeDeck.LABEL_TAPE)
+            stream = uut.playback(self.context1)
+            self.assertEqual(next(stream), "first")
+            with self.assertRaises(RecordedCallNotFoundError):
+                next(stream)